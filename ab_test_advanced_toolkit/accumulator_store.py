@@ -0,0 +1,275 @@
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import logging
+
+from ab_test_advanced_toolkit.allocation_table import NAT
+
+logger = logging.getLogger(__name__)
+
+METADATA_FILE = "store.json"
+USERS_FILE = "users.npy"
+GENERATION_PREFIX = "generation_"
+
+# Per-user count and time of the last event of the events folded while their users were not allocated yet
+PENDING_EVENTS = ("pending", "", "__events")
+PENDING_LAST = ("pending", "", "__last")
+
+
+class AccumulatorStore:
+    def __init__(self, path: str, initial_capacity: int = 1024):
+        """
+        Persistent columnar store of per-user aggregates. Users get dense integer codes in the order they are first
+        seen and every (period, event, column) aggregate is a memory-mapped NumPy array indexed by the user code.
+        Periods are "pretest" and "intest" for events of allocated users and "pending" for events of users that
+        were not allocated yet when they were folded; pending events are split by allocation time when they are read.
+        Columns are "__count" for event counts and attribute names for attribute sums; conversions are derived
+        from event counts. A daily job only reads one day of events.
+
+        Every fold writes a new generation of the arrays: the arrays of the current generation are copied into a new
+        directory and updated there, and flush switches to the new generation by atomically replacing the metadata.
+        A fold that fails before flush leaves the stored generation as it was.
+
+        :param path: Directory of the store. It is created if it does not exist.
+        :param initial_capacity: Number of users the arrays are allocated for when the store is created.
+                The arrays grow geometrically when more users are added.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+
+        metadata = {}
+        if os.path.exists(os.path.join(path, METADATA_FILE)):
+            with open(os.path.join(path, METADATA_FILE)) as f:
+                metadata = json.load(f)
+
+        self.generation: int = metadata.get("generation", 0)
+        self._stored_generation = self.generation
+        self.num_users: int = metadata.get("num_users", 0)
+        self.capacity: int = metadata.get("capacity", max(initial_capacity, 1))
+        self.columns: List[Tuple[str, str, str]] = [tuple(column) for column in metadata.get("columns", [])]
+        self.tracked_events: List[str] = metadata.get("tracked_events", [])
+        self.tracked_attributes: List[str] = metadata.get("tracked_attributes", [])
+        checkpoint = metadata.get("checkpoint")
+        self.checkpoint: Optional[pd.Timestamp] = pd.Timestamp(checkpoint) if checkpoint is not None else None
+        # pretest events outside of the window are not folded, so the window is fixed when the store is created
+        self.pretest_lookback: Optional[int] = metadata.get("pretest_lookback")
+
+        users = np.load(self._file(USERS_FILE), allow_pickle=True) if self.num_users > 0 else []
+        self._users = pd.Index(users)
+        # arrays of the stored generation are never written, folds write copies of them
+        self._arrays: Dict[Tuple[str, str, str], np.ndarray] = {
+            column: np.lib.format.open_memmap(self._column_file(position), mode="r")
+            for position, column in enumerate(self.columns)}
+
+    def _generation_path(self, generation: int) -> str:
+        return os.path.join(self.path, f"{GENERATION_PREFIX}{generation}")
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self._generation_path(self.generation), name)
+
+    def _column_file(self, position: int) -> str:
+        return self._file(f"column_{position}.npy")
+
+    def _begin(self):
+        """
+        Starts a new generation on the first change after opening or flushing the store.
+        """
+        if self.generation != self._stored_generation:
+            return
+        # leftovers of folds that failed before flush
+        for name in os.listdir(self.path):
+            if name.startswith(GENERATION_PREFIX) and name != f"{GENERATION_PREFIX}{self.generation}":
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+        stored_files = [self._column_file(position) for position in range(len(self.columns))]
+        self.generation += 1
+        os.makedirs(self._generation_path(self.generation))
+        for position, column in enumerate(self.columns):
+            shutil.copyfile(stored_files[position], self._column_file(position))
+            self._arrays[column] = np.lib.format.open_memmap(self._column_file(position), mode="r+")
+
+    def _ensure_capacity(self, num_users: int):
+        if num_users <= self.capacity:
+            return
+        capacity = max(num_users, 2 * self.capacity)
+        for position, column in enumerate(self.columns):
+            fd, tmp_path = tempfile.mkstemp(dir=self._generation_path(self.generation), suffix=".tmp")
+            os.close(fd)
+            grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=self._arrays[column].dtype,
+                                              shape=(capacity,))
+            grown[:self.num_users] = self._arrays[column][:self.num_users]
+            grown.flush()
+            del grown
+            self._arrays[column] = None
+            os.replace(tmp_path, self._column_file(position))
+            self._arrays[column] = np.lib.format.open_memmap(self._column_file(position), mode="r+")
+        logger.debug(f"Grew accumulator store from {self.capacity} to {capacity} users")
+        self.capacity = capacity
+
+    def _column(self, column: Tuple[str, str, str], dtype=np.float64) -> np.ndarray:
+        if column not in self._arrays:
+            self._arrays[column] = np.lib.format.open_memmap(self._column_file(len(self.columns)), mode="w+",
+                                                             dtype=dtype, shape=(self.capacity,))
+            self.columns.append(column)
+        return self._arrays[column]
+
+    def _add_users(self, userids: pd.Index):
+        new_users = userids.difference(self._users, sort=False)
+        if len(new_users) == 0:
+            return
+        self._ensure_capacity(self.num_users + len(new_users))
+        self._users = self._users.append(new_users) if self.num_users > 0 else pd.Index(new_users)
+        self.num_users = len(self._users)
+
+    def _add_block(self, period: str, event_name: str, block: pd.DataFrame) -> np.ndarray:
+        # users are unique within a block, so a plain fancy-indexed add is safe
+        codes = self.user_codes(block.index.get_level_values("userid"))
+        for column_name in block.columns:
+            self._column((period, event_name, column_name))[codes] += block[column_name].to_numpy(dtype=np.float64)
+        return codes
+
+    def check_pretest_lookback(self, pretest_lookback: Optional[int]):
+        """
+        Checks that the store is folded and read with the pretest window it was created with. Pretest events
+        outside of the window of the first fold are not stored, so another window would give wrong pretest values.
+        :param pretest_lookback: Optional length of the pretest window in nanoseconds.
+        """
+        if self.columns and pretest_lookback != self.pretest_lookback:
+            raise ValueError(f"The accumulator store was created with pretest_lookback={self.pretest_lookback} ns, "
+                             f"it cannot be used with pretest_lookback={pretest_lookback} ns")
+        self.pretest_lookback = pretest_lookback
+
+    def user_codes(self, userids) -> np.ndarray:
+        """
+        Returns dense codes of the given users, -1 for users that are not in the store.
+        :param userids: array-like of user identifiers
+        """
+        return self._users.get_indexer(userids)
+
+    def fold(self, aggregated: pd.DataFrame, event_names: Iterable[str], attribute_names: Iterable[str],
+             checkpoint: Optional[pd.Timestamp] = None):
+        """
+        Adds per-user aggregates of new events to the arrays of the new generation.
+        :param aggregated: Output of ABTestAnalyzer._aggregate_events_batch.
+                DataFrame with format | pretest (index) | event_name (index) | userid (index) | __count | attribute_1 | ...
+        :param event_names: Event names whose aggregates are kept up to date by this fold.
+        :param attribute_names: Attribute names whose sums are kept up to date by this fold.
+        :param checkpoint: Timestamp of the latest folded event.
+        """
+        self._begin()
+        self.tracked_events += [name for name in event_names if name not in self.tracked_events]
+        self.tracked_attributes += [name for name in attribute_names if name not in self.tracked_attributes]
+        if checkpoint is not None:
+            self.checkpoint = checkpoint if self.checkpoint is None else max(self.checkpoint, checkpoint)
+        if aggregated.empty:
+            return
+
+        self._add_users(aggregated.index.get_level_values("userid").unique())
+        for (pretest, event_name), block in aggregated.groupby(level=["pretest", "event_name"], observed=True):
+            self._add_block("pretest" if pretest else "intest", event_name, block)
+
+    def fold_pending(self, aggregated: pd.DataFrame, last_times: pd.Series):
+        """
+        Adds per-user aggregates of new events of users that are not allocated yet. They are kept apart from pretest
+        and intest aggregates, together with the time of the last event of every user, until the users are
+        allocated (see period_values).
+        :param aggregated: DataFrame with format | event_name (index) | userid (index) | __count | attribute_1 | ...
+        :param last_times: int64 epoch nanoseconds of the last event of every user, indexed by user ID.
+        """
+        self._begin()
+        if aggregated.empty:
+            return
+
+        self._add_users(last_times.index)
+        codes = self.user_codes(last_times.index)
+        events = self._column(PENDING_EVENTS, dtype=np.int64)
+        last = self._column(PENDING_LAST, dtype=np.int64)
+        last[codes] = np.where(events[codes] > 0, np.maximum(last[codes], last_times.to_numpy()), last_times.to_numpy())
+        for event_name, block in aggregated.groupby(level="event_name", observed=True):
+            block_codes = self._add_block("pending", event_name, block)
+            events[block_codes] += block["__count"].to_numpy(dtype=np.int64)
+
+    def values(self, period: str, event_name: str, column_name: str, userids) -> np.ndarray:
+        """
+        Returns stored aggregates of the given users. Users and events without stored aggregates get 0.
+        :param period: "pretest", "intest" or "pending".
+        :param event_name: The name of the event.
+        :param column_name: "__count" for event counts or the name of the attribute for attribute sums.
+        :param userids: array-like of user identifiers
+        :return: array of aggregates aligned with userids
+        """
+        array = self._arrays.get((period, event_name, column_name))
+        values = np.zeros(len(userids), dtype=array.dtype if array is not None else np.float64)
+        if array is not None:
+            codes = self.user_codes(userids)
+            known = codes >= 0
+            values[known] = array[codes[known]]
+        return values
+
+    def period_values(self, event_name: str, column_name: str, userids, allocation_times: np.ndarray,
+                      pretest_lookback: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns pretest and intest aggregates of the given users, including their pending events. Pending events of
+        a user are pretest events when the last of them happened before the allocation (and within pretest_lookback
+        of it) and intest events otherwise. Pending events that span the allocation time, because the allocation
+        was not known yet when events after it were folded, cannot be told apart and all count as intest events.
+        :param event_name: The name of the event.
+        :param column_name: "__count" for event counts or the name of the attribute for attribute sums.
+        :param userids: array-like of user identifiers
+        :param allocation_times: int64 epoch nanoseconds of the allocation of every user (AllocationTable.timestamps).
+        :param pretest_lookback: Optional length of the pretest window in nanoseconds.
+        :return: pretest aggregates, intest aggregates aligned with userids
+        """
+        pretest = self.values("pretest", event_name, column_name, userids)
+        intest = self.values("intest", event_name, column_name, userids)
+        if ("pending", event_name, column_name) in self._arrays:
+            pending = self.values("pending", event_name, column_name, userids)
+            last = self.values(*PENDING_LAST, userids)
+            allocated = allocation_times != NAT
+            after = last >= allocation_times
+            in_window = last >= allocation_times - pretest_lookback if pretest_lookback is not None else True
+            pretest += np.where(allocated & ~after & in_window, pending, 0.0)
+            intest += np.where(allocated & after, pending, 0.0)
+        return pretest, intest
+
+    def flush(self):
+        """
+        Writes the arrays and the list of users of the new generation and switches to it by atomically replacing
+        the metadata. The previous generation is removed afterwards.
+        """
+        if self.generation == self._stored_generation:
+            return
+        for array in self._arrays.values():
+            array.flush()
+        np.save(self._file(USERS_FILE), self._users.to_numpy(), allow_pickle=True)
+
+        metadata = {
+            "generation": self.generation,
+            "num_users": self.num_users,
+            "capacity": self.capacity,
+            "columns": [list(column) for column in self.columns],
+            "tracked_events": self.tracked_events,
+            "tracked_attributes": self.tracked_attributes,
+            "checkpoint": self.checkpoint.isoformat() if self.checkpoint is not None else None,
+            "pretest_lookback": self.pretest_lookback,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, os.path.join(self.path, METADATA_FILE))
+
+        shutil.rmtree(self._generation_path(self._stored_generation), ignore_errors=True)
+        self._stored_generation = self.generation
+
+    def __len__(self):
+        return self.num_users
+
+    def __repr__(self):
+        return (f"AccumulatorStore(path={self.path}, num_users={self.num_users}, columns={len(self.columns)}, "
+                f"generation={self.generation}, checkpoint={self.checkpoint})")
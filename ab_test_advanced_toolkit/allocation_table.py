@@ -0,0 +1,151 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ab_test_advanced_toolkit.moments import GroupMoments
+
+NAT = np.iinfo(np.int64).min
+
+
+def to_epoch(timestamps) -> np.ndarray:
+    """
+    Converts timestamps to int64 nanoseconds since the epoch. Missing timestamps become NAT.
+    :param timestamps: Series or array-like of timestamps
+    """
+    timestamps = pd.Series(timestamps) if not isinstance(timestamps, pd.Series) else timestamps
+    if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        timestamps = timestamps.dt.tz_convert("UTC").dt.tz_localize(None)
+    return timestamps.to_numpy(dtype="datetime64[ns]").view(np.int64)
+
+
+class AllocationTable:
+    def __init__(self, ab_test_allocations: pd.DataFrame, group_names: Optional[List[str]] = None,
+                 group_codes: Optional[np.ndarray] = None):
+        """
+        Compact array-backed representation of AB test allocations. User IDs are mapped once to dense int32 codes
+        (their positions in the allocations), groups are stored as int8 codes and allocation times as int64 epoch
+        nanoseconds. Per-user aggregates and per-group moments are calculated with np.bincount over the codes
+        instead of joining on user IDs.
+
+        :param ab_test_allocations: DataFrame containing AB test allocations. Expected pandas format: |timestamp|userid (index)|abgroup|
+        :param group_names: Optional sorted group names that were already factorized, e.g. by ValidationReport.
+        :param group_codes: Optional group codes of the users matching group_names.
+        """
+        if len(ab_test_allocations) > np.iinfo(np.int32).max:
+            raise ValueError("AllocationTable supports at most 2^31 - 1 users")
+        if group_names is None or group_codes is None:
+            group_codes, group_names = pd.factorize(ab_test_allocations["abgroup"], sort=True)
+        if len(group_names) > np.iinfo(np.int8).max:
+            raise ValueError("AllocationTable supports at most 127 groups")
+
+        self.userids = ab_test_allocations.index
+        self.group_names = list(group_names)
+        self.group_codes = group_codes.astype(np.int8, copy=False)
+        self.timestamps = to_epoch(ab_test_allocations["timestamp"])
+
+    @property
+    def num_users(self) -> int:
+        return len(self.userids)
+
+    @property
+    def groups(self) -> pd.Categorical:
+        """
+        Group of every user as a categorical backed by the int8 group codes.
+        """
+        return pd.Categorical.from_codes(self.group_codes, categories=self.group_names)
+
+    def encode(self, userids) -> np.ndarray:
+        """
+        Maps user IDs to dense codes. Users that are not allocated get -1.
+        :param userids: array-like of user identifiers
+        :return: int32 array of user codes
+        """
+        return self.userids.get_indexer(userids).astype(np.int32)
+
+    def split_periods(self, codes: np.ndarray, event_timestamps,
+                      pretest_lookback: Optional[pd.Timedelta] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Splits events into pretest and intest by comparing their timestamps with the allocation time of their users.
+        Events of unknown users and events with missing timestamps are neither pretest nor intest.
+        :param codes: User codes of the events.
+        :param event_timestamps: Timestamps of the events.
+        :param pretest_lookback: Optional length of the pretest window. Earlier events are neither pretest nor intest.
+        :return: pretest mask, intest mask
+        """
+        event_times = to_epoch(event_timestamps)
+        allocation_times = np.where(codes >= 0, self.timestamps[codes], NAT)
+        valid = (allocation_times != NAT) & (event_times != NAT)
+        pretest_mask = valid & (event_times < allocation_times)
+        if pretest_lookback is not None:
+            pretest_mask &= event_times >= allocation_times - pretest_lookback.value
+        return pretest_mask, valid & (event_times >= allocation_times)
+
+    def aggregate(self, codes: np.ndarray, weights=None) -> np.ndarray:
+        """
+        Sums weights (or counts events when weights are None) per user.
+        :param codes: Non-negative user codes of the events.
+        :param weights: Optional array-like of values to sum.
+        :return: float array of per-user aggregates aligned with the allocations
+        """
+        return np.bincount(codes, weights=weights, minlength=self.num_users).astype(np.float64, copy=False)
+
+    def scatter(self, userids, values) -> np.ndarray:
+        """
+        Places values of a subset of users into a dense per-user array, filling other users with 0.
+        :param userids: Allocated user identifiers.
+        :param values: array-like of values of these users
+        """
+        dense = np.zeros(self.num_users)
+        dense[self.encode(userids)] = values
+        return dense
+
+    def frame(self, value_column: str, values: np.ndarray) -> pd.DataFrame:
+        """
+        :param value_column: The name of the column with per-user values.
+        :param values: Dense per-user values aligned with the allocations.
+        :return: DataFrame with format | userid (index) | abgroup | value_column |
+        """
+        return self.columns_frame({value_column: values})
+
+    def columns_frame(self, columns: Dict[str, np.ndarray]) -> pd.DataFrame:
+        """
+        :param columns: Dense per-user values aligned with the allocations by column name.
+        :return: DataFrame with format | userid (index) | abgroup | column_1 | column_2 | ...
+        """
+        return pd.DataFrame({"abgroup": self.groups, **columns}, index=self.userids)
+
+    def group_moments(self, values: np.ndarray) -> Dict[str, GroupMoments]:
+        """
+        Calculates moments of dense per-user values for every group with np.bincount over the group codes.
+        :param values: Dense per-user values aligned with the allocations.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        observed = ~np.isnan(values)
+        codes = self.group_codes[observed]
+        values = values[observed]
+        n = np.bincount(codes, minlength=len(self.group_names))
+        total = np.bincount(codes, weights=values, minlength=len(self.group_names))
+        total_sq = np.bincount(codes, weights=values * values, minlength=len(self.group_names))
+        return {group: GroupMoments(int(n[code]), total[code], total_sq[code])
+                for code, group in enumerate(self.group_names) if n[code] > 0}
+
+    def group_means(self, value_column: str, values: np.ndarray) -> pd.DataFrame:
+        """
+        :param value_column: The name of the column with per-user values.
+        :param values: Dense per-user values aligned with the allocations.
+        :return: DataFrame with format | abgroup (index) | value_column |
+        """
+        moments = self.group_moments(values)
+        return pd.DataFrame({value_column: [group_moments.mean for group_moments in moments.values()]},
+                            index=pd.Index(list(moments), name="abgroup"))
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory used by the group codes and allocation times, excluding the user ID index.
+        """
+        return self.group_codes.nbytes + self.timestamps.nbytes
+
+    def __repr__(self):
+        return f"AllocationTable(num_users={self.num_users}, groups={self.group_names})"
@@ -1,55 +1,257 @@
-from typing import Tuple, List, Optional
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, List, Optional, Dict, Iterable, Union
 
+import numpy as np
 import pandas as pd
 
-from ab_test_advanced_toolkit.data_validation import validate_data
-from ab_test_advanced_toolkit.metrics import Metric, MetricType, MetricParams, MetricResult, AggregationOperation
-from ab_test_advanced_toolkit.stat_significance import StatTests
-from ab_test_advanced_toolkit.vizualizer import format_metrics_to_html
+from ab_test_advanced_toolkit.accumulator_store import AccumulatorStore
+from ab_test_advanced_toolkit.allocation_table import AllocationTable, NAT, to_epoch
+from ab_test_advanced_toolkit.data_validation import validate_data, validate_event_data, ValidationReport, \
+    ValidationCache
+from ab_test_advanced_toolkit.event_index import EventIndex
+from ab_test_advanced_toolkit.ingestion import iter_event_chunks, load_event_data, DEFAULT_CHUNKSIZE, \
+    NormalizationReport, normalize_allocations, normalize_event_data, widen_attributes
+from ab_test_advanced_toolkit.model_cache import ModelCache
+from ab_test_advanced_toolkit.moments import MomentsMatrix, RatioMomentsMatrix
+from ab_test_advanced_toolkit.regressors import RegressorBackend, CrossFitting, get_regressor_backend
+from ab_test_advanced_toolkit.sequential import SequentialState
+from ab_test_advanced_toolkit.user_timeline import UserTimeline
+from ab_test_advanced_toolkit.metrics import Metric, MetricType, MetricParams, MetricResult, AggregationOperation, \
+    MetricSpec, RATIO_NUMERATOR, RATIO_DENOMINATOR
+from ab_test_advanced_toolkit.stat_significance import StatTests, StatSignificanceResult, StatSignificanceMethod, \
+    BootstrapEngine, CORRECTIONS
+from ab_test_advanced_toolkit.vizualizer import write_metrics_html, write_metrics_ndjson
 
 
 import logging
 
+MODES = ["no_enhancement", "cuped", "gboost_cuped"]
+PERIOD_SPLITS = ["merge", "sorted"]
+
+
 # Function to set up logging configuration
 def setup_logging(level=logging.INFO):
     logging.basicConfig(level=level, format='%(asctime)s - %(levelname)s - %(message)s')
     logger = logging.getLogger(__name__)
     return logger
 
+def _run_stat_test(merged_pretest: pd.DataFrame, merged_intest: pd.DataFrame, operation: AggregationOperation,
+                   mode: str, control_group_name: str, test_group_names: List[str],
+                   user_properties: Optional[pd.DataFrame] = None,
+                   model_cache: Optional[ModelCache] = None,
+                   regressor: Optional[RegressorBackend] = None,
+                   cross_fitting: Optional[CrossFitting] = None) -> StatSignificanceResult:
+    """
+    Runs the statistical test matching the metric operation and the analyzer mode on merged pretest and intest data.
+    Conversions are always compared with a T-test on intest data.
+    :param merged_pretest: DataFrame containing the pretest data. Expected pandas format: | userid (index) | abgroup | value_column |
+    :param merged_intest: DataFrame containing the intest data. Expected pandas format: | userid (index) | abgroup | value_column |
+    :param operation: The aggregation operation of the metric.
+    :param mode: Mode of enhancement ("no_enhancement", "cuped", "gboost_cuped").
+    :return: StatSignificanceResult instance with p-values and the method used.
+    """
+    if operation == AggregationOperation.RATIO:
+        if mode == "no_enhancement":
+            return StatTests.calculate_delta_method_t_test(merged_intest, control_group_name, test_group_names)
+        # ratios are variance-reduced as per-user linearized values, with pretest numerators and denominators
+        # as covariates
+        merged_intest = StatTests.linearize_ratio(merged_intest, control_group_name, test_group_names)
+    elif operation == AggregationOperation.CONVERSION:
+        return StatTests.calculate_t_test_for_dataset(merged_intest, control_group_name, test_group_names)
+    if mode == "gboost_cuped":
+        return StatTests.calculate_gboost_cuped_and_compare(merged_pretest, merged_intest, user_properties,
+                                                            control_group_name, test_group_names, True,
+                                                            model_cache=model_cache, regressor=regressor,
+                                                            cross_fitting=cross_fitting)
+    elif mode == "cuped":
+        return StatTests.calculate_cuped_and_compare(merged_pretest, merged_intest,
+                                                     control_group_name, test_group_names)
+    return StatTests.calculate_gboost_cuped_and_compare(merged_pretest, merged_intest,
+                                                        user_properties,
+                                                        control_group_name, test_group_names,
+                                                        False)
+
+
+def _welch_moments(merged_pretest: pd.DataFrame, merged_intest: pd.DataFrame, operation: AggregationOperation,
+                   mode: str, control_group_name: str, test_group_names: List[str]
+                   ) -> Optional[Tuple[Union[MomentsMatrix, RatioMomentsMatrix], StatSignificanceMethod]]:
+    """
+    Moments of the compared per-user values of a metric whose test is Welch's T-test on intest or CUPED-adjusted
+    values, or covariance moments of a ratio metric, so that the tests of many metrics are calculated from one
+    moments matrix.
+    :param operation: The aggregation operation of the metric.
+    :param mode: Mode of enhancement ("no_enhancement", "cuped", "gboost_cuped").
+    :return: (1 x groups) MomentsMatrix or RatioMomentsMatrix with the control group first and the method of
+            the test, or None for gboost CUPED, which needs a fitted model
+    """
+    group_names = [control_group_name] + test_group_names
+    if operation == AggregationOperation.RATIO:
+        if mode == "no_enhancement":
+            moments = StatTests.ratio_moments_row(merged_intest[RATIO_NUMERATOR], merged_intest[RATIO_DENOMINATOR],
+                                                  merged_intest['abgroup'], group_names)
+            return moments, StatSignificanceMethod.DELTA_METHOD_T_TEST
+        merged_intest = StatTests.linearize_ratio(merged_intest, control_group_name, test_group_names)
+
+    value_column = merged_intest.columns[-1]
+    if operation == AggregationOperation.CONVERSION:
+        values, method = merged_intest[value_column], StatSignificanceMethod.T_TEST
+    elif mode == "cuped":
+        values = StatTests.cuped_adjusted_values(merged_pretest, merged_intest, control_group_name)
+        method = StatSignificanceMethod.PURE_CUPED_T_TEST
+    elif mode == "no_enhancement":
+        # the method is reported as by calculate_gboost_cuped_and_compare without a model
+        values, method = merged_intest[value_column], StatSignificanceMethod.GBOOST_CUPED_T_TEST
+    else:
+        return None
+    return StatTests.group_moments_row(values, merged_intest['abgroup'], group_names), method
+
+
+# Analyzer settings of a worker process. They are sent once per worker by the pool initializer,
+# so user properties are not pickled again with every metric.
+_worker_settings: dict = {}
+
+
+def _init_worker(settings: dict):
+    _worker_settings.clear()
+    _worker_settings.update(settings)
+
+
+def _run_stat_test_in_worker(task: Tuple[pd.DataFrame, pd.DataFrame, AggregationOperation]) -> StatSignificanceResult:
+    merged_pretest, merged_intest, operation = task
+    return _run_stat_test(merged_pretest, merged_intest, operation, **_worker_settings)
+
+
 class ABTestAnalyzer:
-    def __init__(self, event_data: pd.DataFrame, ab_test_allocations: pd.DataFrame, control_group_name: str,
-                 user_properties: Optional[pd.DataFrame] = None, mode="gboost_cuped", logging_level=logging.INFO):
+    def __init__(self, event_data: Optional[pd.DataFrame], ab_test_allocations: pd.DataFrame, control_group_name: str,
+                 user_properties: Optional[pd.DataFrame] = None, mode="gboost_cuped", logging_level=logging.INFO,
+                 model_cache: Optional[ModelCache] = None, bootstrap: Optional[BootstrapEngine] = None,
+                 regressor: Union[str, RegressorBackend, None] = None,
+                 cross_fitting: Optional[CrossFitting] = None,
+                 validation: Union[str, ValidationReport] = "full",
+                 validation_cache: Optional[ValidationCache] = None,
+                 normalize_dtypes: bool = False,
+                 period_split: str = "merge",
+                 pretest_lookback: Union[str, pd.Timedelta, None] = None,
+                 correction: Optional[str] = None):
         """
         Initializes the ABTestAnalyzer with event data, AB test allocations, control group name, user properties, and mode.
         :param event_data: DataFrame containing event data. Expected pandas format: |timestamp|userid|event_name|attribute_1|attribute_2|...
+                Can be None when event data is streamed in chunks with calculate_metrics_from_chunks.
         :param ab_test_allocations: DataFrame containing AB test allocations. Expected pandas format: |timestamp|userid|abgroup|
         :param control_group_name: The name of the control group.
         :param user_properties: DataFrame containing user properties. Expected pandas format: |userid|property_1|property_2|...
         :param mode: Mode of enhancement ("no_enhancement", "cuped", "gboost_cuped").
         :param logging_level: The logging level to be used (e.g., logging.INFO, logging.DEBUG).
+        :param model_cache: Optional ModelCache to reuse fitted gboost CUPED models across metrics and runs.
+                With n_jobs > 1 worker processes share fitted models only through its on-disk store (cache_dir).
+        :param bootstrap: Optional BootstrapEngine to calculate confidence intervals of the relative lift of every metric.
+        :param regressor: Regressor backend of gboost CUPED: a RegressorBackend instance or the name of a registered
+                backend ("catboost", "xgboost_hist", "sklearn_hist", "ridge_target_encoding"). The default is CatBoost.
+        :param cross_fitting: Optional CrossFitting for gboost CUPED. Users are then split into folds and predicted by
+                models trained on the other folds, instead of by one model trained on all users.
+        :param validation: Validation mode of the allocations ("full", "sampled" or "trusted") or a ValidationReport
+                of these allocations returned by validate_data, in which case they are not validated again.
+        :param validation_cache: Optional ValidationCache to skip the validation of allocations that were already
+                validated by another analyzer.
+        :param normalize_dtypes: Convert event data, event data chunks and allocations to compact dtypes on ingestion:
+                categorical event names and groups, timezone-naive datetime64[ns] timestamps and losslessly
+                downcast numeric attributes. The conversions and the memory saved are kept in normalization_report.
+        :param period_split: How events are split into pretest and intest. "merge" joins events with allocation
+                timestamps. "sorted" sorts the events of every event name by (user, timestamp) once, finds the
+                allocation boundary of every user with np.searchsorted and aggregates both periods in one
+                np.add.reduceat pass without intermediate frames.
+        :param pretest_lookback: Optional length of the pretest window before the allocation of every user,
+                e.g. "14D". All earlier events are pretest events when None.
+        :param correction: Optional multiple testing correction of p-values: "holm" (family-wise error rate) or "bh"
+                (Benjamini-Hochberg false discovery rate). Metrics calculated together form one family of
+                (metrics x test groups) comparisons. Adjusted p-values are kept in MetricResult.adjusted_p_values.
         """
-
         self.logger = setup_logging(logging_level)
 
-        assert mode in ["no_enhancement", "cuped", "gboost_cuped"], "Invalid mode"
+        self.normalize_dtypes = normalize_dtypes
+        self.normalization_report: Optional[NormalizationReport] = None
+        if normalize_dtypes:
+            ab_test_allocations, self.normalization_report = normalize_allocations(ab_test_allocations)
+            if event_data is not None:
+                event_data, event_report = normalize_event_data(event_data)
+                self.normalization_report += event_report
+            self.logger.info(f"Normalized dtypes saved {self.normalization_report.bytes_saved} bytes")
 
-        self.control_group_name = control_group_name
-        self.test_group_names = [group for group in ab_test_allocations['abgroup'].unique() if
-                                 group != control_group_name]
+        assert mode in MODES, "Invalid mode"
+        if period_split not in PERIOD_SPLITS:
+            raise ValueError(f"Unknown period split: {period_split}. Available splits: {PERIOD_SPLITS}")
+        self.period_split = period_split
+        self.pretest_lookback = pd.Timedelta(pretest_lookback) if pretest_lookback is not None else None
+        if correction is not None and correction not in CORRECTIONS:
+            raise ValueError(f"Unknown multiple testing correction: {correction}. Available corrections: {CORRECTIONS}")
+        self.correction = correction
 
-        validate_data(event_data, ab_test_allocations, control_group_name)
+        if isinstance(validation, ValidationReport):
+            # user IDs and group codes of the report are used as they are, so they must come from these allocations
+            if not validation.matches(ab_test_allocations, control_group_name):
+                raise ValueError("The validation report does not match the AB test allocations")
+            if event_data is not None:
+                validate_event_data(event_data)
+            self.validation_report = validation
+        else:
+            self.validation_report = validate_data(event_data, ab_test_allocations, control_group_name,
+                                                   mode=validation, cache=validation_cache)
+
+        self.control_group_name = control_group_name
+        self.test_group_names = list(self.validation_report.test_group_names)
 
-        self.ab_test_allocations = ab_test_allocations.set_index("userid")
+        # the user ID index of the report already has its hash table built by validation
+        self.ab_test_allocations = ab_test_allocations.drop(columns="userid").set_axis(self.validation_report.userids)
+        self.allocation_table = AllocationTable(self.ab_test_allocations, self.validation_report.group_names,
+                                                self.validation_report.group_codes)
         self.event_data = event_data
         self.user_properties = user_properties
         self.calculated_metrics: List[Metric] = []
         self.mode = mode
+        self.model_cache = model_cache
+        self.bootstrap = bootstrap
+        self.regressor = get_regressor_backend(regressor)
+        self.cross_fitting = cross_fitting
+        self._event_index: Optional[EventIndex] = None
+
+    @classmethod
+    def from_parquet(cls, source, ab_test_allocations: pd.DataFrame, control_group_name: str,
+                     specs: List[MetricSpec], **kwargs) -> "ABTestAnalyzer":
+        """
+        Initializes the ABTestAnalyzer with event data read from Parquet or Arrow. Only the events and attributes
+        required by the given metrics are read: the event name filter and the column projection are pushed
+        down to the reader.
+        :param source: Path to a Parquet file or a directory with a Parquet dataset, a pyarrow Table or a pyarrow Dataset.
+        :param ab_test_allocations: DataFrame containing AB test allocations. Expected pandas format: |timestamp|userid|abgroup|
+        :param control_group_name: The name of the control group.
+        :param specs: List of MetricSpec instances that will be calculated with the analyzer.
+        :param kwargs: Other arguments of ABTestAnalyzer (user_properties, mode, ...).
+        :return: ABTestAnalyzer instance
+        """
+        event_names, attribute_names = cls._batch_columns(specs)
+        event_data = load_event_data(source, event_names=event_names, attributes=attribute_names)
+        return cls(event_data, ab_test_allocations, control_group_name, **kwargs)
+
+    @property
+    def event_index(self) -> EventIndex:
+        """
+        Index of event data by event name with attached allocation timestamps. It is built on first use and
+        reused by all subsequent metric calculations.
+        """
+        if self.event_data is None:
+            raise ValueError("Event data is not set. Use calculate_metrics_from_chunks to stream event data.")
+        if self._event_index is None:
+            self._event_index = EventIndex(self.event_data, self.ab_test_allocations)
+        return self._event_index
 
     @staticmethod
     def _merge_and_aggregate(event_data: pd.DataFrame, ab_test_allocations: pd.DataFrame, event_name: str,
                              operation: AggregationOperation,
                              attribute_name=None,
-                             pretest=False) -> Tuple[pd.DataFrame, pd.DataFrame]:
+                             pretest=False,
+                             event_index: Optional[EventIndex] = None,
+                             pretest_lookback: Optional[pd.Timedelta] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
         """
         Merges event data with AB test allocations and aggregates data based on specified attributes and operation.
         Adds support for conversion operation.
@@ -60,17 +262,28 @@ class ABTestAnalyzer:
         :param attribute_name: The name of the attribute to aggregate sum
         :param operation: The aggregation operation ('sum', 'count', or 'conversion').
         :param pretest: Boolean indicating whether to process pretest (True) or intest (False) data.
+        :param event_index: Optional EventIndex built from event_data. When given, the events are looked up in the
+                index instead of being filtered and merged with allocations.
+        :param pretest_lookback: Optional length of the pretest window before the allocation of every user.
         :return: raw merged data, metrics data
         """
-        filtered_event_data = event_data[event_data["event_name"] == event_name]
+        if event_index is not None:
+            event_data_with_alloc = event_index.get(
+                event_name, ["timestamp", "userid", "event_name"] + ([attribute_name] if attribute_name else []))
+        else:
+            filtered_event_data = event_data[event_data["event_name"] == event_name]
 
-        event_data_with_alloc = pd.merge(filtered_event_data, ab_test_allocations[['timestamp']], left_on='userid',
-                                         right_index=True, how='left', suffixes=('_event', '_alloc'))
+            event_data_with_alloc = pd.merge(filtered_event_data, ab_test_allocations[['timestamp']],
+                                             left_on='userid', right_index=True, how='left',
+                                             suffixes=('_event', '_alloc'))
 
         # Filter for pretest or intest events
         if pretest:
-            filtered_events = event_data_with_alloc[
-                event_data_with_alloc['timestamp_event'] < event_data_with_alloc['timestamp_alloc']]
+            pretest_mask = event_data_with_alloc['timestamp_event'] < event_data_with_alloc['timestamp_alloc']
+            if pretest_lookback is not None:
+                pretest_mask &= (event_data_with_alloc['timestamp_event'] >=
+                                 event_data_with_alloc['timestamp_alloc'] - pretest_lookback)
+            filtered_events = event_data_with_alloc[pretest_mask]
         else:
             filtered_events = event_data_with_alloc[
                 event_data_with_alloc['timestamp_event'] >= event_data_with_alloc['timestamp_alloc']]
@@ -83,44 +296,405 @@ class ABTestAnalyzer:
         elif operation == AggregationOperation.COUNT:
             aggregated_data = filtered_events.groupby("userid").agg({"event_name": "count"})
         elif operation == AggregationOperation.SUM:
-            aggregated_data = filtered_events.groupby("userid").agg({attribute_name: "sum"})
+            aggregated_data = widen_attributes(filtered_events, [attribute_name]).groupby("userid").agg(
+                {attribute_name: "sum"})
         else:
             raise ValueError(f"Unsupported aggregation operation: {operation}")
 
         # Merge aggregated data with AB test allocations and fill missing values with 0
         merged_data = pd.merge(ab_test_allocations[['abgroup']], aggregated_data, left_index=True, right_index=True,
-                               how="left").fillna(0)
-        result = merged_data.groupby("abgroup").mean()
+                               how="left").fillna(dict.fromkeys(aggregated_data.columns, 0))
+        result = merged_data.groupby("abgroup", observed=True).mean()
 
         return merged_data, result
 
+    @staticmethod
+    def _batch_columns(specs: List[MetricSpec]) -> Tuple[List[str], List[str]]:
+        """
+        :return: unique event names and attribute names required by the given metrics
+        """
+        event_names = list(dict.fromkeys(event_name for spec in specs for event_name, _ in spec.components))
+        attribute_names = list(dict.fromkeys(attribute_name for spec in specs
+                                             for attribute_name in spec.attribute_names))
+        return event_names, attribute_names
+
+    @staticmethod
+    def _aggregate_events_batch(event_data: pd.DataFrame, ab_test_allocations: pd.DataFrame,
+                                event_names: List[str], attribute_names: List[str],
+                                event_index: Optional[EventIndex] = None,
+                                allocation_table: Optional[AllocationTable] = None,
+                                period_split: str = "merge",
+                                pretest_lookback: Optional[pd.Timedelta] = None) -> pd.DataFrame:
+        """
+        Joins the given events with AB test allocations, splits them into pretest and intest and computes event
+        counts and attribute sums of every (period, event, user) in a single grouped pass.
+        The result is additive: aggregates of several chunks of event data can be summed up.
+
+        :param event_data: DataFrame containing event data. Expected pandas format: |timestamp|userid|event_name|attribute_1|attribute_2|...
+        :param ab_test_allocations: DataFrame containing AB test allocations. Expected pandas format: |timestamp|userid (index)|abgroup|
+        :param event_names: The names of the events to aggregate.
+        :param attribute_names: The names of the attributes to sum.
+        :param event_index: Optional EventIndex built from event_data. When given, the events are looked up in the
+                index instead of being filtered and merged with allocations.
+        :param allocation_table: Optional AllocationTable built from ab_test_allocations. When given, user IDs are
+                encoded to dense codes and the events are split by the allocation time of their codes instead of
+                being merged with allocations.
+        :param period_split: "sorted" aggregates the events of every event name with a UserTimeline instead of
+                a grouped pass. It requires allocation_table and ignores event_index.
+        :param pretest_lookback: Optional length of the pretest window before the allocation of every user.
+        :return: DataFrame with format | pretest (index) | event_name (index) | userid (index) | __count | attribute_1 | ...
+        """
+        if period_split == "sorted" and allocation_table is not None:
+            return ABTestAnalyzer._aggregate_events_sorted(event_data, event_names, attribute_names, allocation_table,
+                                                           pretest_lookback)
+        if event_index is not None:
+            event_data_with_alloc = event_index.select(event_names, ["timestamp", "userid", "event_name"] +
+                                                       attribute_names)
+        elif allocation_table is not None:
+            filtered_event_data = event_data.loc[event_data["event_name"].isin(event_names),
+                                                 ["timestamp", "userid", "event_name"] + attribute_names]
+            codes = allocation_table.encode(filtered_event_data["userid"])
+            pretest_mask, intest_mask = allocation_table.split_periods(codes, filtered_event_data["timestamp"],
+                                                                       pretest_lookback)
+            keep = pretest_mask | intest_mask
+            events = widen_attributes(filtered_event_data[keep], attribute_names).assign(pretest=pretest_mask[keep],
+                                                                                        userid=codes[keep])
+
+            grouped = events.groupby(["pretest", "event_name", "userid"], observed=True)
+            aggregated = grouped.size().to_frame(name="__count")
+            if attribute_names:
+                aggregated = aggregated.join(grouped[attribute_names].sum())
+            # user codes are mapped back to user IDs only once per unique user
+            user_codes = aggregated.index.levels[2]
+            return aggregated.set_axis(aggregated.index.set_levels(allocation_table.userids[user_codes],
+                                                                   level="userid"))
+        else:
+            filtered_event_data = event_data.loc[event_data["event_name"].isin(event_names),
+                                                 ["timestamp", "userid", "event_name"] + attribute_names]
+
+            event_data_with_alloc = pd.merge(filtered_event_data, ab_test_allocations[['timestamp']],
+                                             left_on='userid', right_index=True, how='inner',
+                                             suffixes=('_event', '_alloc'))
+
+        # Events of users without a valid allocation timestamp are neither pretest nor intest
+        pretest_mask = event_data_with_alloc['timestamp_event'] < event_data_with_alloc['timestamp_alloc']
+        intest_mask = event_data_with_alloc['timestamp_event'] >= event_data_with_alloc['timestamp_alloc']
+        if pretest_lookback is not None:
+            pretest_mask &= (event_data_with_alloc['timestamp_event'] >=
+                             event_data_with_alloc['timestamp_alloc'] - pretest_lookback)
+        event_data_with_alloc = widen_attributes(event_data_with_alloc.assign(pretest=pretest_mask)[
+            pretest_mask | intest_mask], attribute_names)
+
+        # Single grouped pass for counts and attribute sums of every (period, event, user)
+        grouped = event_data_with_alloc.groupby(["pretest", "event_name", "userid"], observed=True)
+        aggregated = grouped.size().to_frame(name="__count")
+        if attribute_names:
+            aggregated = aggregated.join(grouped[attribute_names].sum())
+        return aggregated
+
+    @staticmethod
+    def _aggregate_events_sorted(event_data: pd.DataFrame, event_names: List[str], attribute_names: List[str],
+                                 allocation_table: AllocationTable,
+                                 pretest_lookback: Optional[pd.Timedelta] = None) -> pd.DataFrame:
+        """
+        Computes the output of _aggregate_events_batch with a UserTimeline of all event names. Events are reduced to
+        arrays of user codes, epoch timestamps and attribute values, and per-user aggregates of both periods are
+        calculated with np.searchsorted and np.add.reduceat instead of merged and grouped frames.
+
+        :param event_data: DataFrame containing event data. Expected pandas format: |timestamp|userid|event_name|attribute_1|attribute_2|...
+        :param event_names: The names of the events to aggregate.
+        :param attribute_names: The names of the attributes to sum.
+        :param allocation_table: AllocationTable of the allocated users.
+        :param pretest_lookback: Optional length of the pretest window before the allocation of every user.
+        :return: DataFrame with format | pretest (index) | event_name (index) | userid (index) | __count | attribute_1 | ...
+        """
+        # event names are folded into the user codes, so that the events of all event names are sorted at once
+        event_codes = pd.Categorical(event_data["event_name"], categories=event_names).codes
+        selected = event_codes >= 0
+        user_codes = allocation_table.encode(event_data["userid"].to_numpy()[selected])
+        num_users = allocation_table.num_users
+        codes = np.where(user_codes >= 0, event_codes[selected].astype(np.int64) * num_users + user_codes, -1)
+        times = to_epoch(event_data["timestamp"])[selected]
+        values = event_data.loc[selected, attribute_names].to_numpy(dtype=np.float64)
+        lookback = pretest_lookback.value if pretest_lookback is not None else None
+
+        timeline = UserTimeline(codes, times, len(event_names) * num_users, values)
+        pretest_counts, pretest_sums, intest_counts, intest_sums = timeline.period_aggregates(
+            np.tile(allocation_table.timestamps, len(event_names)), lookback)
+
+        blocks = []
+        for pretest, counts, sums in ((False, intest_counts, intest_sums), (True, pretest_counts, pretest_sums)):
+            pairs = np.flatnonzero(counts)
+            index = pd.MultiIndex.from_arrays([np.full(len(pairs), pretest),
+                                               np.asarray(event_names, dtype=object)[pairs // num_users],
+                                               allocation_table.userids[pairs % num_users]],
+                                              names=["pretest", "event_name", "userid"])
+            columns = {"__count": counts[pairs]}
+            columns.update({name: sums[pairs, position] for position, name in enumerate(attribute_names)})
+            blocks.append(pd.DataFrame(columns, index=index))
+        return pd.concat(blocks)
+
+    @staticmethod
+    def _aggregate_unallocated_events(event_data: pd.DataFrame, event_names: List[str], attribute_names: List[str],
+                                      allocation_table: AllocationTable) -> Tuple[pd.DataFrame, pd.Series]:
+        """
+        Computes event counts and attribute sums of every (event, user) of the users that are not allocated, and the
+        time of the last event of every such user, so that their events can be split into periods once they are.
+
+        :param event_data: DataFrame containing event data. Expected pandas format: |timestamp|userid|event_name|attribute_1|attribute_2|...
+        :param event_names: The names of the events to aggregate.
+        :param attribute_names: The names of the attributes to sum.
+        :param allocation_table: AllocationTable of the allocated users.
+        :return: DataFrame with format | event_name (index) | userid (index) | __count | attribute_1 | ...,
+                int64 epoch nanoseconds of the last event of every user
+        """
+        events = event_data.loc[event_data["event_name"].isin(event_names),
+                                ["timestamp", "userid", "event_name"] + attribute_names]
+        event_times = to_epoch(events["timestamp"])
+        unallocated = (allocation_table.encode(events["userid"]) < 0) & (event_times != NAT)
+        events = widen_attributes(events[unallocated], attribute_names).assign(timestamp=event_times[unallocated])
+
+        grouped = events.groupby(["event_name", "userid"], observed=True)
+        aggregated = grouped.size().to_frame(name="__count")
+        if attribute_names:
+            aggregated = aggregated.join(grouped[attribute_names].sum())
+        return aggregated, events.groupby("userid")["timestamp"].max()
+
+    @staticmethod
+    def _merge_batch_aggregates(aggregated: pd.DataFrame, ab_test_allocations: pd.DataFrame,
+                                specs: List[MetricSpec], allocation_table: Optional[AllocationTable] = None
+                                ) -> Dict[tuple, Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]]:
+        """
+        Builds per-user metric values of every metric from the output of _aggregate_events_batch.
+
+        :param aggregated: DataFrame with format | pretest (index) | event_name (index) | userid (index) | __count | attribute_1 | ...
+        :param ab_test_allocations: DataFrame containing AB test allocations. Expected pandas format: |timestamp|userid (index)|abgroup|
+        :param specs: List of MetricSpec instances to build.
+        :param allocation_table: Optional AllocationTable built from ab_test_allocations. When given, per-user values
+                are scattered into dense arrays by user code and group means are calculated with np.bincount
+                instead of merging with allocations.
+        :return: dictionary keyed by MetricSpec.key with (merged pretest data, merged intest data, intest metrics data)
+        """
+        def component_values(pretest: bool, event_name: str, attribute_name: Optional[str]) -> pd.Series:
+            try:
+                user_aggregates = aggregated.xs((pretest, event_name), level=["pretest", "event_name"])
+            except KeyError:
+                user_aggregates = aggregated.iloc[0:0].droplevel(["pretest", "event_name"])
+            return user_aggregates[attribute_name if attribute_name is not None else "__count"]
+
+        def per_user_values(spec: MetricSpec, pretest: bool) -> pd.DataFrame:
+            values = [component_values(pretest, *component) for component in spec.components]
+            if spec.operation == AggregationOperation.RATIO:
+                columns = {RATIO_NUMERATOR: values[0], RATIO_DENOMINATOR: values[1]}
+            elif spec.operation == AggregationOperation.CONVERSION:
+                columns = {spec.value_column: values[0].gt(0).astype(int)}
+            else:
+                columns = {spec.value_column: values[0]}
+
+            if allocation_table is not None:
+                return allocation_table.columns_frame({name: allocation_table.scatter(column.index, column)
+                                                       for name, column in columns.items()})
+
+            # Merge aggregated data with AB test allocations and fill missing values with 0
+            return pd.merge(ab_test_allocations[['abgroup']], pd.DataFrame(columns), left_index=True,
+                            right_index=True, how="left").fillna(dict.fromkeys(columns, 0))
+
+        results = {}
+        for spec in specs:
+            merged_pretest = per_user_values(spec, pretest=True)
+            merged_intest = per_user_values(spec, pretest=False)
+            if spec.operation == AggregationOperation.RATIO:
+                result_intest = ABTestAnalyzer._group_ratios(merged_intest, spec.value_column, allocation_table)
+            elif allocation_table is not None:
+                result_intest = allocation_table.group_means(spec.value_column, merged_intest[spec.value_column])
+            else:
+                result_intest = merged_intest.groupby("abgroup", observed=True).mean()
+            results[spec.key] = merged_pretest, merged_intest, result_intest
+        return results
+
+    @staticmethod
+    def _group_ratios(merged_intest: pd.DataFrame, value_column: str,
+                      allocation_table: Optional[AllocationTable] = None) -> pd.DataFrame:
+        """
+        Ratio sum(numerator) / sum(denominator) of every group, i.e. the ratio of the group means.
+        :param merged_intest: DataFrame containing the intest data. Expected pandas format: | userid (index) | abgroup | numerator | denominator |
+        :param value_column: The name of the column with ratios.
+        :param allocation_table: Optional AllocationTable. When given, the per-user values are aligned with it and
+                group means are calculated with np.bincount.
+        :return: DataFrame with format | abgroup (index) | value_column |
+        """
+        if allocation_table is not None:
+            means = pd.concat([allocation_table.group_means(column, merged_intest[column])
+                               for column in (RATIO_NUMERATOR, RATIO_DENOMINATOR)], axis=1)
+        else:
+            means = merged_intest.groupby("abgroup", observed=True)[[RATIO_NUMERATOR, RATIO_DENOMINATOR]].mean()
+        return (means[RATIO_NUMERATOR] / means[RATIO_DENOMINATOR]).to_frame(name=value_column)
+
+    @staticmethod
+    def _merge_and_aggregate_batch(event_data: pd.DataFrame, ab_test_allocations: pd.DataFrame,
+                                   specs: List[MetricSpec],
+                                   event_index: Optional[EventIndex] = None,
+                                   allocation_table: Optional[AllocationTable] = None,
+                                   period_split: str = "merge",
+                                   pretest_lookback: Optional[pd.Timedelta] = None
+                                   ) -> Dict[tuple, Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]]:
+        """
+        Batched version of _merge_and_aggregate. Joins the events of all requested metrics with AB test allocations
+        once, splits them into pretest and intest once and computes every count, sum and conversion per user
+        in a single grouped pass.
+
+        :param event_data: DataFrame containing event data. Expected pandas format: |timestamp|userid|event_name|attribute_1|attribute_2|...
+        :param ab_test_allocations: DataFrame containing AB test allocations. Expected pandas format: |timestamp|userid (index)|abgroup|
+        :param specs: List of MetricSpec instances to aggregate.
+        :param event_index: Optional EventIndex built from event_data. When given, the events are looked up in the
+                index instead of being filtered and merged with allocations.
+        :param allocation_table: Optional AllocationTable built from ab_test_allocations, see _aggregate_events_batch.
+        :param period_split: "merge" or "sorted", see _aggregate_events_batch.
+        :param pretest_lookback: Optional length of the pretest window before the allocation of every user.
+        :return: dictionary keyed by MetricSpec.key with (merged pretest data, merged intest data, intest metrics data)
+        """
+        event_names, attribute_names = ABTestAnalyzer._batch_columns(specs)
+        aggregated = ABTestAnalyzer._aggregate_events_batch(event_data, ab_test_allocations, event_names,
+                                                            attribute_names, event_index=event_index,
+                                                            allocation_table=allocation_table,
+                                                            period_split=period_split,
+                                                            pretest_lookback=pretest_lookback)
+        return ABTestAnalyzer._merge_batch_aggregates(aggregated, ab_test_allocations, specs,
+                                                      allocation_table=allocation_table)
+
+    def _validate_attribute(self, attribute_name: str, event_data: Optional[pd.DataFrame] = None):
+        event_data = self.event_data if event_data is None else event_data
+        if event_data is None:
+            raise ValueError("Event data is not set. Use calculate_metrics_from_chunks to stream event data.")
+        if attribute_name not in event_data.columns:
+            raise ValueError(f"Attribute {attribute_name} not found in event data.")
+        if not pd.api.types.is_numeric_dtype(event_data[attribute_name]):
+            raise ValueError(f"Attribute {attribute_name} is not numeric.")
+
+    def _ingest_chunk(self, chunk: pd.DataFrame, event_names: List[str], attribute_names: List[str]) -> pd.DataFrame:
+        """
+        Validates a chunk of event data and normalizes its dtypes if the analyzer normalizes dtypes. Event names
+        of all chunks get the same categories, so that aggregates of different chunks can be added up.
+        """
+        validate_event_data(chunk)
+        for attribute_name in attribute_names:
+            self._validate_attribute(attribute_name, chunk)
+        if self.normalize_dtypes:
+            chunk, _ = normalize_event_data(chunk, event_names)
+        return chunk
+
+    def _period_settings(self) -> dict:
+        return {
+            "period_split": self.period_split,
+            "pretest_lookback": self.pretest_lookback,
+        }
+
+    @property
+    def _batch_event_index(self) -> Optional[EventIndex]:
+        # the sorted split does not use the event index, so it is not built
+        return self.event_index if self.period_split == "merge" else None
+
+    def _stat_test_settings(self, mode: Optional[str] = None) -> dict:
+        return {
+            "mode": mode or self.mode,
+            "control_group_name": self.control_group_name,
+            "test_group_names": self.test_group_names,
+            "user_properties": self.user_properties,
+            "model_cache": self.model_cache,
+            "regressor": self.regressor,
+            "cross_fitting": self.cross_fitting,
+        }
+
+    def _calculate_stat_significance(self, merged_pretest: pd.DataFrame, merged_intest: pd.DataFrame,
+                                     operation: Optional[AggregationOperation] = None) -> StatSignificanceResult:
+        """
+        Runs the statistical test matching the analyzer mode on merged pretest and intest data.
+        :param merged_pretest: DataFrame containing the pretest data. Expected pandas format: | userid (index) | abgroup | value_column |
+        :param merged_intest: DataFrame containing the intest data. Expected pandas format: | userid (index) | abgroup | value_column |
+        :param operation: The aggregation operation of the metric.
+        :return: StatSignificanceResult instance with p-values and the method used.
+        """
+        return _run_stat_test(merged_pretest, merged_intest, operation, **self._stat_test_settings())
+
+    def _make_metric(self, metrictype: MetricType, metricparams: MetricParams, merged_intest: pd.DataFrame,
+                     result_intest: pd.DataFrame, stat_test: StatSignificanceResult) -> Metric:
+        """
+        Builds a Metric from the intest data and the result of the statistical test. Bootstrap confidence
+        intervals of the relative lift are calculated when the analyzer has a BootstrapEngine.
+        :param merged_intest: DataFrame containing the intest data. Expected pandas format: | userid (index) | abgroup | value_column |
+        :param result_intest: DataFrame with the metric value per group.
+        :param stat_test: StatSignificanceResult instance with p-values and the method used.
+        """
+        if self.correction is not None and stat_test.correction is None:
+            # a metric calculated on its own is the family of comparisons of its test groups
+            StatTests.apply_correction([stat_test], self.correction)
+        confidence_intervals = None
+        # bootstrap intervals are calculated from per-user values, which ratio metrics do not have
+        if self.bootstrap is not None and metrictype != MetricType.RATIO:
+            confidence_intervals = self.bootstrap.calculate_confidence_intervals(merged_intest, self.control_group_name,
+                                                                                 self.test_group_names)
+        return Metric(metrictype, metricparams,
+                      MetricResult(result_intest, self.control_group_name, self.test_group_names, stat_test,
+                                   confidence_intervals))
+
+    def _aggregate_metric(self, spec: MetricSpec) -> Tuple[Optional[pd.DataFrame], pd.DataFrame, pd.DataFrame]:
+        """
+        Per-user pretest and intest values of a single metric, split into periods as configured by period_split.
+        :param spec: MetricSpec of the metric.
+        :return: merged pretest data (None for conversions with the merge split), merged intest data, intest metrics data
+        """
+        if self.period_split == "sorted":
+            return self._merge_and_aggregate_batch(self.event_data, self.ab_test_allocations, [spec],
+                                                   allocation_table=self.allocation_table,
+                                                   **self._period_settings())[spec.key]
+
+        if spec.operation == AggregationOperation.RATIO:
+            return self._aggregate_ratio(spec)
+
+        event_name, attribute_name = spec.metricparams.event_name, spec.metricparams.attribute_name
+        merged_pretest = None
+        if spec.operation != AggregationOperation.CONVERSION:
+            merged_pretest, _ = self._merge_and_aggregate(self.event_data, self.ab_test_allocations, event_name,
+                                                          spec.operation, attribute_name, pretest=True,
+                                                          event_index=self.event_index,
+                                                          pretest_lookback=self.pretest_lookback)
+        merged_intest, result_intest = self._merge_and_aggregate(self.event_data, self.ab_test_allocations, event_name,
+                                                                 spec.operation, attribute_name,
+                                                                 event_index=self.event_index)
+        return merged_pretest, merged_intest, result_intest
+
+    def _aggregate_ratio(self, spec: MetricSpec) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        """
+        Per-user numerators and denominators of a ratio metric in both periods, aggregated by _merge_and_aggregate.
+        :param spec: MetricSpec of a RATIO metric.
+        :return: merged pretest data, merged intest data, intest metrics data
+        """
+        merged = []
+        for pretest in (True, False):
+            values = [self._merge_and_aggregate(self.event_data, self.ab_test_allocations, event_name,
+                                                AggregationOperation.SUM if attribute_name is not None
+                                                else AggregationOperation.COUNT,
+                                                attribute_name, pretest=pretest, event_index=self.event_index,
+                                                pretest_lookback=self.pretest_lookback)[0]
+                      for event_name, attribute_name in spec.components]
+            merged.append(pd.DataFrame({'abgroup': values[0]['abgroup'], RATIO_NUMERATOR: values[0].iloc[:, -1],
+                                        RATIO_DENOMINATOR: values[1].iloc[:, -1]}))
+        merged_pretest, merged_intest = merged
+        return merged_pretest, merged_intest, self._group_ratios(merged_intest, spec.value_column)
+
     def calculate_event_count_per_user(self, event_name: str) -> pd.DataFrame:
         """
         Calculates the count of events per user for the specified event name.
         :param event_name: The name of the event to calculate the count for.
         :return: DataFrame with the calculated event count per user per group
         """
-        merged_pretest, _ = self._merge_and_aggregate(self.event_data, self.ab_test_allocations, event_name,
-                                                      AggregationOperation.COUNT, pretest=True)
+        merged_pretest, merged_intest, result_intest = self._aggregate_metric(
+            MetricSpec(MetricType.EVENT_COUNT_PER_USER, MetricParams(event_name)))
 
-        merged_intest, result_intest = self._merge_and_aggregate(self.event_data, self.ab_test_allocations, event_name,
-                                                                 AggregationOperation.COUNT)
-
-        if self.mode == "gboost_cuped":
-            stat_test = StatTests.calculate_gboost_cuped_and_compare(merged_pretest, merged_intest, self.user_properties,
-                                                                self.control_group_name, self.test_group_names, True)
-        elif self.mode == "cuped":
-            stat_test = StatTests.calculate_cuped_and_compare(merged_pretest, merged_intest,
-                                                                self.control_group_name, self.test_group_names)
-        else:
-            stat_test = StatTests.calculate_gboost_cuped_and_compare(merged_pretest, merged_intest,
-                                                                    self.user_properties,
-                                                                    self.control_group_name, self.test_group_names,
-                                                                    False)
-
-        metric_output = Metric(MetricType.EVENT_COUNT_PER_USER, MetricParams(event_name),
-                                              MetricResult(result_intest, self.control_group_name,
-                                                           self.test_group_names, stat_test))
+        stat_test = self._calculate_stat_significance(merged_pretest, merged_intest)
+
+        metric_output = self._make_metric(MetricType.EVENT_COUNT_PER_USER, MetricParams(event_name),
+                                          merged_intest, result_intest, stat_test)
         self.calculated_metrics.append(metric_output)
         return metric_output
 
@@ -132,31 +706,16 @@ class ABTestAnalyzer:
         :return: DataFrame with the calculated attribute sum per user per group
         """
 
-        if attribute_name not in self.event_data.columns:
-            raise ValueError(f"Attribute {attribute_name} not found in event data.")
-        if not pd.api.types.is_numeric_dtype(self.event_data[attribute_name]):
-            raise ValueError(f"Attribute {attribute_name} is not numeric.")
+        self._validate_attribute(attribute_name)
 
-        merged_pretest, _ = self._merge_and_aggregate(self.event_data, self.ab_test_allocations, event_name,
-                                                    AggregationOperation.SUM, attribute_name, pretest=True)
+        merged_pretest, merged_intest, result_intest = self._aggregate_metric(
+            MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams(event_name, attribute_name)))
 
-        merged_intest, result_intest = self._merge_and_aggregate(self.event_data, self.ab_test_allocations, event_name,
-                                                                AggregationOperation.SUM, attribute_name)
-
-        if self.mode == "gboost_cuped":
-            stat_test = StatTests.calculate_gboost_cuped_and_compare(merged_pretest, merged_intest, self.user_properties,
-                                                                self.control_group_name, self.test_group_names, True)
-        elif self.mode == "cuped":
-            stat_test = StatTests.calculate_cuped_and_compare(merged_pretest, merged_intest,
-                                                                self.control_group_name, self.test_group_names)
-        else:
-            stat_test = StatTests.calculate_gboost_cuped_and_compare(merged_pretest, merged_intest,
-                                                                    self.user_properties,
-                                                                    self.control_group_name, self.test_group_names,
-                                                                    False)
+        stat_test = self._calculate_stat_significance(merged_pretest, merged_intest)
 
-        metric_output = Metric(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams(event_name, attribute_name),
-                MetricResult(result_intest, self.control_group_name, self.test_group_names, stat_test))
+        metric_output = self._make_metric(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER,
+                                          MetricParams(event_name, attribute_name), merged_intest, result_intest,
+                                          stat_test)
         self.calculated_metrics.append(metric_output)
         return metric_output
 
@@ -166,20 +725,460 @@ class ABTestAnalyzer:
         :param target_event: The name of the event to calculate the conversion rate for.
         :return: DataFrame with the calculated conversion rate per user per group
         """
-        merged_intest, result_intest = self._merge_and_aggregate(self.event_data, self.ab_test_allocations,
-                                                                 target_event,
-                                                                 AggregationOperation.CONVERSION)
+        _, merged_intest, result_intest = self._aggregate_metric(
+            MetricSpec(MetricType.CONVERSION_RATE, MetricParams(target_event)))
         stat_test = StatTests.calculate_t_test_for_dataset(merged_intest, self.control_group_name,
                                                            self.test_group_names)
 
-        metric_output = Metric(
-            MetricType.CONVERSION_RATE,
-            MetricParams(target_event),
-            MetricResult(result_intest, self.control_group_name, self.test_group_names, stat_test))
+        metric_output = self._make_metric(MetricType.CONVERSION_RATE, MetricParams(target_event), merged_intest,
+                                          result_intest, stat_test)
         self.calculated_metrics.append(metric_output)
         return metric_output
 
+    def calculate_ratio(self, event_name: str, attribute_name: Optional[str] = None,
+                        denominator_event_name: Optional[str] = None,
+                        denominator_attribute_name: Optional[str] = None) -> Metric:
+        """
+        Calculates a ratio metric sum(numerator) / sum(denominator) over the users of every group, e.g. revenue per
+        purchase or clicks per session. Its variance is calculated with the delta method from covariance moments
+        of per-user numerators and denominators. In CUPED modes per-user linearized values of the ratio are
+        variance-reduced with pretest numerators and denominators.
+        :param event_name: The event name of the numerator.
+        :param attribute_name: The attribute summed in the numerator. Numerator events are counted when None.
+        :param denominator_event_name: The event name of the denominator. By default it is event_name.
+        :param denominator_attribute_name: The attribute summed in the denominator. Denominator events are counted
+                when None.
+        :return: Metric with the ratio per group
+        """
+        metricparams = MetricParams(event_name, attribute_name, denominator_event_name=denominator_event_name,
+                                    denominator_attribute_name=denominator_attribute_name)
+        spec = MetricSpec(MetricType.RATIO, metricparams)
+        for attribute in spec.attribute_names:
+            self._validate_attribute(attribute)
+
+        merged_pretest, merged_intest, result_intest = self._aggregate_metric(spec)
+        stat_test = self._calculate_stat_significance(merged_pretest, merged_intest, AggregationOperation.RATIO)
+
+        metric_output = self._make_metric(MetricType.RATIO, metricparams, merged_intest, result_intest, stat_test)
+        self.calculated_metrics.append(metric_output)
+        return metric_output
+
+    def calculate_metrics(self, specs: List[MetricSpec], n_jobs: int = 1,
+                          segments: Optional[List[str]] = None) -> List[Metric]:
+        """
+        Calculates several metrics at once. Events are joined with AB test allocations and split into pretest and
+        intest only once, and all per-user aggregates are computed in one grouped pass.
+        Statistical tests of the metrics are independent and can be run in a pool of worker processes. Workers
+        receive only per-user aggregates of their metric; event data and allocations stay in the main process.
+        :param specs: List of MetricSpec instances describing the metrics to calculate.
+        :param n_jobs: Number of worker processes for statistical tests. 1 runs them in the current process,
+                -1 uses all available cores.
+        :param segments: Optional list of user property columns. Every metric is additionally broken down by
+                every value of these properties and the slices are kept in MetricResult.segments.
+        :return: List of calculated metrics in the order of the given specs
+        """
+        for spec in specs:
+            for attribute_name in spec.attribute_names:
+                self._validate_attribute(attribute_name)
+
+        aggregates = self._merge_and_aggregate_batch(self.event_data, self.ab_test_allocations, specs,
+                                                     event_index=self._batch_event_index,
+                                                     allocation_table=self.allocation_table,
+                                                     **self._period_settings())
+        return self._calculate_metrics_from_aggregates(specs, aggregates, n_jobs, segments=segments)
+
+    def calculate_metrics_for_modes(self, specs: List[MetricSpec], modes: List[str],
+                                    n_jobs: int = 1) -> Dict[str, List[Metric]]:
+        """
+        Calculates several metrics with several modes of enhancement at once. Per-user pretest and intest
+        aggregates are computed once and only the statistical test is repeated for every mode.
+        The metrics are not added to calculated_metrics, as they describe the same metrics several times.
+        :param specs: List of MetricSpec instances describing the metrics to calculate.
+        :param modes: Modes of enhancement to compare. For example, ["no_enhancement", "cuped", "gboost_cuped"].
+        :param n_jobs: Number of worker processes for statistical tests.
+        :return: dictionary with the list of calculated metrics for every mode, in the order of the given specs
+        """
+        for mode in modes:
+            assert mode in MODES, "Invalid mode"
+        for spec in specs:
+            for attribute_name in spec.attribute_names:
+                self._validate_attribute(attribute_name)
+
+        aggregates = self._merge_and_aggregate_batch(self.event_data, self.ab_test_allocations, specs,
+                                                     event_index=self._batch_event_index,
+                                                     allocation_table=self.allocation_table,
+                                                     **self._period_settings())
+        return {mode: self._calculate_metrics_from_aggregates(specs, aggregates, n_jobs, mode=mode, track=False)
+                for mode in modes}
+
+    def calculate_metrics_from_chunks(self, event_chunks: Union[str, Iterable[pd.DataFrame]],
+                                      specs: List[MetricSpec], n_jobs: int = 1,
+                                      chunksize: int = DEFAULT_CHUNKSIZE,
+                                      segments: Optional[List[str]] = None) -> List[Metric]:
+        """
+        Calculates several metrics from event data that is read chunk by chunk. Every chunk is folded into
+        per-user pretest and intest aggregates of the requested metrics and then discarded, so peak memory
+        depends on the number of users rather than the number of events.
+        :param event_chunks: Iterable of event data DataFrames or a path to a CSV or Parquet file with event data.
+                Expected pandas format of every chunk: |timestamp|userid|event_name|attribute_1|attribute_2|...
+        :param specs: List of MetricSpec instances describing the metrics to calculate.
+        :param n_jobs: Number of worker processes for statistical tests.
+        :param chunksize: Number of rows per chunk when reading from a file.
+        :param segments: Optional list of user property columns. Every metric is additionally broken down by
+                every value of these properties and the slices are kept in MetricResult.segments.
+        :return: List of calculated metrics in the order of the given specs
+        """
+        event_names, attribute_names = self._batch_columns(specs)
+
+        aggregated = None
+        for chunk in iter_event_chunks(event_chunks, chunksize=chunksize, event_names=event_names,
+                                       attributes=attribute_names):
+            chunk = self._ingest_chunk(chunk, event_names, attribute_names)
+
+            chunk_aggregated = self._aggregate_events_batch(chunk, self.ab_test_allocations, event_names,
+                                                            attribute_names, allocation_table=self.allocation_table,
+                                                            **self._period_settings())
+            aggregated = chunk_aggregated if aggregated is None else aggregated.add(chunk_aggregated, fill_value=0)
+            self.logger.debug(f"Folded chunk of {len(chunk)} events into {len(aggregated)} per-user aggregates")
+
+        if aggregated is None:
+            raise ValueError("No event data chunks were provided.")
+
+        aggregates = self._merge_batch_aggregates(aggregated, self.ab_test_allocations, specs,
+                                                  allocation_table=self.allocation_table)
+        return self._calculate_metrics_from_aggregates(specs, aggregates, n_jobs, segments=segments)
+
+    def fold_events_into_store(self, new_event_data: Union[str, pd.DataFrame, Iterable[pd.DataFrame]],
+                               specs: List[MetricSpec], store: Union[AccumulatorStore, str],
+                               chunksize: int = DEFAULT_CHUNKSIZE) -> AccumulatorStore:
+        """
+        Folds new events into a persistent per-user accumulator store. Only the events and attributes of the given
+        metrics are read and their pretest and intest per-user aggregates are added to the stored arrays.
+        Events of users that are not allocated yet are kept as pending aggregates, which become pretest or intest
+        aggregates when the users appear in the allocations of a later analyzer. Events at or before the checkpoint
+        of the store were already folded and are skipped, so folding the same events twice does not count them twice.
+        Late-arriving events with timestamps at or before the checkpoint are skipped too; their number is logged.
+        The pretest window (pretest_lookback) is applied when events are folded, so the store can only be folded
+        and read by analyzers with the pretest window it was created with.
+        The fold is written as a new generation of the store, which replaces the previous one only when it succeeds.
+        :param new_event_data: Events appended since the last fold (see AccumulatorStore.checkpoint): a DataFrame,
+                an iterable of DataFrames or a path to a CSV or Parquet file.
+                Expected pandas format: |timestamp|userid|event_name|attribute_1|attribute_2|...
+        :param specs: List of MetricSpec instances whose aggregates are kept in the store.
+        :param store: AccumulatorStore instance or path to the store directory.
+        :param chunksize: Number of rows per chunk when reading from a file.
+        :return: the updated store
+        """
+        if not isinstance(store, AccumulatorStore):
+            store = AccumulatorStore(store)
+
+        store.check_pretest_lookback(self.pretest_lookback.value if self.pretest_lookback is not None else None)
+        folded_until = store.checkpoint
+        num_skipped = 0
+        event_names, attribute_names = self._batch_columns(specs)
+        for chunk in iter_event_chunks(new_event_data, chunksize=chunksize, event_names=event_names,
+                                       attributes=attribute_names):
+            chunk = self._ingest_chunk(chunk, event_names, attribute_names)
+            if folded_until is not None:
+                num_events = len(chunk)
+                chunk = chunk[chunk["timestamp"] > folded_until]
+                num_skipped += num_events - len(chunk)
+
+            aggregated = self._aggregate_events_batch(chunk, self.ab_test_allocations, event_names, attribute_names,
+                                                      allocation_table=self.allocation_table,
+                                                      **self._period_settings())
+            store.fold(aggregated, event_names, attribute_names,
+                       checkpoint=chunk["timestamp"].max() if len(chunk) > 0 else None)
+            store.fold_pending(*self._aggregate_unallocated_events(chunk, event_names, attribute_names,
+                                                                   self.allocation_table))
+            self.logger.debug(f"Folded chunk of {len(chunk)} events into {store}")
+
+        if num_skipped > 0:
+            self.logger.info(f"Skipped {num_skipped} events at or before the checkpoint {folded_until} of the store")
+        store.flush()
+        return store
+
+    def calculate_metrics_from_store(self, specs: List[MetricSpec], store: Union[AccumulatorStore, str],
+                                     n_jobs: int = 1, segments: Optional[List[str]] = None) -> List[Metric]:
+        """
+        Calculates several metrics straight from the per-user aggregates of an accumulator store, without reading
+        event data.
+        :param specs: List of MetricSpec instances describing the metrics to calculate.
+        :param store: AccumulatorStore instance or path to the store directory.
+        :param n_jobs: Number of worker processes for statistical tests.
+        :param segments: Optional list of user property columns. Every metric is additionally broken down by
+                every value of these properties and the slices are kept in MetricResult.segments.
+        :return: List of calculated metrics in the order of the given specs
+        """
+        if not isinstance(store, AccumulatorStore):
+            store = AccumulatorStore(store)
+
+        userids = self.allocation_table.userids
+        lookback = self.pretest_lookback.value if self.pretest_lookback is not None else None
+        store.check_pretest_lookback(lookback)
+        aggregates = {}
+        for spec in specs:
+            for event_name, attribute_name in spec.components:
+                if event_name not in store.tracked_events or (attribute_name is not None and
+                                                               attribute_name not in store.tracked_attributes):
+                    raise ValueError(f"Metric {spec} is not tracked by the accumulator store. "
+                                     f"Fold events with fold_events_into_store first.")
+
+            component_values = [store.period_values(event_name, attribute_name or "__count", userids,
+                                                    self.allocation_table.timestamps, lookback)
+                                for event_name, attribute_name in spec.components]
+            merged = []
+            for period in (0, 1):
+                values = [pretest_and_intest[period] for pretest_and_intest in component_values]
+                if spec.operation == AggregationOperation.RATIO:
+                    columns = {RATIO_NUMERATOR: values[0], RATIO_DENOMINATOR: values[1]}
+                elif spec.operation == AggregationOperation.CONVERSION:
+                    columns = {spec.value_column: (values[0] > 0).astype(int)}
+                else:
+                    columns = {spec.value_column: values[0]}
+                merged.append(self.allocation_table.columns_frame(columns))
+            merged_pretest, merged_intest = merged
+            if spec.operation == AggregationOperation.RATIO:
+                result_intest = self._group_ratios(merged_intest, spec.value_column, self.allocation_table)
+            else:
+                result_intest = self.allocation_table.group_means(spec.value_column, merged_intest[spec.value_column])
+            aggregates[spec.key] = merged_pretest, merged_intest, result_intest
+
+        return self._calculate_metrics_from_aggregates(specs, aggregates, n_jobs, segments=segments)
+
+    def update_sequential(self, new_event_data: Union[str, pd.DataFrame, Iterable[pd.DataFrame]],
+                          specs: List[MetricSpec], state: Union[SequentialState, str],
+                          chunksize: int = DEFAULT_CHUNKSIZE) -> List[Metric]:
+        """
+        Sequential testing of a running experiment. Only the events appended since the last update are read:
+        they are folded into the per-user aggregates and per-group running moments kept in the state, and the
+        metrics are tested with always-valid mSPRT p-values, which can be checked after every update.
+        Pretest data is not used, so the enhancement mode of the analyzer does not apply.
+        Events at or before the checkpoint of the state were already folded and are skipped, so that re-delivered
+        events do not change the always-valid p-values. Events of users that are not allocated yet are kept in the
+        state and counted once the users are allocated, if the last of them is at or after the allocation.
+        :param new_event_data: Events appended since the last update (see SequentialState.checkpoint): a DataFrame,
+                an iterable of DataFrames or a path to a CSV or Parquet file.
+                Expected pandas format: |timestamp|userid|event_name|attribute_1|attribute_2|...
+        :param specs: List of MetricSpec instances describing the metrics to calculate.
+        :param state: SequentialState instance or path to the state file. The file is created on the first run
+                and rewritten after every update.
+        :param chunksize: Number of rows per chunk when reading from a file.
+        :return: List of calculated metrics in the order of the given specs
+        """
+        state_path = state if isinstance(state, (str, os.PathLike)) else None
+        if state_path is not None:
+            state = SequentialState.load(state_path)
+
+        for spec in specs:
+            if spec.operation == AggregationOperation.RATIO:
+                raise ValueError(f"Sequential testing does not support RATIO metrics: {spec}")
+        state.sync_allocations(self.ab_test_allocations)
+        for spec in specs:
+            state.metric(spec.key, spec.operation)
+
+        def update_state(intest_aggregates: pd.DataFrame):
+            # intest_aggregates has the format | event_name (index) | userid (index) | __count | attribute_1 | ...
+            for spec in specs:
+                try:
+                    user_aggregates = intest_aggregates.xs(spec.metricparams.event_name, level="event_name")
+                except KeyError:
+                    continue
+                column = spec.metricparams.attribute_name if spec.operation == AggregationOperation.SUM else "__count"
+                if column in user_aggregates.columns:
+                    state.update(spec.key, spec.operation, user_aggregates[column])
+
+        update_state(state.resolve_pending(self.ab_test_allocations))
+
+        folded_until = state.checkpoint
+        event_names, attribute_names = self._batch_columns(specs)
+        for chunk in iter_event_chunks(new_event_data, chunksize=chunksize, event_names=event_names,
+                                       attributes=attribute_names):
+            chunk = self._ingest_chunk(chunk, event_names, attribute_names)
+            if folded_until is not None:
+                chunk = chunk[chunk["timestamp"] > folded_until]
+            if len(chunk) == 0:
+                continue
+
+            aggregated = self._aggregate_events_batch(chunk, self.ab_test_allocations, event_names, attribute_names,
+                                                      allocation_table=self.allocation_table,
+                                                      **self._period_settings())
+            if False in aggregated.index.get_level_values("pretest"):
+                update_state(aggregated.xs(False, level="pretest"))
+            state.add_pending(*self._aggregate_unallocated_events(chunk, event_names, attribute_names,
+                                                                  self.allocation_table))
+
+            chunk_checkpoint = chunk["timestamp"].max()
+            state.checkpoint = chunk_checkpoint if state.checkpoint is None else max(state.checkpoint,
+                                                                                     chunk_checkpoint)
+        state.num_updates += 1
+
+        stat_tests = [StatSignificanceResult(StatSignificanceMethod.MSPRT,
+                                             state.p_values(spec.key, self.control_group_name, self.test_group_names))
+                      for spec in specs]
+        if self.correction is not None:
+            StatTests.apply_correction(stat_tests, self.correction)
+
+        metrics = []
+        for spec, stat_test in zip(specs, stat_tests):
+            groups = [self.control_group_name] + self.test_group_names
+            result_intest = pd.DataFrame({spec.value_column: [state.group_moments(spec.key, group).mean
+                                                              for group in groups]},
+                                         index=pd.Index(groups, name="abgroup"))
+            metric_output = Metric(spec.metrictype, spec.metricparams,
+                                   MetricResult(result_intest, self.control_group_name, self.test_group_names,
+                                                stat_test))
+            self.calculated_metrics.append(metric_output)
+            metrics.append(metric_output)
+
+        if state_path is not None:
+            state.save(state_path)
+        self.logger.debug(f"Sequential update {state.num_updates} up to {state.checkpoint}")
+        return metrics
+
+    def _segment_codes(self, segments: List[str]) -> Dict[str, Tuple[np.ndarray, pd.Index]]:
+        """
+        Factorizes segment properties of the allocated users once for all metrics.
+        :param segments: List of user property columns.
+        :return: dictionary with (segment code of every allocated user, segment values) for every property.
+                Users without properties get code -1 and are left out of all slices.
+        """
+        if self.user_properties is None:
+            raise ValueError("User properties are required to break metrics down by segments.")
+        user_properties = self.user_properties.set_index("userid")
+        segment_codes = {}
+        for segment in segments:
+            if segment not in user_properties.columns:
+                raise ValueError(f"Segment {segment} not found in user properties.")
+            codes, values = pd.factorize(user_properties[segment].reindex(self.allocation_table.userids), sort=True)
+            segment_codes[segment] = codes, values
+        return segment_codes
+
+    def _calculate_segment_metrics(self, spec: MetricSpec, merged_intest: pd.DataFrame,
+                                   segment_codes: Dict[str, Tuple[np.ndarray, pd.Index]]) -> List[Metric]:
+        """
+        Breaks a metric down by segments. Moments of all (segment, group) slices are calculated in one np.bincount
+        pass per segment property and all slices are tested with one vectorized Welch's T-test. Slices are not
+        variance-reduced, as fitting CUPED models per slice would cost as much as a separate analysis.
+        :param spec: MetricSpec of the metric.
+        :param merged_intest: DataFrame containing the intest data. Expected pandas format: | userid (index) | abgroup | value_column |
+        :param segment_codes: Output of _segment_codes.
+        :return: List of metrics, one for every (segment property, value)
+        """
+        table = self.allocation_table
+
+        def dense_values(column: str) -> np.ndarray:
+            values = merged_intest[column]
+            if not values.index.equals(table.userids):
+                values = values.reindex(table.userids)
+            return values.to_numpy(dtype=float)
+
+        if spec.operation == AggregationOperation.RATIO:
+            numerators, denominators = dense_values(RATIO_NUMERATOR), dense_values(RATIO_DENOMINATOR)
+            method = StatSignificanceMethod.DELTA_METHOD_T_TEST
+        else:
+            values = dense_values(spec.value_column)
+            method = StatSignificanceMethod.T_TEST
+
+        control_code = table.group_names.index(self.control_group_name)
+        test_codes = [table.group_names.index(group) for group in self.test_group_names]
+        group_index = pd.Index(table.group_names, name="abgroup")
+
+        slices = []
+        for segment, (codes, segment_values) in segment_codes.items():
+            if spec.operation == AggregationOperation.RATIO:
+                moments = RatioMomentsMatrix.from_codes(codes, table.group_codes, numerators, denominators,
+                                                        len(segment_values), len(table.group_names))
+            else:
+                moments = MomentsMatrix.from_codes(codes, table.group_codes, values, len(segment_values),
+                                                   len(table.group_names))
+            p_values = StatTests.calculate_t_test_for_moments_matrix(moments, control_code, test_codes)
+            means = moments.mean
+            for row, segment_value in enumerate(segment_values):
+                metricparams = MetricParams(spec.metricparams.event_name, spec.metricparams.attribute_name,
+                                            segment=(segment, segment_value),
+                                            denominator_event_name=spec.metricparams.denominator_event_name,
+                                            denominator_attribute_name=spec.metricparams.denominator_attribute_name)
+                result = pd.DataFrame({spec.value_column: means[row]}, index=group_index)
+                stat_test = StatSignificanceResult(method, p_values[row].tolist())
+                slices.append((metricparams, result, stat_test))
+
+        if self.correction is not None:
+            # all slices of the metric are one family of comparisons
+            StatTests.apply_correction([stat_test for _, _, stat_test in slices], self.correction)
+        return [Metric(spec.metrictype, metricparams,
+                       MetricResult(result, self.control_group_name, self.test_group_names, stat_test))
+                for metricparams, result, stat_test in slices]
+
+    def _calculate_metrics_from_aggregates(self, specs: List[MetricSpec],
+                                           aggregates: Dict[tuple, Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]],
+                                           n_jobs: int = 1, mode: Optional[str] = None,
+                                           track: bool = True, segments: Optional[List[str]] = None) -> List[Metric]:
+        tasks = [(aggregates[spec.key][0], aggregates[spec.key][1], spec.operation) for spec in specs]
+        settings = self._stat_test_settings(mode)
+        segment_codes = self._segment_codes(segments) if segments else {}
+
+        # Welch's T-tests of all metrics without a model are calculated at once from a (metrics x groups)
+        # moments matrix; only gboost CUPED tests are run one by one
+        stat_tests: List[Optional[StatSignificanceResult]] = [None] * len(tasks)
+        welch_moments = [_welch_moments(*task, settings["mode"], self.control_group_name, self.test_group_names)
+                         for task in tasks]
+        # covariance moments of ratio metrics are stacked into a matrix of their own
+        for moments_class in (MomentsMatrix, RatioMomentsMatrix):
+            batched = [position for position, moments in enumerate(welch_moments)
+                       if moments is not None and isinstance(moments[0], moments_class)]
+            if batched:
+                moments = moments_class.stack([welch_moments[position][0] for position in batched])
+                methods = [welch_moments[position][1] for position in batched]
+                for position, stat_test in zip(batched, StatTests.compare_moments_matrix(moments, methods)):
+                    stat_tests[position] = stat_test
+        model_tasks = [position for position, stat_test in enumerate(stat_tests) if stat_test is None]
+
+        if n_jobs < 0:
+            n_jobs = os.cpu_count() or 1
+        n_jobs = min(n_jobs, len(model_tasks))
+
+        if n_jobs > 1:
+            if self.model_cache is not None and self.model_cache.cache_dir is None:
+                self.logger.warning("Models fitted in worker processes are not kept in a ModelCache without "
+                                    "cache_dir. Set cache_dir to reuse them.")
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                     initargs=(settings,)) as executor:
+                # map keeps the order of the specs regardless of the completion order
+                model_stat_tests = list(executor.map(_run_stat_test_in_worker,
+                                                     [tasks[position] for position in model_tasks]))
+        else:
+            model_stat_tests = [_run_stat_test(*tasks[position], **settings) for position in model_tasks]
+        for position, stat_test in zip(model_tasks, model_stat_tests):
+            stat_tests[position] = stat_test
+
+        if self.correction is not None:
+            StatTests.apply_correction(stat_tests, self.correction)
+
+        metrics = []
+        for spec, stat_test in zip(specs, stat_tests):
+            _, merged_intest, result_intest = aggregates[spec.key]
+            metric_output = self._make_metric(spec.metrictype, spec.metricparams, merged_intest, result_intest,
+                                              stat_test)
+            if segment_codes:
+                metric_output.result.segments = self._calculate_segment_metrics(spec, merged_intest, segment_codes)
+            if track:
+                self.calculated_metrics.append(metric_output)
+            metrics.append(metric_output)
+        return metrics
+
     def save_report(self, filename: str):
-        res = format_metrics_to_html(self.calculated_metrics, self.control_group_name, self.test_group_names)
+        """
+        Saves an HTML report of the calculated metrics. The report is written row by row.
+        :param filename: path to the HTML file
+        """
+        with open(filename, 'w') as f:
+            write_metrics_html(self.calculated_metrics, self.control_group_name, self.test_group_names, f)
+
+    def save_metrics_ndjson(self, filename: str):
+        """
+        Saves the calculated metrics as newline-delimited JSON, one object per metric.
+        :param filename: path to the NDJSON file
+        """
         with open(filename, 'w') as f:
-            f.write(res)
+            write_metrics_ndjson(self.calculated_metrics, f)
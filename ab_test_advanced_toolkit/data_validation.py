@@ -1,17 +1,129 @@
+from typing import List, Optional
+
+import numpy as np
 import pandas as pd
 
+VALIDATION_MODES = ["full", "sampled", "trusted"]
+
+# Number of allocation rows checked for missing values in the sampled mode
+DEFAULT_SAMPLE_SIZE = 100_000
+
+
+class ValidationReport:
+    def __init__(self, mode: str, control_group_name: str, userids: pd.Index, group_names: List[str],
+                 group_codes: np.ndarray, test_group_names: List[str]):
+        """
+        Result of the validation of AB test allocations. It keeps what the checks had to compute anyway,
+        so that the analyzer does not compute it again: the user ID index (whose hash table is built by
+        the duplicate check) and the group of every user as int8 codes.
+
+        Parameters:
+        - mode: Validation mode that produced the report ("full", "sampled" or "trusted").
+        - control_group_name: The name of the control group.
+        - userids: Index of user IDs in the order of the allocations. The position of a user is its dense code.
+        - group_names: Sorted names of the groups.
+        - group_codes: int8 array with the position of the group of every user in group_names.
+        - test_group_names: Names of the test groups in the order of their first allocation.
+        """
+        self.mode = mode
+        self.control_group_name = control_group_name
+        self.userids = userids
+        self.group_names = group_names
+        self.group_codes = group_codes
+        self.test_group_names = test_group_names
+
+    @property
+    def num_users(self) -> int:
+        return len(self.userids)
+
+    def matches(self, ab_test_allocations: pd.DataFrame, control_group_name: str) -> bool:
+        """
+        Checks that the report was produced for these allocations and this control group: every row must have
+        the user ID and the group of the report. The columns are compared as arrays, without hashing them.
+        """
+        if control_group_name != self.control_group_name or len(ab_test_allocations) != self.num_users:
+            return False
+        if not self.userids.equals(pd.Index(ab_test_allocations['userid'])):
+            return False
+        # code -1 of a missing group picks the missing value appended to the names
+        expected_groups = np.asarray(self.group_names + [None], dtype=object)[self.group_codes]
+        groups = ab_test_allocations['abgroup'].to_numpy(dtype=object)
+        return bool(((groups == expected_groups) | (pd.isna(groups) & (self.group_codes < 0))).all())
+
+    def __repr__(self):
+        return (f"ValidationReport(mode={self.mode}, num_users={self.num_users}, groups={self.group_names}, "
+                f"control_group_name={self.control_group_name})")
+
+
+class ValidationCache:
+    def __init__(self, max_size: int = 4):
+        """
+        Cache of validation reports, so that allocations that were already validated are not validated again by
+        every ABTestAnalyzer instance. A cached report is reused for allocations with the same user IDs and groups
+        row by row, which is checked with vectorized comparisons that are much cheaper than the validation.
+        Reports keep the user ID index, so the cache is small.
 
-def validate_data(event_data: pd.DataFrame, ab_test_allocations: pd.DataFrame, control_group_name: str) -> None:
+        Parameters:
+        - max_size: Maximum number of reports kept in memory.
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be a positive number")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._reports: List[ValidationReport] = []
+
+    def get(self, ab_test_allocations: pd.DataFrame, control_group_name: str,
+            mode: str) -> Optional[ValidationReport]:
+        """
+        Returns a report of these allocations that were validated at least as thoroughly as the requested mode,
+        or None.
+        """
+        for report in reversed(self._reports):
+            if (VALIDATION_MODES.index(report.mode) <= VALIDATION_MODES.index(mode) and
+                    report.matches(ab_test_allocations, control_group_name)):
+                # the most recently used report is kept last
+                self._reports.remove(report)
+                self._reports.append(report)
+                self.hits += 1
+                return report
+        self.misses += 1
+        return None
+
+    def put(self, report: ValidationReport):
+        self._reports.append(report)
+        while len(self._reports) > self.max_size:
+            self._reports.pop(0)
+
+    def __len__(self):
+        return len(self._reports)
+
+    def __repr__(self):
+        return f"ValidationCache(size={len(self)}, max_size={self.max_size}, hits={self.hits}, misses={self.misses})"
+
+
+def validate_allocations(ab_test_allocations: pd.DataFrame, control_group_name: str, mode: str = "full",
+                         sample_size: int = DEFAULT_SAMPLE_SIZE, random_state: int = 0,
+                         cache: Optional[ValidationCache] = None) -> ValidationReport:
     """
-    Validates the event data and AB test allocations DataFrame.
+    Validates AB test allocations and returns a ValidationReport with the user ID index and group codes.
+    Groups are factorized once; the presence of the control group is checked on the group list and duplicate
+    user IDs are found with the hash table of the user ID index, which is then reused to encode users.
 
     Parameters:
-    - event_data: DataFrame containing event data with columns ["timestamp", "userid", "event_name", ...].
     - ab_test_allocations: DataFrame containing AB test allocations with columns ["timestamp", "userid", "abgroup"].
     - control_group_name: The name of the control group to check for its presence in the AB test allocations.
+    - mode: "full" checks every row. "sampled" checks missing user IDs and groups on a random sample of rows.
+      "trusted" skips the checks of missing values, for allocations produced by a trusted pipeline.
+      Duplicate user IDs are checked on all rows in every mode with the hash table of the user ID index, which
+      is built anyway to encode users.
+    - sample_size: Number of rows checked for missing values in the sampled mode.
+    - random_state: Seed of the sample.
+    - cache: Optional ValidationCache. Allocations with a cached report are not validated again.
     """
+    if mode not in VALIDATION_MODES:
+        raise ValueError(f"Unknown validation mode: {mode}. Available modes: {VALIDATION_MODES}")
 
-    # Validation for AB test allocations
     required_ab_columns = ["timestamp", "userid", "abgroup"]
     if not all(column in ab_test_allocations.columns for column in required_ab_columns):
         raise ValueError(f"AB test allocations must have the required columns: {required_ab_columns}")
@@ -19,13 +131,71 @@ def validate_data(event_data: pd.DataFrame, ab_test_allocations: pd.DataFrame, c
     if not pd.api.types.is_datetime64_any_dtype(ab_test_allocations['timestamp']):
         raise ValueError("The 'timestamp' column in ab_test_allocations must be of datetime type.")
 
-    if control_group_name not in ab_test_allocations['abgroup'].unique():
+    if cache is not None:
+        report = cache.get(ab_test_allocations, control_group_name, mode)
+        if report is not None:
+            return report
+
+    group_codes, group_names = pd.factorize(ab_test_allocations['abgroup'], sort=True)
+    group_names = list(group_names)
+    if control_group_name not in group_names:
         raise ValueError(f"Control group '{control_group_name}' not found in ab_test_allocations.")
+    if len(group_names) > np.iinfo(np.int8).max:
+        raise ValueError("AB test allocations support at most 127 groups")
 
-    if ab_test_allocations['userid'].duplicated().any():
+    userids = pd.Index(ab_test_allocations['userid'], name='userid')
+    # a duplicate is only found by checking all rows; the hash table is reused to encode users
+    if not userids.is_unique:
         raise ValueError("Duplicate userids found in ab_test_allocations. Please ensure each userid is unique.")
+    if mode != "trusted":
+        rows = slice(None)
+        if mode == "sampled" and len(userids) > sample_size:
+            rows = np.random.default_rng(random_state).choice(len(userids), size=sample_size, replace=False)
+        if (group_codes[rows] < 0).any():
+            raise ValueError("Missing abgroup values found in ab_test_allocations.")
+        if userids[rows].hasnans:
+            raise ValueError("Missing userids found in ab_test_allocations.")
 
-    # Validation for event data
+    # test groups are reported in the order of their first allocation
+    present_codes, first_rows = np.unique(group_codes, return_index=True)
+    test_group_names = [group_names[code] for code in present_codes[np.argsort(first_rows)]
+                        if code >= 0 and group_names[code] != control_group_name]
+
+    report = ValidationReport(mode, control_group_name, userids, group_names,
+                              group_codes.astype(np.int8), test_group_names)
+    if cache is not None:
+        cache.put(report)
+    return report
+
+
+def validate_data(event_data: Optional[pd.DataFrame], ab_test_allocations: pd.DataFrame,
+                  control_group_name: str, mode: str = "full",
+                  cache: Optional[ValidationCache] = None) -> ValidationReport:
+    """
+    Validates the event data and AB test allocations DataFrame.
+
+    Parameters:
+    - event_data: DataFrame containing event data with columns ["timestamp", "userid", "event_name", ...].
+      None skips the validation of event data, e.g. when it is streamed in chunks.
+    - ab_test_allocations: DataFrame containing AB test allocations with columns ["timestamp", "userid", "abgroup"].
+    - control_group_name: The name of the control group to check for its presence in the AB test allocations.
+    - mode: Validation mode of the allocations ("full", "sampled" or "trusted"), see validate_allocations.
+    - cache: Optional ValidationCache of reports of already validated allocations.
+    """
+    report = validate_allocations(ab_test_allocations, control_group_name, mode=mode, cache=cache)
+
+    if event_data is not None:
+        validate_event_data(event_data)
+    return report
+
+
+def validate_event_data(event_data: pd.DataFrame) -> None:
+    """
+    Validates the event data DataFrame.
+
+    Parameters:
+    - event_data: DataFrame containing event data with columns ["timestamp", "userid", "event_name", ...].
+    """
     required_event_columns = ["timestamp", "userid", "event_name"]
     if not all(column in event_data.columns for column in required_event_columns):
         raise ValueError(f"Event data must have the required columns: {required_event_columns}")
@@ -0,0 +1,72 @@
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+class EventIndex:
+    def __init__(self, event_data: pd.DataFrame, ab_test_allocations: pd.DataFrame):
+        """
+        Builds an index of event data keyed by event name. Event names are factorized into integer codes and the
+        row positions are sorted by code once, so the events of a single event name are a contiguous block of the
+        permutation that can be taken without scanning the whole event log. The event data itself is not copied:
+        only the permutation, the block offsets and the allocation timestamps of the events in sorted order are
+        kept, and rows and columns are taken from event_data on lookup.
+
+        :param event_data: DataFrame containing event data. Expected pandas format: |timestamp|userid|event_name|attribute_1|attribute_2|...
+        :param ab_test_allocations: DataFrame containing AB test allocations. Expected pandas format: |timestamp|userid (index)|abgroup|
+        """
+        codes, event_names = pd.factorize(event_data["event_name"])
+        order = np.argsort(codes, kind="stable")
+        # rows with a missing event name get code -1 and are sorted in front of all other rows
+        num_missing = int((codes < 0).sum())
+        counts = np.bincount(codes[codes >= 0], minlength=len(event_names))
+
+        self.event_names: List[str] = list(event_names)
+        self._positions = {event_name: code for code, event_name in enumerate(self.event_names)}
+        self._offsets = num_missing + np.concatenate([[0], np.cumsum(counts)])
+        self._order = order
+        self._event_data = event_data
+        self._alloc_timestamps = ab_test_allocations["timestamp"].reindex(
+            event_data["userid"].to_numpy()[order]).array
+
+    def _take(self, rows: np.ndarray, columns: Optional[List[str]]) -> pd.DataFrame:
+        """
+        Takes the given positions of the sorted events from event_data and attaches their allocation timestamps.
+        :param rows: Positions in the sorted order of the events.
+        :param columns: Columns of event_data to take, all columns if None.
+        :return: DataFrame with format |timestamp_event|userid|event_name|attribute_1|...|timestamp_alloc|
+        """
+        column_positions = (slice(None) if columns is None else
+                            self._event_data.columns.get_indexer(columns))
+        events = self._event_data.iloc[self._order[rows], column_positions].rename(
+            columns={"timestamp": "timestamp_event"})
+        events["timestamp_alloc"] = self._alloc_timestamps[rows]
+        return events
+
+    def get(self, event_name: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Returns the events with the given name together with the allocation timestamp of their users.
+        :param event_name: The name of the event.
+        :param columns: Columns of event_data to return, all columns if None.
+        :return: DataFrame with format |timestamp_event|userid|event_name|attribute_1|...|timestamp_alloc|
+        """
+        code = self._positions.get(event_name)
+        if code is None:
+            return self._take(np.arange(0), columns)
+        return self._take(np.arange(self._offsets[code], self._offsets[code + 1]), columns)
+
+    def select(self, event_names: List[str], columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Returns the events with any of the given names together with the allocation timestamp of their users.
+        :param event_names: The names of the events.
+        :param columns: Columns of event_data to return, all columns if None.
+        :return: DataFrame with format |timestamp_event|userid|event_name|attribute_1|...|timestamp_alloc|
+        """
+        codes = [self._positions[event_name] for event_name in event_names if event_name in self._positions]
+        rows = np.concatenate([np.arange(0)] + [np.arange(self._offsets[code], self._offsets[code + 1])
+                                                for code in codes])
+        return self._take(rows, columns)
+
+    def __repr__(self):
+        return f"<EventIndex(num_events={len(self._order)}, event_names={self.event_names})>"
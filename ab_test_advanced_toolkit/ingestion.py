@@ -0,0 +1,231 @@
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNKSIZE = 1_000_000
+
+PARQUET_SUFFIXES = (".parquet", ".pq")
+
+REQUIRED_EVENT_COLUMNS = ["timestamp", "userid", "event_name"]
+
+
+def _import_dataset():
+    try:
+        import pyarrow.dataset as ds
+    except ImportError as e:
+        raise ImportError("Reading Parquet files and Arrow datasets requires pyarrow. "
+                          "Install it with `pip install ab-test-advanced-toolkit[parquet]`.") from e
+    return ds
+
+
+def _is_arrow_source(source) -> bool:
+    if isinstance(source, (str, os.PathLike)):
+        path = os.fspath(source)
+        # a directory is treated as a partitioned Parquet dataset
+        return path.endswith(PARQUET_SUFFIXES) or os.path.isdir(path)
+    return type(source).__module__.startswith("pyarrow")
+
+
+def _event_columns(attributes: Optional[List[str]]) -> List[str]:
+    return REQUIRED_EVENT_COLUMNS + [attribute for attribute in attributes or [] if
+                                     attribute not in REQUIRED_EVENT_COLUMNS]
+
+
+def _open_dataset(source):
+    """
+    :param source: path to a Parquet file or directory, pyarrow Table or pyarrow Dataset
+    """
+    ds = _import_dataset()
+    if isinstance(source, ds.Dataset):
+        return source
+    if isinstance(source, (str, os.PathLike)):
+        return ds.dataset(os.fspath(source), format="parquet")
+    return ds.dataset(source)
+
+
+def _scan_arguments(event_names: Optional[List[str]], attributes: Optional[List[str]]) -> dict:
+    ds = _import_dataset()
+    return {
+        "columns": _event_columns(attributes),
+        "filter": ds.field("event_name").isin(list(event_names)) if event_names is not None else None,
+    }
+
+
+def load_event_data(source, event_names: Optional[List[str]] = None,
+                    attributes: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Loads event data from Parquet or Arrow. Only the required columns and the given attributes are read
+    and the event name filter is pushed down to the reader, so row groups and columns that no metric
+    uses are never deserialised.
+
+    :param source: Path to a Parquet file or a directory with a Parquet dataset, a pyarrow Table or a pyarrow Dataset.
+    :param event_names: Optional list of event names to read. All events are read when None.
+    :param attributes: Optional list of attribute columns to read in addition to timestamp, userid and event_name.
+    :return: DataFrame with format |timestamp|userid|event_name|attribute_1|attribute_2|...
+    """
+    table = _open_dataset(source).to_table(**_scan_arguments(event_names, attributes))
+    return table.to_pandas()
+
+
+def iter_event_chunks(source: Union[str, os.PathLike, pd.DataFrame, Iterable[pd.DataFrame]],
+                      chunksize: int = DEFAULT_CHUNKSIZE, event_names: Optional[List[str]] = None,
+                      attributes: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+    """
+    Iterates over event data in chunks. When event names and attributes are given, Parquet and Arrow sources
+    push the filter and the column projection down to the reader and CSV files read only the needed columns.
+
+    :param source: A DataFrame, an iterable of DataFrames, a path to a CSV file, a path to a Parquet file or
+            directory, a pyarrow Table or a pyarrow Dataset. Expected format: |timestamp|userid|event_name|attribute_1|...
+    :param chunksize: Number of rows per chunk when reading from a file.
+    :param event_names: Optional list of event names to read.
+    :param attributes: Optional list of attribute columns to read. All columns are read when None.
+    :return: iterator of event data DataFrames
+    """
+    if isinstance(source, pd.DataFrame):
+        yield source
+    elif _is_arrow_source(source):
+        scan_arguments = _scan_arguments(event_names, attributes)
+        if attributes is None:
+            scan_arguments.pop("columns")
+        for batch in _open_dataset(source).to_batches(batch_size=chunksize, **scan_arguments):
+            yield batch.to_pandas()
+    elif isinstance(source, (str, os.PathLike)):
+        usecols = _event_columns(attributes) if attributes is not None else None
+        yield from pd.read_csv(source, chunksize=chunksize, parse_dates=["timestamp"], usecols=usecols)
+    else:
+        yield from source
+
+
+class NormalizationReport:
+    def __init__(self):
+        """
+        Dtype conversions made by normalize_event_data and normalize_allocations and the memory they saved.
+        Memory is measured with memory_usage(deep=True) for the converted columns only.
+        """
+        self.conversions: Dict[str, Tuple[str, str]] = {}
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def record(self, name: str, before: pd.Series, after: pd.Series):
+        if before.dtype == after.dtype:
+            return
+        self.conversions[name] = (str(before.dtype), str(after.dtype))
+        self.bytes_before += before.memory_usage(index=False, deep=True)
+        self.bytes_after += after.memory_usage(index=False, deep=True)
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+    def __add__(self, other: "NormalizationReport") -> "NormalizationReport":
+        report = NormalizationReport()
+        report.conversions = {**self.conversions, **other.conversions}
+        report.bytes_before = self.bytes_before + other.bytes_before
+        report.bytes_after = self.bytes_after + other.bytes_after
+        return report
+
+    def __repr__(self):
+        return (f"NormalizationReport(bytes_saved={self.bytes_saved}, bytes_before={self.bytes_before}, "
+                f"bytes_after={self.bytes_after}, conversions={self.conversions})")
+
+
+def normalize_timestamps(timestamps: pd.Series) -> pd.Series:
+    """
+    Converts timestamps to timezone-naive UTC datetime64[ns]. Its memory layout is int64 nanoseconds since the
+    epoch, so allocation_table.to_epoch reads it without a copy, while comparisons with other timestamps and
+    the validation of datetime columns keep working.
+    :param timestamps: Series of timestamps
+    """
+    if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        timestamps = timestamps.dt.tz_convert("UTC").dt.tz_localize(None)
+    if timestamps.dtype != np.dtype("datetime64[ns]"):
+        timestamps = timestamps.astype("datetime64[ns]")
+    return timestamps
+
+
+def downcast_numeric(values: pd.Series) -> pd.Series:
+    """
+    Downcasts integers to the smallest integer type that holds their range and float64 to float32 when every
+    value survives the round trip. Other dtypes are returned unchanged.
+    :param values: Series of attribute values
+    """
+    if not isinstance(values.dtype, np.dtype) or values.dtype.kind not in "iuf" or values.empty:
+        return values
+    if values.dtype.kind in "iu":
+        return pd.to_numeric(values, downcast="integer")
+    if values.dtype == np.float64:
+        downcast = values.to_numpy().astype(np.float32)
+        if np.array_equal(downcast.astype(np.float64), values.to_numpy(), equal_nan=True):
+            return pd.Series(downcast, index=values.index, name=values.name)
+    return values
+
+
+def widen_attributes(event_data: pd.DataFrame, attribute_names: List[str]) -> pd.DataFrame:
+    """
+    Casts float attributes narrower than float64 back to float64, so that sums are accumulated in double precision.
+    Integer sums are accumulated in int64 by pandas already.
+    :param event_data: DataFrame with event data.
+    :param attribute_names: The names of the attributes that are summed.
+    """
+    narrow = {name: np.float64 for name in attribute_names
+              if event_data[name].dtype.kind == "f" and event_data[name].dtype.itemsize < 8}
+    return event_data.astype(narrow) if narrow else event_data
+
+
+def normalize_event_data(event_data: pd.DataFrame, event_names: Optional[List[str]] = None
+                         ) -> Tuple[pd.DataFrame, NormalizationReport]:
+    """
+    Converts event data to compact dtypes: event names to a categorical, timestamps to timezone-naive UTC
+    datetime64[ns] and numeric attributes to the narrowest dtype that holds them without loss.
+    User IDs are kept as they are, because they are matched against the index of the allocations.
+
+    :param event_data: DataFrame containing event data. Expected pandas format: |timestamp|userid|event_name|attribute_1|attribute_2|...
+    :param event_names: Optional list of event names. When given, only these events are kept and they are the
+            categories of the event name, so that chunks of event data share the same categories.
+    :return: normalized event data, NormalizationReport
+    """
+    report = NormalizationReport()
+    if event_names is not None:
+        event_data = event_data[event_data["event_name"].isin(event_names)]
+
+    columns = {}
+    for name, values in event_data.items():
+        if name == "event_name":
+            categories = event_names if event_names is not None else None
+            normalized = values if isinstance(values.dtype, pd.CategoricalDtype) and categories is None else \
+                values.astype(pd.CategoricalDtype(categories))
+        elif name == "timestamp" and pd.api.types.is_datetime64_any_dtype(values):
+            normalized = normalize_timestamps(values)
+        elif name in ("timestamp", "userid"):
+            normalized = values
+        else:
+            normalized = downcast_numeric(values)
+        report.record(f"event_data.{name}", values, normalized)
+        columns[name] = normalized
+
+    logger.debug(f"Normalized event data: {report}")
+    return pd.DataFrame(columns, index=event_data.index), report
+
+
+def normalize_allocations(ab_test_allocations: pd.DataFrame) -> Tuple[pd.DataFrame, NormalizationReport]:
+    """
+    Converts AB test allocations to compact dtypes: groups to a categorical and timestamps to timezone-naive UTC
+    datetime64[ns].
+    :param ab_test_allocations: DataFrame containing AB test allocations. Expected pandas format: |timestamp|userid|abgroup|
+    :return: normalized allocations, NormalizationReport
+    """
+    report = NormalizationReport()
+    normalized = {}
+    if "abgroup" in ab_test_allocations and not isinstance(ab_test_allocations["abgroup"].dtype, pd.CategoricalDtype):
+        normalized["abgroup"] = ab_test_allocations["abgroup"].astype("category")
+    if "timestamp" in ab_test_allocations and pd.api.types.is_datetime64_any_dtype(ab_test_allocations["timestamp"]):
+        normalized["timestamp"] = normalize_timestamps(ab_test_allocations["timestamp"])
+    for name, values in normalized.items():
+        report.record(f"ab_test_allocations.{name}", ab_test_allocations[name], values)
+    return ab_test_allocations.assign(**normalized), report
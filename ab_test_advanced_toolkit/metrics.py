@@ -1,4 +1,5 @@
-from typing import List
+import math
+from typing import Any, Dict, List, Optional, Tuple
 
 import pandas as pd
 
@@ -7,10 +8,17 @@ from enum import Enum, auto
 from ab_test_advanced_toolkit.stat_significance import StatSignificanceResult
 
 
+def _json_number(value) -> Optional[float]:
+    if value is None or math.isnan(value):
+        return None
+    return float(value)
+
+
 class MetricType(Enum):
     EVENT_COUNT_PER_USER = auto()
     EVENT_ATTRIBUTE_SUM_PER_USER = auto()
     CONVERSION_RATE = auto()
+    RATIO = auto()
 
 
 class AggregationOperation(Enum):
@@ -18,18 +26,34 @@ class AggregationOperation(Enum):
     MEAN = auto()
     COUNT = auto()
     CONVERSION = auto()
+    RATIO = auto()
+
+
+# Per-user columns of ratio metrics in merged pretest and intest data
+RATIO_NUMERATOR = "numerator"
+RATIO_DENOMINATOR = "denominator"
 
 
 class MetricParams:
-    def __init__(self, event_name, attribute_name=None):
+    def __init__(self, event_name, attribute_name=None, segment: Optional[Tuple[str, Any]] = None,
+                 denominator_event_name=None, denominator_attribute_name=None):
         """
         Initialize with the event name and an optional attribute name.
         :param event_name: event name that is used to calculate the metric. For example, "purchase"
         :param attribute_name: attribute that is used for the metric calculation (optional).
                 For example, revenuee sum for event "purchase"
+        :param segment: (user property, value) of the segment the metric is restricted to (optional).
+                For example, ("country", "USA")
+        :param denominator_event_name: event name of the denominator of RATIO metrics (optional).
+                By default it is event_name. For example, "session" for clicks per session
+        :param denominator_attribute_name: attribute summed in the denominator of RATIO metrics (optional).
+                Denominator events are counted when it is None
         """
         self.event_name = event_name
         self.attribute_name = attribute_name  # Optional, not all metrics may need this
+        self.segment = segment
+        self.denominator_event_name = denominator_event_name
+        self.denominator_attribute_name = denominator_attribute_name
 
     def __repr__(self):
         # Provides a readable representation, showing only non-None attributes
@@ -37,9 +61,84 @@ class MetricParams:
         return f"<MetricParams({params})>"
 
 
+class MetricSpec:
+    def __init__(self, metrictype: MetricType, metricparams: MetricParams):
+        """
+        Describes a metric to be calculated in a batch by ABTestAnalyzer.calculate_metrics.
+        :param metrictype: metric type (e.g., MetricType.EVENT_COUNT_PER_USER)
+        :param metricparams: MetricParams instance with event name and optional attribute name
+        """
+        if not isinstance(metricparams, MetricParams):
+            raise ValueError("metricparams must be an instance of MetricParams")
+        if metrictype == MetricType.EVENT_ATTRIBUTE_SUM_PER_USER and metricparams.attribute_name is None:
+            raise ValueError("attribute_name is required for EVENT_ATTRIBUTE_SUM_PER_USER metrics")
+        if metrictype == MetricType.RATIO and metricparams.attribute_name is None and \
+                metricparams.denominator_event_name is None and metricparams.denominator_attribute_name is None:
+            raise ValueError("RATIO metrics require an attribute_name or a denominator event or attribute")
+        self.metrictype = metrictype
+        self.metricparams = metricparams
+
+    @property
+    def operation(self) -> AggregationOperation:
+        """
+        Aggregation operation used to build the per-user values of the metric.
+        """
+        if self.metrictype == MetricType.EVENT_COUNT_PER_USER:
+            return AggregationOperation.COUNT
+        if self.metrictype == MetricType.EVENT_ATTRIBUTE_SUM_PER_USER:
+            return AggregationOperation.SUM
+        if self.metrictype == MetricType.CONVERSION_RATE:
+            return AggregationOperation.CONVERSION
+        if self.metrictype == MetricType.RATIO:
+            return AggregationOperation.RATIO
+        raise ValueError(f"Unsupported metric type: {self.metrictype}")
+
+    @property
+    def value_column(self) -> str:
+        """
+        Name of the per-user value column, matching the output of ABTestAnalyzer._merge_and_aggregate.
+        """
+        if self.operation == AggregationOperation.COUNT:
+            return "event_name"
+        if self.operation == AggregationOperation.SUM:
+            return self.metricparams.attribute_name
+        if self.operation == AggregationOperation.RATIO:
+            return "ratio"
+        return "conversion_status"
+
+    @property
+    def components(self) -> List[Tuple[str, Optional[str]]]:
+        """
+        (event name, attribute name) of every per-user aggregate the metric is built from. Events are counted
+        when the attribute name is None. RATIO metrics have a numerator and a denominator.
+        """
+        params = self.metricparams
+        if self.operation == AggregationOperation.SUM:
+            return [(params.event_name, params.attribute_name)]
+        if self.operation == AggregationOperation.RATIO:
+            return [(params.event_name, params.attribute_name),
+                    (params.denominator_event_name or params.event_name, params.denominator_attribute_name)]
+        return [(params.event_name, None)]
+
+    @property
+    def attribute_names(self) -> List[str]:
+        return [attribute_name for _, attribute_name in self.components if attribute_name is not None]
+
+    @property
+    def key(self) -> tuple:
+        if self.operation == AggregationOperation.RATIO:
+            return (self.metrictype, self.metricparams.event_name, self.metricparams.attribute_name,
+                    self.metricparams.denominator_event_name, self.metricparams.denominator_attribute_name)
+        return self.metrictype, self.metricparams.event_name, self.metricparams.attribute_name
+
+    def __repr__(self):
+        return f"<MetricSpec(metrictype={self.metrictype}, metricparams={self.metricparams})>"
+
+
 class MetricResult:
     def __init__(self, df: pd.DataFrame, control_group: str, test_groups: List[str],
-                 stat_significance: StatSignificanceResult):
+                 stat_significance: StatSignificanceResult,
+                 confidence_intervals: Optional[Dict[str, Tuple[float, float]]] = None):
         """
         Initialize with a pandas DataFrame and specify the control and test groups.
         The DataFrame is expected to have an index named 'abgroup' and a single column with metric values.
@@ -48,12 +147,22 @@ class MetricResult:
         :param control_group: The identifier for the control group (e.g., 'A').
         :param test_groups: List of identifiers for the test groups (e.g., ['B', 'C']).
         :param stat_significance: StatSignificanceResult instance with the method used and p-values.
+        :param confidence_intervals: Optional bootstrap confidence intervals of the relative lift for every test group.
+
+        Segment slices of the metric, if calculated, are kept in the segments attribute as Metric instances.
+        P-values adjusted for multiple testing, if requested, are kept in adjusted_p_values.
         """
         self.control_group = control_group
         self.test_groups = test_groups
         self.data = self._process_dataframe(df)
-        self.stat_significance = self._associate_pvals_with_groups(stat_significance)
+        self.stat_significance = self._associate_pvals_with_groups(stat_significance.p_values)
         self.stat_significance_method = stat_significance.method_used
+        self.adjusted_p_values = None
+        if stat_significance.adjusted_p_values is not None:
+            self.adjusted_p_values = self._associate_pvals_with_groups(stat_significance.adjusted_p_values)
+        self.correction = stat_significance.correction
+        self.confidence_intervals = confidence_intervals
+        self.segments: List["Metric"] = []
 
     def _process_dataframe(self, df: pd.DataFrame) -> dict:
         """
@@ -70,12 +179,30 @@ class MetricResult:
 
         return data
 
-    def _associate_pvals_with_groups(self, stat_significance: StatSignificanceResult) -> dict:
+    def _associate_pvals_with_groups(self, p_values: List[float]) -> dict:
         """
         Associates the provided p-values with the corresponding test groups.
-        :param stat_significance: StatSignificanceResult instance with the method used and p-values.
+        :param p_values: p-values in the order of the test groups.
+        """
+        return {group: pval for group, pval in zip(self.test_groups, p_values)}
+
+    def to_dict(self) -> dict:
+        """
+        Compact JSON-serializable representation of the result. Missing and undefined values are None.
         """
-        return {group: pval for group, pval in zip(self.test_groups, stat_significance.p_values)}
+        result = {
+            "control_group": self.control_group,
+            "values": {group: _json_number(value) for group, value in self.data.items()},
+            "p_values": {group: _json_number(pval) for group, pval in self.stat_significance.items()},
+            "method": self.stat_significance_method.name,
+        }
+        if self.adjusted_p_values is not None:
+            result["adjusted_p_values"] = {group: _json_number(pval) for group, pval in self.adjusted_p_values.items()}
+            result["correction"] = self.correction
+        if self.confidence_intervals is not None:
+            result["confidence_intervals"] = {group: [_json_number(low), _json_number(high)] for group, (low, high)
+                                              in self.confidence_intervals.items()}
+        return result
 
     def __repr__(self):
         return f"<MetricResult(control_group={self.control_group}, test_groups={self.test_groups}, data={self.data}, stat_significance={self.stat_significance}, stat_significance_method={self.stat_significance_method})>"
@@ -96,5 +223,14 @@ class Metric:
         self.metricparams = metricparams
         self.result = metricresult
 
+    def to_dict(self) -> dict:
+        """
+        Compact JSON-serializable representation of the metric.
+        """
+        params = {k: v for k, v in vars(self.metricparams).items() if v is not None}
+        if "segment" in params:
+            params["segment"] = {"property": params["segment"][0], "value": params["segment"][1]}
+        return {"metric_type": self.metrictype.name, **params, **self.result.to_dict()}
+
     def __repr__(self):
         return f"<Metric(metrictype={self.metrictype}, metricparams={self.metricparams}, result={self.result})>"
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+import pandas as pd
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ModelCache:
+    def __init__(self, max_size: int = 32, cache_dir: Optional[str] = None):
+        """
+        Cache of fitted regression models used for gboost CUPED. Models are kept in memory with LRU eviction
+        and, optionally, persisted on disk so that unchanged experiments reuse fitted models between runs.
+        When statistical tests run in worker processes (n_jobs > 1), every worker gets a copy of the cache and
+        models fitted by a worker are not added to the memory of the main process; they are only shared through
+        the on-disk store, so set cache_dir to reuse them.
+
+        :param max_size: Maximum number of models kept in memory.
+        :param cache_dir: Optional directory for the on-disk store of fitted models.
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be a positive number")
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._models: "OrderedDict[str, Any]" = OrderedDict()
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(x_train: pd.DataFrame, y_train: pd.Series, model_params: dict) -> str:
+        """
+        Calculates a fingerprint of the training data and model parameters. The training features contain the
+        pretest values of the metric for the pretest window and the user properties, so the fingerprint changes
+        whenever the metric, the feature set or the pretest window changes.
+
+        :param x_train: DataFrame with training features.
+        :param y_train: Series with training targets.
+        :param model_params: Parameters of the model to fit.
+        :return: hex digest of the fingerprint
+        """
+        digest = hashlib.sha256()
+        digest.update(repr(sorted(model_params.items())).encode())
+        digest.update(repr([(column, str(dtype)) for column, dtype in x_train.dtypes.items()]).encode())
+        digest.update(repr((y_train.name, str(y_train.dtype))).encode())
+        digest.update(pd.util.hash_pandas_object(x_train, index=False).values.tobytes())
+        digest.update(pd.util.hash_pandas_object(y_train, index=False).values.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Returns a fitted model by its fingerprint or None if the model is not cached.
+        :param key: fingerprint of the model
+        """
+        if key in self._models:
+            self._models.move_to_end(key)
+            self.hits += 1
+            return self._models[key]
+
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            with open(self._path(key), 'rb') as f:
+                model = pickle.load(f)
+            self._remember(key, model)
+            self.hits += 1
+            return model
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, model: Any):
+        """
+        Stores a fitted model in memory and in the on-disk store, if configured.
+        :param key: fingerprint of the model
+        :param model: fitted model
+        """
+        self._remember(key, model)
+        if self.cache_dir is not None:
+            # write to a temporary file first so that concurrent readers never see a partially written model
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(model, f)
+            os.replace(tmp_path, self._path(key))
+
+    def get_or_fit(self, key: str, fit: Callable[[], Any]) -> Any:
+        """
+        Returns a cached model or fits a new one and caches it.
+        :param key: fingerprint of the model
+        :param fit: function that fits and returns a new model
+        """
+        model = self.get(key)
+        if model is None:
+            logger.debug(f"Model cache miss for {key}")
+            model = fit()
+            self.put(key, model)
+        return model
+
+    def _remember(self, key: str, model: Any):
+        self._models[key] = model
+        self._models.move_to_end(key)
+        while len(self._models) > self.max_size:
+            self._models.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all models from memory. The on-disk store is kept.
+        """
+        self._models.clear()
+
+    def __len__(self):
+        return len(self._models)
+
+    def __repr__(self):
+        return f"ModelCache(size={len(self)}, max_size={self.max_size}, hits={self.hits}, misses={self.misses})"
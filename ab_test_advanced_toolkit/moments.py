@@ -0,0 +1,287 @@
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+
+class GroupMoments:
+    def __init__(self, n: Union[int, float], total: float, total_sq: float):
+        """
+        Sufficient statistics of a sample: number of observations, sum and sum of squares.
+        They are enough to calculate mean and variance of the sample and can be merged across chunks of data.
+
+        :param n: Number of observations.
+        :param total: Sum of the observed values.
+        :param total_sq: Sum of squares of the observed values.
+        """
+        self.n = n
+        self.total = total
+        self.total_sq = total_sq
+
+    @classmethod
+    def from_values(cls, values) -> "GroupMoments":
+        """
+        Calculates moments of an array of values, ignoring missing values.
+        :param values: array-like of numeric values
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        return cls(len(values), values.sum(), np.dot(values, values))
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.n if self.n > 0 else np.nan
+
+    @property
+    def variance(self) -> float:
+        """
+        Unbiased sample variance.
+        """
+        if self.n < 2:
+            return np.nan
+        return max(self.total_sq - self.total * self.total / self.n, 0.0) / (self.n - 1)
+
+    def __add__(self, other: "GroupMoments") -> "GroupMoments":
+        return GroupMoments(self.n + other.n, self.total + other.total, self.total_sq + other.total_sq)
+
+    def __repr__(self):
+        return f"GroupMoments(n={self.n}, total={self.total}, total_sq={self.total_sq})"
+
+
+def calculate_group_moments(data: pd.DataFrame, value_column: str,
+                            group_column: str = "abgroup") -> Dict[str, GroupMoments]:
+    """
+    Calculates moments of the value column for every group. Groups are factorized into integer codes and
+    the moments are summed with np.bincount, which is much cheaper than a groupby on group labels.
+    :param data: DataFrame with format | userid (index) | abgroup | value_column |
+    :param value_column: The name of the column with per-user values.
+    :param group_column: The name of the column with group identifiers.
+    :return: dictionary with GroupMoments for every group
+    """
+    codes, groups = pd.factorize(data[group_column], sort=True)
+    values = data[value_column].to_numpy(dtype=float)
+    # missing groups have code -1 and missing values are not observations
+    observed = (codes >= 0) & ~np.isnan(values)
+    codes, values = codes[observed], values[observed]
+    n = np.bincount(codes, minlength=len(groups))
+    total = np.bincount(codes, weights=values, minlength=len(groups))
+    total_sq = np.bincount(codes, weights=values * values, minlength=len(groups))
+    return {group: GroupMoments(int(n[code]), total[code], total_sq[code])
+            for code, group in enumerate(groups) if n[code] > 0}
+
+
+class CovariateMoments:
+    def __init__(self, num_covariates: int = 1):
+        """
+        Streaming accumulator of the first and second moments of pretest covariates X and an intest metric Y.
+        It is enough to calculate the CUPED coefficients theta = Var(X)^-1 Cov(X, Y) without keeping the data.
+
+        :param num_covariates: Number of pretest covariates.
+        """
+        self.n = 0
+        self.sum_x = np.zeros(num_covariates)
+        self.sum_y = 0.0
+        self.sum_xx = np.zeros((num_covariates, num_covariates))
+        self.sum_xy = np.zeros(num_covariates)
+
+    @classmethod
+    def from_values(cls, x, y) -> "CovariateMoments":
+        """
+        :param x: array-like of shape (n,) or (n, num_covariates) with pretest covariates
+        :param y: array-like of shape (n,) with intest metric values
+        """
+        x = np.asarray(x, dtype=float)
+        moments = cls(1 if x.ndim == 1 else x.shape[1])
+        moments.update(x, y)
+        return moments
+
+    def update(self, x, y) -> "CovariateMoments":
+        """
+        Adds a chunk of observations to the accumulator.
+        :param x: array-like of shape (n,) or (n, num_covariates) with pretest covariates
+        :param y: array-like of shape (n,) with intest metric values
+        """
+        x = np.asarray(x, dtype=float).reshape(len(y), -1)
+        y = np.asarray(y, dtype=float)
+        self.n += len(y)
+        self.sum_x += x.sum(axis=0)
+        self.sum_y += y.sum()
+        self.sum_xx += x.T @ x
+        self.sum_xy += x.T @ y
+        return self
+
+    def __add__(self, other: "CovariateMoments") -> "CovariateMoments":
+        moments = CovariateMoments(len(self.sum_x))
+        moments.n = self.n + other.n
+        moments.sum_x = self.sum_x + other.sum_x
+        moments.sum_y = self.sum_y + other.sum_y
+        moments.sum_xx = self.sum_xx + other.sum_xx
+        moments.sum_xy = self.sum_xy + other.sum_xy
+        return moments
+
+    @property
+    def theta(self) -> np.ndarray:
+        """
+        CUPED coefficients, solved from the normal equations Cov(X, X) theta = Cov(X, Y).
+        Covariates without variance get a zero coefficient.
+        """
+        if self.n == 0:
+            return np.zeros(len(self.sum_x))
+        mean_x = self.sum_x / self.n
+        cov_xx = self.sum_xx / self.n - np.outer(mean_x, mean_x)
+        cov_xy = self.sum_xy / self.n - mean_x * (self.sum_y / self.n)
+        theta, *_ = np.linalg.lstsq(cov_xx, cov_xy, rcond=None)
+        return theta
+
+    @property
+    def intercept(self) -> float:
+        if self.n == 0:
+            return 0.0
+        return self.sum_y / self.n - self.sum_x / self.n @ self.theta
+
+    def __repr__(self):
+        return f"CovariateMoments(n={self.n}, theta={self.theta})"
+
+
+class MomentsMatrix:
+    def __init__(self, n: np.ndarray, total: np.ndarray, total_sq: np.ndarray):
+        """
+        Moments of many samples at once, arranged as a (rows x groups) matrix. For example, rows are segments
+        or metrics and columns are AB test groups.
+
+        :param n: Array of shape (rows, groups) with numbers of observations.
+        :param total: Array of shape (rows, groups) with sums of the observed values.
+        :param total_sq: Array of shape (rows, groups) with sums of squares of the observed values.
+        """
+        self.n = n
+        self.total = total
+        self.total_sq = total_sq
+
+    @classmethod
+    def from_codes(cls, row_codes: np.ndarray, group_codes: np.ndarray, values: np.ndarray, num_rows: int,
+                   num_groups: int) -> "MomentsMatrix":
+        """
+        Calculates the moments of every (row, group) cell in one np.bincount pass over a flattened cell index.
+        Observations with a negative code or a missing value are ignored.
+        :param row_codes: Row code of every observation.
+        :param group_codes: Group code of every observation.
+        :param values: Value of every observation.
+        :param num_rows: Number of rows.
+        :param num_groups: Number of groups.
+        """
+        values = np.asarray(values, dtype=float)
+        observed = (row_codes >= 0) & (group_codes >= 0) & ~np.isnan(values)
+        cells = row_codes[observed].astype(np.int64) * num_groups + group_codes[observed]
+        values = values[observed]
+        size = num_rows * num_groups
+        return cls(np.bincount(cells, minlength=size).reshape(num_rows, num_groups),
+                   np.bincount(cells, weights=values, minlength=size).reshape(num_rows, num_groups),
+                   np.bincount(cells, weights=values * values, minlength=size).reshape(num_rows, num_groups))
+
+    @classmethod
+    def stack(cls, matrices: List["MomentsMatrix"]) -> "MomentsMatrix":
+        """
+        Stacks the rows of several moments matrices with the same groups into one matrix.
+        For example, the (1 x groups) moments of every metric into a (metrics x groups) matrix.
+        """
+        return cls(np.vstack([matrix.n for matrix in matrices]), np.vstack([matrix.total for matrix in matrices]),
+                   np.vstack([matrix.total_sq for matrix in matrices]))
+
+    @property
+    def mean(self) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.n > 0, self.total / self.n, np.nan)
+
+    @property
+    def variance(self) -> np.ndarray:
+        """
+        Unbiased sample variance of every cell.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            centered = np.maximum(self.total_sq - self.total * self.total / self.n, 0.0)
+            return np.where(self.n > 1, centered / (self.n - 1), np.nan)
+
+    def __getitem__(self, cell) -> GroupMoments:
+        return GroupMoments(int(self.n[cell]), self.total[cell], self.total_sq[cell])
+
+    def __repr__(self):
+        return f"MomentsMatrix(shape={self.n.shape})"
+
+
+class RatioMomentsMatrix:
+    def __init__(self, n: np.ndarray, sum_x: np.ndarray, sum_y: np.ndarray, sum_xx: np.ndarray, sum_yy: np.ndarray,
+                 sum_xy: np.ndarray):
+        """
+        Covariance moments of per-user numerators x and denominators y of a ratio metric, arranged as a
+        (rows x groups) matrix like MomentsMatrix. The ratio of a cell is sum(x) / sum(y) and its variance is
+        calculated with the delta method, so ratio metrics are tested as cheaply as means.
+
+        :param n: Array of shape (rows, groups) with numbers of users.
+        :param sum_x: Sums of numerators.
+        :param sum_y: Sums of denominators.
+        :param sum_xx: Sums of squares of numerators.
+        :param sum_yy: Sums of squares of denominators.
+        :param sum_xy: Sums of products of numerators and denominators.
+        """
+        self.n = n
+        self.sum_x = sum_x
+        self.sum_y = sum_y
+        self.sum_xx = sum_xx
+        self.sum_yy = sum_yy
+        self.sum_xy = sum_xy
+
+    @classmethod
+    def from_codes(cls, row_codes: np.ndarray, group_codes: np.ndarray, numerators: np.ndarray,
+                   denominators: np.ndarray, num_rows: int, num_groups: int) -> "RatioMomentsMatrix":
+        """
+        Calculates the moments of every (row, group) cell with np.bincount over a flattened cell index.
+        Users with a negative code or a missing numerator or denominator are ignored.
+        """
+        x = np.asarray(numerators, dtype=float)
+        y = np.asarray(denominators, dtype=float)
+        observed = (row_codes >= 0) & (group_codes >= 0) & ~np.isnan(x) & ~np.isnan(y)
+        cells = row_codes[observed].astype(np.int64) * num_groups + group_codes[observed]
+        x, y = x[observed], y[observed]
+        size = num_rows * num_groups
+
+        def cell_sums(weights=None):
+            return np.bincount(cells, weights=weights, minlength=size).reshape(num_rows, num_groups)
+
+        return cls(cell_sums(), cell_sums(x), cell_sums(y), cell_sums(x * x), cell_sums(y * y), cell_sums(x * y))
+
+    @classmethod
+    def stack(cls, matrices: List["RatioMomentsMatrix"]) -> "RatioMomentsMatrix":
+        """
+        Stacks the rows of several ratio moments matrices with the same groups into one matrix.
+        """
+        return cls(*(np.vstack([getattr(matrix, name) for matrix in matrices])
+                     for name in ("n", "sum_x", "sum_y", "sum_xx", "sum_yy", "sum_xy")))
+
+    @property
+    def mean(self) -> np.ndarray:
+        """
+        Ratio sum(x) / sum(y) of every cell.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where((self.n > 0) & (self.sum_y != 0), self.sum_x / self.sum_y, np.nan)
+
+    @property
+    def denominator_mean(self) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.n > 0, self.sum_y / self.n, np.nan)
+
+    @property
+    def variance(self) -> np.ndarray:
+        """
+        Unbiased variance of the linearized per-user values (x - ratio * y) / mean(y) of every cell.
+        Divided by n, it is the delta-method variance of the ratio:
+        (Var(x) - 2 ratio Cov(x, y) + ratio^2 Var(y)) / (n mean(y)^2).
+        """
+        ratio = self.mean
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # sum((x - ratio * y)^2), as the linearized values have a zero mean
+            residual_sq = np.maximum(self.sum_xx - 2 * ratio * self.sum_xy + ratio * ratio * self.sum_yy, 0.0)
+            return np.where(self.n > 1, residual_sq / (self.n - 1) / self.denominator_mean ** 2, np.nan)
+
+    def __repr__(self):
+        return f"RatioMomentsMatrix(shape={self.n.shape})"
@@ -0,0 +1,365 @@
+import copy
+import os
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Type, Union
+
+import numpy as np
+import pandas as pd
+
+from ab_test_advanced_toolkit.model_cache import ModelCache
+
+# Default parameters of the gradient boosting backends. They match the CatBoost model used for gboost CUPED.
+GBOOST_MODEL_PARAMS = {'iterations': 500, 'learning_rate': 0.1, 'depth': 4, 'loss_function': 'RMSE'}
+
+
+MISSING_CATEGORY = "__missing__"
+
+
+class FittedRegressor:
+    def __init__(self, model, categorical_features: List[str], categories: Optional[Dict[str, pd.Index]] = None):
+        """
+        A fitted model together with the encoding of categorical features used during the fit, so that
+        features are encoded in the same way when predicting.
+
+        :param model: Fitted model with a predict method.
+        :param categorical_features: Names of the categorical features.
+        :param categories: Categories of every categorical feature for models that take pandas categoricals.
+                None for models that take strings, in which case missing values are replaced with MISSING_CATEGORY.
+        """
+        self.model = model
+        self.categorical_features = categorical_features
+        self.categories = categories
+
+    def predict(self, x: pd.DataFrame) -> np.ndarray:
+        if self.categories is None:
+            x = _fill_missing_categories(x, self.categorical_features)
+        else:
+            x = _encode_categories(x, self.categories)
+        return np.asarray(self.model.predict(x))
+
+    def __repr__(self):
+        return f"FittedRegressor(model={type(self.model).__name__})"
+
+
+def _encode_categories(x: pd.DataFrame, categories: Dict[str, pd.Index]) -> pd.DataFrame:
+    if not categories:
+        return x
+    return x.assign(**{column: pd.Categorical(x[column], categories=values) for column, values in categories.items()})
+
+
+def _fill_missing_categories(x: pd.DataFrame, categorical_features: List[str]) -> pd.DataFrame:
+    if not categorical_features:
+        return x
+    return x.assign(**{column: x[column].astype(object).where(x[column].notna(), MISSING_CATEGORY).astype(str)
+                       for column in categorical_features})
+
+
+class RegressorBackend(ABC):
+    name = None
+
+    def __init__(self, n_threads: int = -1, early_stopping_rounds: Optional[int] = None,
+                 validation_fraction: float = 0.1, time_budget: Optional[float] = None, random_state: int = 0,
+                 **params):
+        """
+        Configuration of a regression model used to predict intest metric values from pretest data in gboost CUPED.
+        A backend is only a configuration: fit returns a new FittedRegressor, so one backend can be shared by
+        all metrics and worker processes.
+
+        :param n_threads: Number of threads used to fit a model. -1 uses all available cores.
+        :param early_stopping_rounds: Stop boosting when the loss on a validation split has not improved for this
+                number of rounds. None trains all iterations on all data.
+        :param validation_fraction: Fraction of users held out for early stopping.
+        :param time_budget: Maximum number of seconds to spend on boosting iterations of one fit.
+        :param random_state: Seed of the validation split and the model.
+        :param params: Parameters of the model that override the defaults of the backend.
+        """
+        if not 0 < validation_fraction < 1:
+            raise ValueError("validation_fraction must be between 0 and 1")
+        self.n_threads = (os.cpu_count() or 1) if n_threads < 0 else n_threads
+        self.early_stopping_rounds = early_stopping_rounds
+        self.validation_fraction = validation_fraction
+        self.time_budget = time_budget
+        self.random_state = random_state
+        self.params = params
+
+    @property
+    def model_params(self) -> dict:
+        """
+        Parameters that define the fitted model. They are part of the model cache fingerprint.
+        """
+        return dict(self.params, backend=self.name, early_stopping_rounds=self.early_stopping_rounds,
+                    validation_fraction=self.validation_fraction, time_budget=self.time_budget,
+                    random_state=self.random_state)
+
+    def _validation_split(self, x: pd.DataFrame, y: pd.Series) -> Tuple[pd.DataFrame, pd.Series,
+                                                                        Optional[pd.DataFrame], Optional[pd.Series]]:
+        if self.early_stopping_rounds is None or len(x) < 2:
+            return x, y, None, None
+        order = np.random.default_rng(self.random_state).permutation(len(x))
+        num_validation = max(1, int(len(x) * self.validation_fraction))
+        validation, train = order[:num_validation], order[num_validation:]
+        return x.iloc[train], y.iloc[train], x.iloc[validation], y.iloc[validation]
+
+    def _deadline(self) -> Optional[float]:
+        return time.monotonic() + self.time_budget if self.time_budget is not None else None
+
+    @abstractmethod
+    def fit(self, x: pd.DataFrame, y: pd.Series, categorical_features: List[str]) -> FittedRegressor:
+        """
+        Fits a new model.
+        :param x: DataFrame with training features.
+        :param y: Series with training targets.
+        :param categorical_features: Names of the categorical features.
+        """
+
+    def __repr__(self):
+        return (f"{type(self).__name__}(n_threads={self.n_threads}, early_stopping_rounds={self.early_stopping_rounds}, "
+                f"time_budget={self.time_budget}, params={self.params})")
+
+
+class CatBoostBackend(RegressorBackend):
+    name = "catboost"
+
+    def fit(self, x: pd.DataFrame, y: pd.Series, categorical_features: List[str]) -> FittedRegressor:
+        # catboost is imported on first use so that importing the package and other modes do not load it
+        from catboost import CatBoostRegressor
+
+        # catboost writes training logs to catboost_info/ in the working directory unless it is told not to
+        params = dict(GBOOST_MODEL_PARAMS, allow_writing_files=False)
+        params.update(self.params)
+        model = CatBoostRegressor(**params, cat_features=categorical_features, thread_count=self.n_threads,
+                                  random_seed=self.random_state)
+        # catboost does not accept missing values of categorical features
+        x = _fill_missing_categories(x, categorical_features)
+        x_train, y_train, x_validation, y_validation = self._validation_split(x, y)
+        fit_params = {}
+        if x_validation is not None:
+            fit_params.update(eval_set=(x_validation, y_validation), early_stopping_rounds=self.early_stopping_rounds)
+        deadline = self._deadline()
+        if deadline is not None:
+            fit_params["callbacks"] = [_CatBoostDeadline(deadline)]
+        model.fit(x_train, y_train, verbose=False, **fit_params)
+        return FittedRegressor(model, categorical_features)
+
+
+class _CatBoostDeadline:
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+
+    def after_iteration(self, info) -> bool:
+        # returning False stops training
+        return time.monotonic() < self.deadline
+
+
+class XGBoostHistBackend(RegressorBackend):
+    name = "xgboost_hist"
+
+    def fit(self, x: pd.DataFrame, y: pd.Series, categorical_features: List[str]) -> FittedRegressor:
+        from xgboost import XGBRegressor
+        from xgboost.callback import TrainingCallback
+
+        class Deadline(TrainingCallback):
+            def __init__(self, deadline: float):
+                super().__init__()
+                self.deadline = deadline
+
+            def after_iteration(self, model, epoch, evals_log) -> bool:
+                # returning True stops training
+                return time.monotonic() >= self.deadline
+
+        defaults = {'n_estimators': GBOOST_MODEL_PARAMS['iterations'],
+                    'learning_rate': GBOOST_MODEL_PARAMS['learning_rate'],
+                    'max_depth': GBOOST_MODEL_PARAMS['depth']}
+        categories = {column: pd.Index(x[column].dropna().unique()) for column in categorical_features}
+        x = _encode_categories(x, categories)
+        x_train, y_train, x_validation, y_validation = self._validation_split(x, y)
+
+        deadline = self._deadline()
+        model = XGBRegressor(**dict(defaults, **self.params), tree_method="hist", enable_categorical=True,
+                             n_jobs=self.n_threads, random_state=self.random_state,
+                             early_stopping_rounds=self.early_stopping_rounds if x_validation is not None else None,
+                             callbacks=[Deadline(deadline)] if deadline is not None else None)
+        model.fit(x_train, y_train, verbose=False,
+                  eval_set=[(x_validation, y_validation)] if x_validation is not None else None)
+        # the deadline callback is a local class and would make the fitted model impossible to pickle
+        model.set_params(callbacks=None)
+        return FittedRegressor(model, categorical_features, categories)
+
+
+class SklearnHistBackend(RegressorBackend):
+    name = "sklearn_hist"
+
+    # number of boosting iterations between checks of the time budget
+    ITERATIONS_PER_STEP = 25
+
+    def fit(self, x: pd.DataFrame, y: pd.Series, categorical_features: List[str]) -> FittedRegressor:
+        from sklearn.ensemble import HistGradientBoostingRegressor
+        from threadpoolctl import threadpool_limits
+
+        defaults = {'max_iter': GBOOST_MODEL_PARAMS['iterations'],
+                    'learning_rate': GBOOST_MODEL_PARAMS['learning_rate'],
+                    'max_depth': GBOOST_MODEL_PARAMS['depth']}
+        params = dict(defaults, **self.params)
+        categories = {column: pd.Index(x[column].dropna().unique()) for column in categorical_features}
+        x = _encode_categories(x, categories)
+        early_stopping = self.early_stopping_rounds is not None
+        max_iter = params.pop('max_iter')
+        deadline = self._deadline()
+
+        model = HistGradientBoostingRegressor(**params, categorical_features="from_dtype",
+                                              early_stopping=early_stopping,
+                                              n_iter_no_change=self.early_stopping_rounds or 10,
+                                              validation_fraction=self.validation_fraction if early_stopping else None,
+                                              random_state=self.random_state,
+                                              max_iter=max_iter if deadline is None else 0, warm_start=True)
+        with threadpool_limits(limits=self.n_threads, user_api="openmp"):
+            if deadline is None:
+                model.fit(x, y)
+            else:
+                # grow the ensemble in steps with warm start until it is complete, stopped early or out of time
+                while True:
+                    model.max_iter = min(max_iter, model.max_iter + self.ITERATIONS_PER_STEP)
+                    model.fit(x, y)
+                    if model.n_iter_ < model.max_iter or model.max_iter >= max_iter or time.monotonic() >= deadline:
+                        break
+        return FittedRegressor(model, categorical_features, categories)
+
+
+class RidgeTargetEncodingBackend(RegressorBackend):
+    name = "ridge_target_encoding"
+
+    def fit(self, x: pd.DataFrame, y: pd.Series, categorical_features: List[str]) -> FittedRegressor:
+        """
+        Fits a ridge regression on target-encoded categorical features. The fit is closed form, so early stopping
+        and the time budget do not apply.
+        """
+        from category_encoders import TargetEncoder
+        from sklearn.impute import SimpleImputer
+        from sklearn.linear_model import Ridge
+        from sklearn.pipeline import Pipeline
+        from threadpoolctl import threadpool_limits
+
+        model = Pipeline([
+            ("target_encoder", TargetEncoder(cols=categorical_features)),
+            ("imputer", SimpleImputer(keep_empty_features=True)),
+            ("ridge", Ridge(**dict({'alpha': 1.0}, **self.params))),
+        ])
+        with threadpool_limits(limits=self.n_threads, user_api="blas"):
+            model.fit(x, y)
+        return FittedRegressor(model, categorical_features, categories={})
+
+
+class CrossFitting:
+    def __init__(self, n_folds: int = 5, n_jobs: int = 1, random_state: int = 0):
+        """
+        K-fold cross-fitting of gboost CUPED predictions. Users are split into folds, and the model of every fold
+        is trained on the other folds and predicts only the users of its fold. A user's prediction never depends
+        on their own in-test value, so the model cannot overfit to the outcome and the adjusted values stay unbiased.
+
+        :param n_folds: Number of folds. Must be at least 2.
+        :param n_jobs: Number of folds fitted in parallel threads. -1 fits all folds at once. The threads of the
+                regressor backend are shared between the parallel folds.
+        :param random_state: Seed of the fold assignment.
+        """
+        if n_folds < 2:
+            raise ValueError("n_folds must be at least 2")
+        self.n_folds = n_folds
+        self.n_jobs = (os.cpu_count() or 1) if n_jobs < 0 else max(1, n_jobs)
+        self.random_state = random_state
+
+    def fold_ids(self, strata: np.ndarray) -> np.ndarray:
+        """
+        Assigns users to folds at random, so that every stratum (for example, AB group) is spread evenly over folds.
+        :param strata: Stratum of every user.
+        :return: int array with the fold of every user
+        """
+        order = np.random.default_rng(self.random_state).permutation(len(strata))
+        codes = pd.factorize(np.asarray(strata)[order])[0]
+        # rank of every user within its stratum in the shuffled order
+        ranks = pd.Series(codes).groupby(codes).cumcount().to_numpy()
+        fold_ids = np.empty(len(strata), dtype=np.int64)
+        fold_ids[order] = ranks % self.n_folds
+        return fold_ids
+
+    def predict_out_of_fold(self, regressor: RegressorBackend, x: pd.DataFrame, y: pd.Series,
+                            categorical_features: List[str], strata: np.ndarray,
+                            model_cache: Optional[ModelCache] = None) -> np.ndarray:
+        """
+        Fits a model per fold and predicts every user with the model that was not trained on them.
+        :param regressor: RegressorBackend that fits the models.
+        :param x: DataFrame with features of all users.
+        :param y: Series with targets of all users.
+        :param categorical_features: Names of the categorical features.
+        :param strata: Stratum of every user used for the fold assignment.
+        :param model_cache: Optional ModelCache. Models of folds with unchanged training data are reused from it.
+        :return: array with out-of-fold predictions aligned with x
+        """
+        fold_ids = self.fold_ids(strata)
+        folds = [fold for fold in range(self.n_folds) if np.any(fold_ids == fold)]
+        training_sets = {fold: (x[fold_ids != fold], y[fold_ids != fold]) for fold in folds}
+
+        # cache lookups and updates happen in this thread, only the fits run in parallel
+        keys, models = {}, {}
+        if model_cache is not None:
+            model_params = dict(regressor.model_params, cat_features=categorical_features)
+            keys = {fold: ModelCache.fingerprint(*training_sets[fold], model_params) for fold in folds}
+            models = {fold: model_cache.get(keys[fold]) for fold in folds}
+        missing = [fold for fold in folds if models.get(fold) is None]
+
+        n_jobs = min(self.n_jobs, len(missing))
+        if n_jobs > 1:
+            fold_regressor = copy.copy(regressor)
+            fold_regressor.n_threads = max(1, regressor.n_threads // n_jobs)
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                fitted = list(executor.map(
+                    lambda fold: fold_regressor.fit(*training_sets[fold], categorical_features), missing))
+        else:
+            fitted = [regressor.fit(*training_sets[fold], categorical_features) for fold in missing]
+        for fold, model in zip(missing, fitted):
+            models[fold] = model
+            if model_cache is not None:
+                model_cache.put(keys[fold], model)
+
+        predictions = np.zeros(len(x))
+        for fold in folds:
+            holdout = fold_ids == fold
+            predictions[holdout] = models[fold].predict(x[holdout])
+        return predictions
+
+    def __repr__(self):
+        return f"CrossFitting(n_folds={self.n_folds}, n_jobs={self.n_jobs}, random_state={self.random_state})"
+
+
+REGRESSOR_BACKENDS: Dict[str, Type[RegressorBackend]] = {}
+
+
+def register_regressor_backend(backend_class: Type[RegressorBackend]) -> Type[RegressorBackend]:
+    """
+    Registers a regressor backend under its name, so that it can be selected by name in ABTestAnalyzer.
+    :param backend_class: Subclass of RegressorBackend with a unique name.
+    """
+    if not backend_class.name:
+        raise ValueError("Regressor backend must have a name")
+    REGRESSOR_BACKENDS[backend_class.name] = backend_class
+    return backend_class
+
+
+for _backend_class in (CatBoostBackend, XGBoostHistBackend, SklearnHistBackend, RidgeTargetEncodingBackend):
+    register_regressor_backend(_backend_class)
+
+
+def get_regressor_backend(regressor: Union[str, RegressorBackend, None], **kwargs) -> RegressorBackend:
+    """
+    Returns a regressor backend by name, or the given backend itself.
+    :param regressor: Name of a registered backend ("catboost", "xgboost_hist", "sklearn_hist",
+            "ridge_target_encoding"), a RegressorBackend instance or None for the default CatBoost backend.
+    :param kwargs: Arguments of the backend when it is created by name.
+    """
+    if isinstance(regressor, RegressorBackend):
+        return regressor
+    name = regressor or CatBoostBackend.name
+    if name not in REGRESSOR_BACKENDS:
+        raise ValueError(f"Unknown regressor backend: {name}. Available backends: {list(REGRESSOR_BACKENDS)}")
+    return REGRESSOR_BACKENDS[name](**kwargs)
@@ -0,0 +1,243 @@
+import os
+import pickle
+import tempfile
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from ab_test_advanced_toolkit.allocation_table import NAT, to_epoch
+from ab_test_advanced_toolkit.metrics import AggregationOperation
+from ab_test_advanced_toolkit.moments import GroupMoments
+
+
+def msprt_p_value(control: GroupMoments, test: GroupMoments, mixture_sd: float = 0.1) -> float:
+    """
+    Calculates the p-value of the mixture sequential probability ratio test (mSPRT) for the difference of means.
+    The effect is integrated over a normal mixture N(0, tau^2), which gives a closed-form likelihood ratio.
+    1 / likelihood ratio is an always-valid p-value: it can be checked after every update without inflating
+    the false positive rate.
+
+    :param control: GroupMoments of the control group.
+    :param test: GroupMoments of the test group.
+    :param mixture_sd: Standard deviation of the mixture over effect sizes, in units of the metric standard deviation.
+    :return: p-value of the current look
+    """
+    if control.n < 2 or test.n < 2:
+        return 1.0
+    variance_of_difference = control.variance / control.n + test.variance / test.n
+    if not variance_of_difference > 0:
+        return 1.0
+    mixture_variance = mixture_sd ** 2 * (control.variance + test.variance) / 2
+    difference = test.mean - control.mean
+    log_likelihood_ratio = (0.5 * np.log(variance_of_difference / (variance_of_difference + mixture_variance)) +
+                            difference ** 2 * mixture_variance /
+                            (2 * variance_of_difference * (variance_of_difference + mixture_variance)))
+    return float(min(1.0, np.exp(-log_likelihood_ratio)))
+
+
+class SequentialMetricState:
+    def __init__(self, operation: AggregationOperation, num_users: int, group_codes: np.ndarray, num_groups: int):
+        """
+        Running state of a single metric: raw per-user aggregates (event count or attribute sum) and
+        the moments of the per-user metric values of every group.
+
+        :param operation: The aggregation operation of the metric.
+        :param num_users: Number of allocated users.
+        :param group_codes: Group code of every allocated user.
+        :param num_groups: Number of groups.
+        """
+        self.operation = operation
+        self.raw = np.zeros(num_users)
+        self.n = np.bincount(group_codes, minlength=num_groups).astype(float)
+        self.total = np.zeros(num_groups)
+        self.total_sq = np.zeros(num_groups)
+        # running minimum of the always-valid p-values of every test group
+        self.p_values: Dict[str, float] = {}
+
+    def _values(self, raw: np.ndarray) -> np.ndarray:
+        if self.operation == AggregationOperation.CONVERSION:
+            return (raw > 0).astype(float)
+        return raw
+
+    def add_users(self, group_codes: np.ndarray, num_groups: int):
+        """
+        Adds newly allocated users. They have no events yet, so only the number of observations changes.
+        :param group_codes: Group code of every new user.
+        :param num_groups: Number of groups, including new ones.
+        """
+        self._resize_groups(num_groups)
+        self.raw = np.concatenate([self.raw, np.zeros(len(group_codes))])
+        self.n += np.bincount(group_codes, minlength=num_groups)
+
+    def _resize_groups(self, num_groups: int):
+        padding = num_groups - len(self.n)
+        if padding > 0:
+            self.n, self.total, self.total_sq = (np.pad(moment, (0, padding))
+                                                 for moment in (self.n, self.total, self.total_sq))
+
+    def update(self, positions: np.ndarray, deltas: np.ndarray, group_codes: np.ndarray):
+        """
+        Adds raw aggregates of new events to the users at the given positions. A user value changes from v to
+        v + d, so the sum of the group changes by d and the sum of squares by 2vd + d^2.
+
+        :param positions: Unique positions of the users with new events.
+        :param deltas: Raw aggregates of the new events of every user.
+        :param group_codes: Group code of every allocated user.
+        """
+        old_values = self._values(self.raw[positions])
+        self.raw[positions] += deltas
+        differences = self._values(self.raw[positions]) - old_values
+        codes = group_codes[positions]
+        self.total += np.bincount(codes, weights=differences, minlength=len(self.n))
+        self.total_sq += np.bincount(codes, weights=2 * old_values * differences + differences * differences,
+                                     minlength=len(self.n))
+
+    def moments(self, group_code: int) -> GroupMoments:
+        return GroupMoments(int(self.n[group_code]), self.total[group_code], self.total_sq[group_code])
+
+
+class SequentialState:
+    def __init__(self, mixture_sd: float = 0.1):
+        """
+        Persistent state of a sequential test. It keeps the allocated users, per-user aggregates and per-group
+        running moments of every metric, so that an update costs O(new events) instead of O(all events).
+        Events of users that are not allocated yet are kept as pending aggregates until the users are allocated.
+
+        :param mixture_sd: Standard deviation of the mSPRT mixture over effect sizes, in units of the metric
+                standard deviation.
+        """
+        if mixture_sd <= 0:
+            raise ValueError("mixture_sd must be a positive number")
+        self.mixture_sd = mixture_sd
+        self.userids = pd.Index([])
+        self.group_names: List[str] = []
+        self.group_codes = np.array([], dtype=np.int64)
+        self.metrics: Dict[tuple, SequentialMetricState] = {}
+        self.checkpoint: Optional[pd.Timestamp] = None
+        self.num_updates = 0
+        # | event_name (index) | userid (index) | __count | attribute_1 | ... and the time of the last pending event
+        self.pending_aggregates = pd.DataFrame(index=pd.MultiIndex.from_arrays([[], []],
+                                                                              names=["event_name", "userid"]))
+        self.pending_last = pd.Series(dtype=np.int64)
+
+    def sync_allocations(self, ab_test_allocations: pd.DataFrame):
+        """
+        Adds users that were allocated since the last update.
+        :param ab_test_allocations: DataFrame containing AB test allocations. Expected pandas format: |timestamp|userid (index)|abgroup|
+        """
+        new_users = ab_test_allocations.index.difference(self.userids, sort=False)
+        if len(new_users) == 0:
+            return
+        groups = ab_test_allocations.loc[new_users, "abgroup"]
+        self.group_names += [group for group in pd.unique(groups) if group not in self.group_names]
+        codes = pd.Index(self.group_names).get_indexer(groups)
+
+        self.userids = self.userids.append(new_users) if len(self.userids) > 0 else new_users
+        self.group_codes = np.concatenate([self.group_codes, codes])
+        for metric_state in self.metrics.values():
+            metric_state.add_users(codes, len(self.group_names))
+
+    def add_pending(self, aggregated: pd.DataFrame, last_times: pd.Series):
+        """
+        Keeps per-user aggregates of new events of users that are not allocated yet.
+        :param aggregated: DataFrame with format | event_name (index) | userid (index) | __count | attribute_1 | ...
+        :param last_times: int64 epoch nanoseconds of the last event of every user, indexed by user ID.
+        """
+        if aggregated.empty:
+            return
+        self.pending_aggregates = pd.concat([self.pending_aggregates, aggregated]).groupby(
+            level=["event_name", "userid"], observed=True).sum()
+        self.pending_last = pd.concat([self.pending_last, last_times]).groupby(level=0).max()
+
+    def resolve_pending(self, ab_test_allocations: pd.DataFrame) -> pd.DataFrame:
+        """
+        Removes pending aggregates of users that are allocated now and returns those of them that are intest.
+        Pending events of a user are intest events when the last of them happened at or after the allocation.
+        Pending events that span the allocation time cannot be told apart and all count as intest events.
+        :param ab_test_allocations: DataFrame containing AB test allocations. Expected pandas format: |timestamp|userid (index)|abgroup|
+        :return: DataFrame with format | event_name (index) | userid (index) | __count | attribute_1 | ...
+        """
+        allocated = self.pending_last.index.intersection(ab_test_allocations.index)
+        if len(allocated) == 0:
+            return self.pending_aggregates.iloc[:0]
+        allocation_times = to_epoch(ab_test_allocations.loc[allocated, "timestamp"])
+        intest_users = allocated[(allocation_times != NAT) & (self.pending_last.loc[allocated].to_numpy() >=
+                                                              allocation_times)]
+
+        userids = self.pending_aggregates.index.get_level_values("userid")
+        resolved = self.pending_aggregates[userids.isin(intest_users)]
+        self.pending_aggregates = self.pending_aggregates[~userids.isin(allocated)]
+        self.pending_last = self.pending_last.drop(allocated)
+        return resolved
+
+    def metric(self, key: tuple, operation: AggregationOperation) -> SequentialMetricState:
+        """
+        Returns the state of a metric, creating an empty one for metrics that were not tracked before.
+        :param key: MetricSpec.key of the metric.
+        :param operation: The aggregation operation of the metric.
+        """
+        if key not in self.metrics:
+            self.metrics[key] = SequentialMetricState(operation, len(self.userids), self.group_codes,
+                                                      len(self.group_names))
+        return self.metrics[key]
+
+    def update(self, key: tuple, operation: AggregationOperation, user_aggregates: pd.Series):
+        """
+        Folds per-user raw aggregates of new intest events into the state of a metric.
+        :param key: MetricSpec.key of the metric.
+        :param operation: The aggregation operation of the metric.
+        :param user_aggregates: Series with event counts or attribute sums indexed by userid.
+        """
+        metric_state = self.metric(key, operation)
+        positions = self.userids.get_indexer(user_aggregates.index)
+        known = positions >= 0
+        metric_state.update(positions[known], user_aggregates.to_numpy(dtype=float)[known], self.group_codes)
+
+    def p_values(self, key: tuple, control_group: str, test_groups: List[str]) -> List[float]:
+        """
+        Updates and returns always-valid p-values of a metric. The p-value of every test group is the running
+        minimum of the mSPRT p-values of all looks, so it never increases between updates.
+        :param key: MetricSpec.key of the metric.
+        :param control_group: Identifier for the control group. For example, 'A'.
+        :param test_groups: List of identifiers for the test groups. For example, ['B', 'C'].
+        """
+        metric_state = self.metrics[key]
+        control = self.group_moments(key, control_group)
+        for test_group in test_groups:
+            p_value = msprt_p_value(control, self.group_moments(key, test_group), self.mixture_sd)
+            metric_state.p_values[test_group] = min(metric_state.p_values.get(test_group, 1.0), p_value)
+        return [metric_state.p_values[test_group] for test_group in test_groups]
+
+    def group_moments(self, key: tuple, group: str) -> GroupMoments:
+        if group not in self.group_names:
+            return GroupMoments(0, 0.0, 0.0)
+        return self.metrics[key].moments(self.group_names.index(group))
+
+    def save(self, path: str):
+        """
+        Saves the state to a file. The file is replaced atomically, so an interrupted run keeps the previous state.
+        :param path: path to the state file
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "SequentialState":
+        """
+        Loads the state from a file or creates a new state if the file does not exist.
+        :param path: path to the state file
+        :param kwargs: Arguments of a new SequentialState.
+        """
+        if not os.path.exists(path):
+            return cls(**kwargs)
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def __repr__(self):
+        return (f"SequentialState(num_users={len(self.userids)}, metrics={list(self.metrics)}, "
+                f"pending_users={len(self.pending_last)}, checkpoint={self.checkpoint}, "
+                f"num_updates={self.num_updates})")
@@ -1,45 +1,84 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
-from typing import List, Union, Optional
+from typing import List, Union, Optional, Dict, Tuple
 
 import numpy as np
-from catboost import CatBoostRegressor
-from scipy import stats
-from sklearn.compose import ColumnTransformer
-from sklearn.dummy import DummyRegressor
-from sklearn.linear_model import LinearRegression
-
 import pandas as pd
-from sklearn.pipeline import Pipeline
-from category_encoders import TargetEncoder
-from xgboost import XGBRegressor
+
+from ab_test_advanced_toolkit.model_cache import ModelCache
+from ab_test_advanced_toolkit.regressors import RegressorBackend, CatBoostBackend, CrossFitting, GBOOST_MODEL_PARAMS
+from ab_test_advanced_toolkit.moments import GroupMoments, CovariateMoments, MomentsMatrix, RatioMomentsMatrix
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+CORRECTIONS = ["holm", "bh"]
+
 
 class StatSignificanceMethod(Enum):
     CHI_SQUARE = auto()
     T_TEST = auto()
     PURE_CUPED_T_TEST = auto()
     GBOOST_CUPED_T_TEST = auto()
+    MSPRT = auto()
+    DELTA_METHOD_T_TEST = auto()
 
 
 class StatSignificanceResult:
-    def __init__(self, method_used: StatSignificanceMethod, p_values: List[float]):
+    def __init__(self, method_used: StatSignificanceMethod, p_values: List[float],
+                 adjusted_p_values: Optional[List[float]] = None, correction: Optional[str] = None):
         """
         Initializes the StatSignificanceResult with the method used, p-values for each test group.
 
         :param method_used: The statistical test method used.
         :param p_values: A list of p-values corresponding to each test group comparison with the control group.
+        :param adjusted_p_values: Optional p-values adjusted for multiple testing, see StatTests.apply_correction.
+        :param correction: Multiple testing correction of the adjusted p-values ("holm" or "bh").
         """
         self.method_used = method_used
         self.p_values = p_values
+        self.adjusted_p_values = adjusted_p_values
+        self.correction = correction
 
     def __repr__(self):
+        if self.correction is not None:
+            return (f"StatSignificanceResult(method_used={self.method_used}, p_values={self.p_values}, "
+                    f"adjusted_p_values={self.adjusted_p_values}, correction={self.correction})")
         return f"StatSignificanceResult(method_used={self.method_used}, p_values={self.p_values})"
 
 
+def adjust_p_values(p_values, method: str) -> np.ndarray:
+    """
+    Adjusts p-values of one family of comparisons for multiple testing. All p-values are sorted once and the
+    step-down (Holm) or step-up (Benjamini-Hochberg) adjustment is a cumulative maximum or minimum over them.
+    Missing p-values are not part of the family and stay missing.
+
+    :param p_values: Array of p-values of any shape. For example, (metrics x test groups).
+    :param method: "holm" controls the family-wise error rate (Holm-Bonferroni), "bh" controls the false
+            discovery rate (Benjamini-Hochberg).
+    :return: array of adjusted p-values of the same shape
+    """
+    if method not in CORRECTIONS:
+        raise ValueError(f"Unknown multiple testing correction: {method}. Available corrections: {CORRECTIONS}")
+    p_values = np.asarray(p_values, dtype=np.float64)
+    flat = p_values.ravel()
+    adjusted = np.full(flat.shape, np.nan)
+
+    observed = np.flatnonzero(~np.isnan(flat))
+    order = observed[np.argsort(flat[observed], kind="stable")]
+    num_tests = len(order)
+    ranks = np.arange(1, num_tests + 1)
+    if method == "holm":
+        stepped = np.maximum.accumulate((num_tests - ranks + 1) * flat[order])
+    else:
+        stepped = np.minimum.accumulate((num_tests / ranks * flat[order])[::-1])[::-1]
+    adjusted[order] = np.minimum(stepped, 1.0)
+    return adjusted.reshape(p_values.shape)
+
+
 class ZeroPredictor:
     def fit(self, X, y):
         # This model doesn't need to learn anything, so `fit` is a no-op
@@ -50,7 +89,218 @@ class ZeroPredictor:
         return np.zeros(len(X))
 
 
+class OutOfFoldPredictor:
+    def __init__(self, predictions: np.ndarray):
+        """
+        Cross-fitted predictions of all users. Every user is predicted by a model that was not trained on them,
+        so predictions are used as they are instead of being recomputed from features.
+
+        :param predictions: Out-of-fold predictions aligned with the pretest data.
+        """
+        self.predictions = predictions
+
+
+def _group_codes(groups, group_names: List[str]) -> np.ndarray:
+    """
+    :return: position of the group of every user in group_names, -1 for users of other groups
+    """
+    if isinstance(groups, pd.Series) and isinstance(groups.dtype, pd.CategoricalDtype):
+        # only the categories are looked up; missing groups (code -1) take the appended -1
+        category_codes = pd.Index(group_names).get_indexer(groups.cat.categories)
+        return np.append(category_codes, -1)[groups.cat.codes.to_numpy()]
+    return pd.Index(group_names).get_indexer(np.asarray(groups))
+
+
 class StatTests:
+    @staticmethod
+    def welch_t_test_from_moments(control_moments: GroupMoments, test_moments: GroupMoments) -> float:
+        """
+        Calculates the two-sided p-value of Welch's T-test using only the moments of both samples.
+        The result is the same as scipy.stats.ttest_ind(control_values, test_values, equal_var=False).
+
+        :param control_moments: GroupMoments of the control group.
+        :param test_moments: GroupMoments of the test group.
+        :return: p-value
+        """
+        return float(StatTests.welch_t_test_vectorized(control_moments.n, control_moments.mean,
+                                                       control_moments.variance, test_moments.n,
+                                                       test_moments.mean, test_moments.variance))
+
+    @staticmethod
+    def welch_t_test_vectorized(control_n, control_mean, control_variance, test_n, test_mean,
+                                test_variance) -> np.ndarray:
+        """
+        Calculates two-sided p-values of Welch's T-test for many pairs of samples at once.
+        All arguments are broadcastable arrays of sample sizes, means and unbiased variances.
+        :return: array of p-values
+        """
+        # scipy.special is imported on first use: it is much lighter than scipy.stats and stdtr is the kernel
+        # behind scipy.stats.t.sf
+        from scipy.special import stdtr
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            control_error = np.asarray(control_variance, dtype=np.float64) / control_n
+            test_error = np.asarray(test_variance, dtype=np.float64) / test_n
+            standard_error_sq = control_error + test_error
+            t_statistic = (np.asarray(control_mean, dtype=np.float64) - test_mean) / np.sqrt(standard_error_sq)
+            degrees_of_freedom = standard_error_sq ** 2 / (
+                    control_error ** 2 / (np.asarray(control_n, dtype=np.float64) - 1) +
+                    test_error ** 2 / (np.asarray(test_n, dtype=np.float64) - 1))
+        return 2 * stdtr(degrees_of_freedom, -np.abs(t_statistic))
+
+    @staticmethod
+    def calculate_t_test_for_moments_matrix(moments: MomentsMatrix, control_group_code: int,
+                                            test_group_codes: List[int]) -> np.ndarray:
+        """
+        Calculates Welch's T-test of every test group against the control group in every row of a moments matrix.
+        :param moments: MomentsMatrix of shape (rows, groups).
+        :param control_group_code: Column of the control group.
+        :param test_group_codes: Columns of the test groups.
+        :return: array of p-values of shape (rows, test groups)
+        """
+        n, mean, variance = moments.n, moments.mean, moments.variance
+        control = [control_group_code]
+        return StatTests.welch_t_test_vectorized(n[:, control], mean[:, control], variance[:, control],
+                                                 n[:, test_group_codes], mean[:, test_group_codes],
+                                                 variance[:, test_group_codes])
+
+    @staticmethod
+    def compare_moments_matrix(moments: Union[MomentsMatrix, RatioMomentsMatrix],
+                               methods: Union[StatSignificanceMethod, List[StatSignificanceMethod]],
+                               correction: Optional[str] = None) -> List[StatSignificanceResult]:
+        """
+        Compares every test group with the control group in every row of a (metrics x groups) moments matrix.
+        All Welch's T-tests are calculated with one vectorized expression, so the cost of many metrics and many
+        test groups is a few array operations.
+
+        :param moments: MomentsMatrix or RatioMomentsMatrix of shape (metrics, groups). Column 0 is the control group
+                and the other columns are the test groups, see group_moments_row and ratio_moments_row.
+        :param methods: The method reported for every row, or one method for all rows.
+        :param correction: Optional multiple testing correction ("holm" or "bh") across the whole
+                (metrics x test groups) matrix of p-values.
+        :return: StatSignificanceResult of every row
+        """
+        num_rows, num_groups = moments.n.shape
+        if isinstance(methods, StatSignificanceMethod):
+            methods = [methods] * num_rows
+        p_values = StatTests.calculate_t_test_for_moments_matrix(moments, 0, list(range(1, num_groups)))
+        results = [StatSignificanceResult(method, row.tolist()) for method, row in zip(methods, p_values)]
+        if correction is not None:
+            StatTests.apply_correction(results, correction)
+        return results
+
+    @staticmethod
+    def apply_correction(results: List[StatSignificanceResult], correction: str):
+        """
+        Adjusts the p-values of several results for multiple testing as one family of comparisons and
+        stores them in adjusted_p_values of every result.
+        :param results: StatSignificanceResult instances, for example of all metrics calculated together.
+        :param correction: "holm" or "bh", see adjust_p_values.
+        """
+        adjusted = adjust_p_values([p_value for result in results for p_value in result.p_values], correction)
+        position = 0
+        for result in results:
+            result.adjusted_p_values = adjusted[position:position + len(result.p_values)].tolist()
+            result.correction = correction
+            position += len(result.p_values)
+
+    @staticmethod
+    def group_moments_row(values, groups, group_names: List[str]) -> MomentsMatrix:
+        """
+        Calculates moments of per-user values in every group as a MomentsMatrix of shape (1, groups).
+        Rows of several metrics are stacked with MomentsMatrix.stack and compared with compare_moments_matrix.
+        :param values: Per-user values.
+        :param groups: Group of every user.
+        :param group_names: Groups in the order of the columns. Users of other groups are ignored.
+        """
+        values = np.asarray(values, dtype=float)
+        return MomentsMatrix.from_codes(np.zeros(len(values), dtype=np.int64), _group_codes(groups, group_names),
+                                        values, 1, len(group_names))
+
+    @staticmethod
+    def ratio_moments_row(numerators, denominators, groups, group_names: List[str]) -> RatioMomentsMatrix:
+        """
+        Calculates covariance moments of per-user numerators and denominators of a ratio metric in every group
+        as a RatioMomentsMatrix of shape (1, groups).
+        :param numerators: Per-user numerators.
+        :param denominators: Per-user denominators.
+        :param groups: Group of every user.
+        :param group_names: Groups in the order of the columns. Users of other groups are ignored.
+        """
+        return RatioMomentsMatrix.from_codes(np.zeros(len(numerators), dtype=np.int64),
+                                             _group_codes(groups, group_names), numerators, denominators, 1,
+                                             len(group_names))
+
+    @staticmethod
+    def calculate_delta_method_t_test(merged_intest: pd.DataFrame, control_group: str,
+                                      test_groups: List[str]) -> StatSignificanceResult:
+        """
+        Compares ratio metrics sum(numerator) / sum(denominator) of the test groups with the control group.
+        The variance of the ratio of every group comes from its covariance moments with the delta method,
+        and the ratios are compared with Welch's T-test.
+
+        :param merged_intest: DataFrame containing the intest data. Expected pandas format: | userid (index) | abgroup | numerator | denominator |
+        :param control_group: Identifier for the control group. For example, 'A'.
+        :param test_groups: List of identifiers for the test groups. For example, ['B', 'C'].
+        :return: StatSignificanceResult instance with p-values and the method used.
+        """
+        numerator_column, denominator_column = merged_intest.columns[-2:]
+        moments = StatTests.ratio_moments_row(merged_intest[numerator_column], merged_intest[denominator_column],
+                                              merged_intest['abgroup'], [control_group] + test_groups)
+        return StatTests.compare_moments_matrix(moments, StatSignificanceMethod.DELTA_METHOD_T_TEST)[0]
+
+    @staticmethod
+    def linearize_ratio(merged_intest: pd.DataFrame, control_group: str, test_groups: List[str],
+                        value_column: str = "ratio") -> pd.DataFrame:
+        """
+        Replaces the numerators and denominators of a ratio metric with per-user linearized values
+        ratio + (numerator - ratio * denominator) / mean(denominator), with the ratio and the mean denominator
+        of the group of the user. The mean of the linearized values of a group is its ratio and the variance of
+        the mean is the delta-method variance of the ratio, so they can be variance-reduced with CUPED like
+        any other per-user metric.
+
+        :param merged_intest: DataFrame containing the intest data. Expected pandas format: | userid (index) | abgroup | numerator | denominator |
+        :param control_group: Identifier for the control group. For example, 'A'.
+        :param test_groups: List of identifiers for the test groups. For example, ['B', 'C'].
+        :param value_column: The name of the column with linearized values.
+        :return: DataFrame with format | userid (index) | abgroup | value_column |. Users of other groups are NaN.
+        """
+        numerator_column, denominator_column = merged_intest.columns[-2:]
+        numerators = merged_intest[numerator_column].to_numpy(dtype=float)
+        denominators = merged_intest[denominator_column].to_numpy(dtype=float)
+        group_names = [control_group] + test_groups
+        group_codes = _group_codes(merged_intest['abgroup'], group_names)
+
+        moments = RatioMomentsMatrix.from_codes(np.zeros(len(numerators), dtype=np.int64), group_codes, numerators,
+                                                denominators, 1, len(group_names))
+        # users of other groups (code -1) take the appended NaN
+        ratio = np.append(moments.mean[0], np.nan)[group_codes]
+        denominator_mean = np.append(moments.denominator_mean[0], np.nan)[group_codes]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            linearized = ratio + (numerators - ratio * denominators) / denominator_mean
+        return pd.DataFrame({'abgroup': merged_intest['abgroup'], value_column: linearized}, index=merged_intest.index)
+
+    @staticmethod
+    def calculate_t_test_from_moments(moments: Dict[str, GroupMoments], control_group: str,
+                                      test_groups: List[str],
+                                      method: StatSignificanceMethod = StatSignificanceMethod.T_TEST
+                                      ) -> StatSignificanceResult:
+        """
+        Calculates Welch's T-test for each test group compared to the control group from precomputed moments.
+
+        :param moments: dictionary with GroupMoments for every group. For example, {'A': GroupMoments(...), ...}
+        :param control_group: Identifier for the control group. For example, 'A'.
+        :param test_groups: List of identifiers for the test groups. For example, ['B', 'C'].
+        :param method: The method reported in the result.
+        :return: StatSignificanceResult instance with p-values and the method used.
+        """
+        empty = GroupMoments(0, 0.0, 0.0)
+        group_moments = [moments.get(group, empty) for group in [control_group] + test_groups]
+        matrix = MomentsMatrix(np.array([[group.n for group in group_moments]]),
+                               np.array([[group.total for group in group_moments]], dtype=float),
+                               np.array([[group.total_sq for group in group_moments]], dtype=float))
+        return StatTests.compare_moments_matrix(matrix, method)[0]
+
     @staticmethod
     def calculate_t_test_for_dataset(merged_intest: pd.DataFrame, control_group: str,
                                      test_groups: List[str]) -> StatSignificanceResult:
@@ -64,70 +314,60 @@ class StatTests:
         :return: StatSignificanceResult instance with p-values and the method used.
         """
         value_column = merged_intest.columns[-1]
-        p_values = []
-        control_values = merged_intest[merged_intest['abgroup'] == control_group][value_column]
-        for test_group in test_groups:
-            test_values = merged_intest[merged_intest['abgroup'] == test_group][value_column]
+        moments = StatTests.group_moments_row(merged_intest[value_column], merged_intest['abgroup'],
+                                              [control_group] + test_groups)
+        return StatTests.compare_moments_matrix(moments, StatSignificanceMethod.T_TEST)[0]
+
+    @staticmethod
+    def cuped_adjusted_values(merged_pretest: pd.DataFrame, merged_intest: pd.DataFrame, control_group: str,
+                              covariate_moments: Optional[CovariateMoments] = None) -> np.ndarray:
+        """
+        CUPED-adjusted intest values of all users, see calculate_cuped_and_compare.
+        :return: array of adjusted values aligned with merged_intest
+        """
+        value_column = merged_intest.columns[-1]
+        covariate_columns = [column for column in merged_pretest.columns if column != 'abgroup']
+
+        pretest_values = merged_pretest[covariate_columns].to_numpy(dtype=float)
+        intest_values = merged_intest[value_column].to_numpy(dtype=float)
 
-            _, p_value = stats.ttest_ind(control_values, test_values, equal_var=False, nan_policy='omit')
-            p_values.append(p_value)
+        if covariate_moments is None:
+            control_mask = (merged_intest['abgroup'] == control_group).to_numpy()
+            covariate_moments = CovariateMoments.from_values(pretest_values[control_mask], intest_values[control_mask])
+        logger.debug(f"CUPED coefficients: {covariate_moments.theta}")
 
-        return StatSignificanceResult(StatSignificanceMethod.T_TEST, p_values)
+        # Adjust control and test groups in one broadcast
+        return intest_values - covariate_moments.intercept - pretest_values @ covariate_moments.theta
 
     @staticmethod
     def calculate_cuped_and_compare(merged_pretest: pd.DataFrame, merged_intest: pd.DataFrame, control_group: str,
-                                    test_groups: List[str]) -> StatSignificanceResult:
+                                    test_groups: List[str],
+                                    covariate_moments: Optional[CovariateMoments] = None) -> StatSignificanceResult:
         """
         Calculate the CUPED adjustment and compare the adjusted test group values to the control group using T-tests.
-        :param merged_pretest: DataFrame containing the pretest data. Expected pandas format: | userid (index) | abgroup | value_column |
+        The CUPED coefficients are calculated in closed form from the moments of the control group,
+        theta = Var(X)^-1 Cov(X, Y), and all groups are adjusted at once.
+        :param merged_pretest: DataFrame containing the pretest data. Expected pandas format: | userid (index) | abgroup | covariate_1 | covariate_2 | ...
+                Every column except 'abgroup' is used as a pretest covariate.
         :param merged_intest: DataFrame containing the intest data. Expected pandas format: | userid (index) | abgroup | value_column |
         :param control_group: Identifier for the control group. For example, 'A'.
         :param test_groups: List of identifiers for the test groups. For example, ['B', 'C'].
+        :param covariate_moments: Optional precomputed (e.g. streamed) CovariateMoments of the control group.
+                When given, the coefficients are taken from it instead of being calculated from merged data.
         :return:
         """
-        value_column = merged_pretest.columns[-1]
-        # Extract control group pretest and intest values for the regression model
-        control_pretest_values = merged_pretest[merged_pretest['abgroup'] == control_group][
-            value_column].values.reshape(-1, 1)
-        control_intest_values = merged_intest[merged_intest['abgroup'] == control_group][value_column].values
-
-        # Fit linear regression model on control group data
-        model = LinearRegression()
-        model.fit(control_pretest_values, control_intest_values)
-        logger.debug(f"Control pretest values: {control_pretest_values}")
-        logger.debug(f"Control intest values: {control_intest_values}")
-        logger.debug(f"Model coefficients: {model.coef_}")
-        adjusted_control_values = control_intest_values - model.predict(control_pretest_values)
-
-        # Initialize lists for storing p-values and test group names
-        p_values = []
-        test_group_names = []
-
-        # Iterate over test groups to perform adjustments and T-tests
-        for test_group in test_groups:
-            test_group_names.append(test_group)
-
-            # Apply model to test group pretest values
-            test_pretest_values = merged_pretest[merged_pretest['abgroup'] == test_group][value_column].values.reshape(
-                -1, 1)
-            test_intest_values = merged_intest[merged_intest['abgroup'] == test_group][value_column].values
-
-            # Calculate the adjusted values for the test group
-            predicted_test_intest_values = model.predict(test_pretest_values)
-            adjusted_test_values = test_intest_values - predicted_test_intest_values
-
-            # Perform T-test between adjusted control and test group values
-            _, p_value = stats.ttest_ind(
-                adjusted_control_values,
-                adjusted_test_values, equal_var=False)
-            p_values.append(p_value)
-
-        return StatSignificanceResult(StatSignificanceMethod.PURE_CUPED_T_TEST, p_values)
+        adjusted_values = StatTests.cuped_adjusted_values(merged_pretest, merged_intest, control_group,
+                                                          covariate_moments)
+        moments = StatTests.group_moments_row(adjusted_values, merged_intest['abgroup'], [control_group] + test_groups)
+        return StatTests.compare_moments_matrix(moments, StatSignificanceMethod.PURE_CUPED_T_TEST)[0]
 
     @staticmethod
     def calculate_gboost_cuped_and_compare(merged_pretest: pd.DataFrame, merged_intest: pd.DataFrame,
                                              user_properties: Optional[pd.DataFrame], control_group: str,
-                                             test_groups: List[str], use_enhansement: bool = False) -> StatSignificanceResult:
+                                             test_groups: List[str], use_enhansement: bool = False,
+                                             model_cache: Optional[ModelCache] = None,
+                                             regressor: Optional[RegressorBackend] = None,
+                                             cross_fitting: Optional[CrossFitting] = None) -> StatSignificanceResult:
         """
         Calculate the CUPED adjustment and compare the adjusted test group values to the control group using T-tests.
         :param merged_pretest: DataFrame containing the pretest data. Expected pandas format: | userid (index) | abgroup | value_column |
@@ -135,6 +375,10 @@ class StatTests:
         :param user_properties: DataFrame containing user properties. Expected pandas format: | userid (index) | property1 | property2 | ...
         :param control_group: Identifier for the control group. For example, 'A'.
         :param test_groups: List of identifiers for the test groups. For example, ['B', 'C'].
+        :param model_cache: Optional ModelCache. Models fitted on the same training data are reused from it.
+        :param regressor: Optional RegressorBackend that fits the model. The default is CatBoost.
+        :param cross_fitting: Optional CrossFitting. Every user is then predicted by a model that was trained on
+                other folds of users instead of one model trained on all users.
         :return:
         """
         # Ensure `value_column` is defined to match your actual data structure
@@ -151,56 +395,199 @@ class StatTests:
                 categorical_features = []
             return X, categorical_features
 
-        control_pretest_data = merged_pretest[merged_pretest['abgroup'] == control_group]
-
-        X_control, categorical_features = prepare_dataset(control_pretest_data, user_properties)
-
-        # model = CatBoostRegressor(loss_function='RMSE', cat_features=categorical_features, verbose=False)
-        model = CatBoostRegressor(iterations=500, learning_rate=0.1, depth=4, loss_function='RMSE', cat_features=categorical_features)
+        regressor = regressor or CatBoostBackend()
 
         logger.debug(f"use_enhansement: {use_enhansement}")
+        model = ZeroPredictor()
         if use_enhansement:
             try:
-                logger.debug(f"X_control: {X_control}")
-                logger.debug(f"merged_intest[merged_intest['abgroup'] == control_group][value_column]: {merged_intest[merged_intest['abgroup'] == control_group][value_column]}")
-                x_ = X_control.copy()
-                x_.reset_index(drop=True, inplace=True)
-
-                y_ = merged_intest[merged_intest['abgroup'] == control_group][value_column].copy()
-                y_.reset_index(drop=True, inplace=True)
-
-                x_train, _ = prepare_dataset(merged_pretest, user_properties)
-                y_train = merged_intest[value_column]
-                model.fit(x_train.reset_index(drop=True), y_train.reset_index(drop=True), verbose=False)
+                x_train, categorical_features = prepare_dataset(merged_pretest, user_properties)
+                x_train = x_train.reset_index(drop=True)
+                y_train = merged_intest[value_column].reset_index(drop=True)
+
+                def fit_model():
+                    return regressor.fit(x_train, y_train, categorical_features)
+
+                if cross_fitting is not None:
+                    predictions = cross_fitting.predict_out_of_fold(regressor, x_train, y_train, categorical_features,
+                                                                    merged_pretest['abgroup'].to_numpy(), model_cache)
+                    model = OutOfFoldPredictor(predictions)
+                elif model_cache is not None:
+                    model_params = dict(regressor.model_params, cat_features=categorical_features)
+                    model = model_cache.get_or_fit(ModelCache.fingerprint(x_train, y_train, model_params), fit_model)
+                else:
+                    model = fit_model()
 
                 logger.debug(f"Model was fit")
             except Exception as e:
                 logger.error(f"Model was not fit. Error: {e}")
                 # this case is equivalent o regular T-test
                 model = ZeroPredictor()
+
+        # All users are adjusted with one prediction and compared with one vectorized T-test,
+        # instead of masking the pretest and intest data of every group
+        if isinstance(model, OutOfFoldPredictor):
+            y_predicted = model.predictions
+        elif isinstance(model, ZeroPredictor):
+            y_predicted = 0.0
+        else:
+            y_predicted = model.predict(x_train)
+        adjusted_values = merged_intest[value_column].to_numpy(dtype=float) - y_predicted
+
+        moments = StatTests.group_moments_row(adjusted_values, merged_intest['abgroup'], [control_group] + test_groups)
+        return StatTests.compare_moments_matrix(moments, StatSignificanceMethod.GBOOST_CUPED_T_TEST)[0]
+
+
+POISSON_TABLE_BITS = 16
+_poisson_cdf: Optional[np.ndarray] = None
+_poisson_table: Optional[np.ndarray] = None
+
+
+def _poisson_weights(rng: np.random.Generator, size: Tuple[int, int]) -> np.ndarray:
+    """
+    Draws Poisson(1) weights by inverse transform of 16-bit random integers through a lookup table,
+    which is several times faster than Generator.poisson. Every entry of the table covers 1/65536 of the
+    probability. The few entries whose range contains a step of the Poisson CDF, including the tail of weights
+    of 8 and more, are NaN; draws of these entries are resolved with a uniform number within the range of
+    the entry, so the weights follow Poisson(1) exactly up to P(weight >= 20) < 1e-18.
+    """
+    global _poisson_cdf, _poisson_table
+    if _poisson_table is None:
+        k = np.arange(20)
+        _poisson_cdf = np.cumsum(np.exp(-1) / np.array([math.factorial(i) for i in k], dtype=float))
+        bounds = np.arange(2 ** POISSON_TABLE_BITS + 1) / 2 ** POISSON_TABLE_BITS
+        # weight of u is the number of CDF steps at or below u; it is constant on [low, high) without a step inside
+        low_weights = np.searchsorted(_poisson_cdf, bounds[:-1], side="right")
+        high_weights = np.searchsorted(_poisson_cdf, bounds[1:], side="left")
+        _poisson_table = np.where(low_weights == high_weights, low_weights, np.nan)
+
+    indices = rng.integers(0, 2 ** POISSON_TABLE_BITS, size=size, dtype=np.uint16)
+    weights = np.take(_poisson_table, indices)
+    ambiguous = np.isnan(weights)
+    if ambiguous.any():
+        quantiles = (indices[ambiguous] + rng.random(np.count_nonzero(ambiguous))) / 2 ** POISSON_TABLE_BITS
+        weights[ambiguous] = np.searchsorted(_poisson_cdf, quantiles, side="right")
+    return weights
+
+
+class BootstrapEngine:
+    def __init__(self, n_replicates: int = 1000, confidence_level: float = 0.95, weights: str = "poisson",
+                 max_block_elements: int = 50_000_000, n_jobs: int = 1, seed: Optional[int] = None):
+        """
+        Vectorized bootstrap of group means. Resampling weights are drawn as a (replicates x users) matrix in
+        memory-bounded blocks and the means of all replicates in a block are calculated with one matrix product.
+
+        :param n_replicates: Number of bootstrap replicates.
+        :param confidence_level: Confidence level of the intervals. For example, 0.95.
+        :param weights: "poisson" for the Poisson bootstrap (independent Poisson(1) weights per user) or
+                "multinomial" for a blocked bootstrap: users are split into consecutive blocks of at most
+                max_block_elements / replicates users and resampled with replacement within every block. It is
+                the classic bootstrap when all users fit into one block; with several blocks every block keeps
+                its size in every replicate, like strata.
+        :param max_block_elements: Maximum number of weights in memory per block and worker.
+        :param n_jobs: Number of threads that process blocks in parallel. -1 uses all available cores.
+        :param seed: Seed of the random generator.
+        """
+        if weights not in ("poisson", "multinomial"):
+            raise ValueError(f"Unsupported bootstrap weights: {weights}")
+        if not 0 < confidence_level < 1:
+            raise ValueError("confidence_level must be between 0 and 1")
+        self.n_replicates = n_replicates
+        self.confidence_level = confidence_level
+        self.weights = weights
+        self.max_block_elements = max_block_elements
+        self.n_jobs = (os.cpu_count() or 1) if n_jobs < 0 else n_jobs
+        self.seed = seed
+
+    def _block_means(self, values: np.ndarray, n_block_replicates: int, seed_sequence: np.random.SeedSequence) -> np.ndarray:
+        rng = np.random.default_rng(seed_sequence)
+        n_users = len(values)
+        # split users into column blocks so that a block never holds more than max_block_elements weights
+        users_per_block = max(1, self.max_block_elements // max(n_block_replicates, 1))
+        weighted_sums = np.zeros(n_block_replicates)
+        weight_sums = np.zeros(n_block_replicates)
+        for start in range(0, n_users, users_per_block):
+            block_values = values[start:start + users_per_block]
+            if self.weights == "poisson":
+                block_weights = _poisson_weights(rng, (n_block_replicates, len(block_values)))
+                weighted_sums += block_weights @ block_values
+                weight_sums += block_weights.sum(axis=1)
+            else:
+                # resampling with replacement within the block of users
+                resampled = block_values[rng.integers(0, len(block_values), size=(n_block_replicates, len(block_values)))]
+                weighted_sums += resampled.sum(axis=1)
+                weight_sums += len(block_values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return weighted_sums / weight_sums
+
+    def replicate_means(self, values, seed_sequence: Optional[np.random.SeedSequence] = None) -> np.ndarray:
+        """
+        Calculates means of the values in every bootstrap replicate.
+        :param values: array-like of per-user values
+        :param seed_sequence: Optional SeedSequence for the random weights.
+        :return: array of shape (n_replicates,)
+        """
+        values = np.asarray(values, dtype=float)
+        seed_sequence = seed_sequence or np.random.SeedSequence(self.seed)
+        if len(values) == 0:
+            return np.full(self.n_replicates, np.nan)
+
+        replicates_per_block = max(1, min(self.n_replicates, self.max_block_elements // len(values)))
+        block_sizes = [min(replicates_per_block, self.n_replicates - start)
+                       for start in range(0, self.n_replicates, replicates_per_block)]
+        block_seeds = seed_sequence.spawn(len(block_sizes))
+
+        if self.n_jobs > 1 and len(block_sizes) > 1:
+            # numpy releases the GIL in matrix products, so threads process blocks in parallel without copying values
+            with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+                blocks = list(executor.map(lambda args: self._block_means(values, *args), zip(block_sizes, block_seeds)))
         else:
-            model = ZeroPredictor()
-
-        adjusted_values = {}
-        p_values = []
-        test_group_names = []
-
-        # Adjust and calculate deltas for control and test groups
-        for group in [control_group] + test_groups:
-            group_pretest_data, _ = prepare_dataset(merged_pretest[merged_pretest['abgroup'] == group], user_properties)
-            group_intest_data = merged_intest[merged_intest['abgroup'] == group][value_column]
-
-            if not group_pretest_data.empty and model is not None:
-                y_predicted = model.predict(group_pretest_data)
-                adjusted_values[group] = group_intest_data.values - y_predicted
-
-        # Perform T-tests for statistical significance between control and test group adjustments
-        for test_group in test_groups:
-            if test_group in adjusted_values and control_group in adjusted_values:
-                _, p_value = stats.ttest_ind(adjusted_values[control_group], adjusted_values[test_group],
-                                             equal_var=False)
-                p_values.append(p_value)
-                test_group_names.append(test_group)
-
-        # Assuming StatSignificanceResult is a structure you've defined to store the results
-        return StatSignificanceResult(StatSignificanceMethod.GBOOST_CUPED_T_TEST, p_values)
+            blocks = [self._block_means(values, size, block_seed) for size, block_seed in zip(block_sizes, block_seeds)]
+        return np.concatenate(blocks)
+
+    def relative_lift_interval(self, control_values, test_values,
+                               seed_sequence: Optional[np.random.SeedSequence] = None) -> Tuple[float, float]:
+        """
+        Calculates the percentile confidence interval of the relative lift mean(test) / mean(control) - 1.
+        :param control_values: array-like of per-user values of the control group
+        :param test_values: array-like of per-user values of the test group
+        :param seed_sequence: Optional SeedSequence for the random weights.
+        :return: lower and upper bound of the interval
+        """
+        control_seed, test_seed = (seed_sequence or np.random.SeedSequence(self.seed)).spawn(2)
+        return self._lift_interval(self.replicate_means(control_values, control_seed),
+                                   self.replicate_means(test_values, test_seed))
+
+    def _lift_interval(self, control_means: np.ndarray, test_means: np.ndarray) -> Tuple[float, float]:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lifts = test_means / control_means - 1
+        lifts = lifts[np.isfinite(lifts)]
+        if len(lifts) == 0:
+            return np.nan, np.nan
+        alpha = 1 - self.confidence_level
+        low, high = np.quantile(lifts, [alpha / 2, 1 - alpha / 2])
+        return float(low), float(high)
+
+    def calculate_confidence_intervals(self, merged_intest: pd.DataFrame, control_group: str,
+                                       test_groups: List[str]) -> Dict[str, Tuple[float, float]]:
+        """
+        Calculates confidence intervals of the relative lift of every test group compared to the control group.
+        :param merged_intest: DataFrame containing the intest data. Expected pandas format: | userid (index) | abgroup | value_column |
+        :param control_group: Identifier for the control group. For example, 'A'.
+        :param test_groups: List of identifiers for the test groups. For example, ['B', 'C'].
+        :return: dictionary with (lower bound, upper bound) of the relative lift for every test group
+        """
+        value_column = merged_intest.columns[-1]
+        values_by_group = {group: values.to_numpy(dtype=float) for group, values in
+                           merged_intest[value_column].groupby(merged_intest['abgroup'], observed=True)}
+        empty = np.array([])
+        control_seed, *test_seeds = np.random.SeedSequence(self.seed).spawn(len(test_groups) + 1)
+        # replicates of the control group are shared by all comparisons
+        control_means = self.replicate_means(values_by_group.get(control_group, empty), control_seed)
+        return {test_group: self._lift_interval(control_means,
+                                                self.replicate_means(values_by_group.get(test_group, empty), test_seed))
+                for test_group, test_seed in zip(test_groups, test_seeds)}
+
+    def __repr__(self):
+        return (f"BootstrapEngine(n_replicates={self.n_replicates}, confidence_level={self.confidence_level}, "
+                f"weights={self.weights})")
@@ -0,0 +1,107 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+from ab_test_advanced_toolkit.allocation_table import NAT
+
+# Largest (user code, timestamp rank) key that is packed into one int64
+MAX_PACKED_KEY = np.iinfo(np.int64).max
+
+
+class UserTimeline:
+    def __init__(self, codes: np.ndarray, event_times: np.ndarray, num_users: int,
+                 values: Optional[np.ndarray] = None):
+        """
+        Events sorted once by (user code, timestamp). Timestamps are replaced by their ranks among the distinct
+        event timestamps, so that (user code, rank) packs into one int64 key whose order is the order of
+        (user code, timestamp). The events of a user before and after any cutoff time are then contiguous and
+        the boundaries of all users are found with one vectorized np.searchsorted over the keys.
+        Several event names are handled at once by using (event name code, user code) pairs as user codes.
+        When the keys do not fit into int64, events are sorted with np.lexsort by (user code, timestamp) instead and
+        boundaries are found by sorting the cutoffs together with the events.
+
+        :param codes: Dense user codes of the events (AllocationTable.encode). Events of unknown users (-1) are dropped.
+        :param event_times: int64 epoch nanoseconds of the events (allocation_table.to_epoch). Events without a
+                timestamp (NAT) are dropped.
+        :param num_users: Number of users, or of (event name, user) pairs.
+        :param values: Optional 2D array with a row of values of every event to sum per user and period.
+        """
+        valid = (codes >= 0) & (event_times != NAT)
+        codes, event_times = codes[valid].astype(np.int64), event_times[valid]
+        self.unique_times, time_ranks = np.unique(event_times, return_inverse=True)
+        self.stride = len(self.unique_times) + 1
+        self.num_users = num_users
+        self.packed = (num_users + 1) * self.stride <= MAX_PACKED_KEY
+
+        if self.packed:
+            keys = codes * self.stride + time_ranks
+            order = np.argsort(keys)
+            self.keys = keys[order]
+            self.codes = self.times = None
+        else:
+            order = np.lexsort((event_times, codes))
+            self.keys = None
+            self.codes, self.times = codes[order], event_times[order]
+        self.values = values[valid][order] if values is not None else np.empty((len(order), 0))
+
+    def __len__(self):
+        return len(self.values)
+
+    def boundaries(self, cutoffs: np.ndarray) -> np.ndarray:
+        """
+        :param cutoffs: int64 epoch nanoseconds per user.
+        :return: position of the first event of every user at or after their cutoff in the sorted events
+        """
+        if self.packed:
+            ranks = np.searchsorted(self.unique_times, cutoffs, side="left")
+            return np.searchsorted(self.keys, np.arange(self.num_users) * self.stride + ranks, side="left")
+
+        # (user, cutoff) queries sorted together with the (code, time) events, before events with an equal pair;
+        # the query of user u follows the queries of the u users before it, the rest are events before the cutoff
+        users = np.arange(self.num_users)
+        merged_order = np.lexsort((np.concatenate([np.zeros(self.num_users, dtype=np.int8),
+                                                   np.ones(len(self.codes), dtype=np.int8)]),
+                                   np.concatenate([cutoffs, self.times]),
+                                   np.concatenate([users, self.codes])))
+        positions = np.empty(len(merged_order), dtype=np.int64)
+        positions[merged_order] = np.arange(len(merged_order))
+        return positions[:self.num_users] - users
+
+    def period_aggregates(self, allocation_times: np.ndarray, pretest_lookback: Optional[int] = None
+                          ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Counts events and sums values of every user in the pretest and intest periods in one np.add.reduceat pass.
+        Pretest is [allocation time - lookback, allocation time) and intest is [allocation time, ...).
+        Users without an allocation time have no events in either period.
+
+        :param allocation_times: int64 epoch nanoseconds of the allocation of every user (AllocationTable.timestamps).
+        :param pretest_lookback: Optional length of the pretest window in nanoseconds. None uses all earlier events.
+        :return: pretest counts, pretest sums, intest counts, intest sums; sums have a column per column of values
+        """
+        if self.packed:
+            user_starts = np.searchsorted(self.keys, np.arange(self.num_users + 1) * self.stride, side="left")
+        else:
+            user_starts = np.searchsorted(self.codes, np.arange(self.num_users + 1), side="left")
+        starts, ends = user_starts[:-1], user_starts[1:]
+        splits = self.boundaries(allocation_times)
+        if pretest_lookback is not None:
+            starts = self.boundaries(allocation_times - pretest_lookback)
+
+        unallocated = allocation_times == NAT
+        starts = np.where(unallocated, ends, starts)
+        splits = np.where(unallocated, ends, splits)
+
+        # segments [start, split), [split, end), [end, next start) of all users in one monotone index list;
+        # a zero row is appended so that the end of the last user is a valid index
+        indices = np.stack([starts, splits, ends], axis=1).ravel()
+        padded = np.concatenate([self.values, np.zeros((1, self.values.shape[1]))])
+        sums = np.add.reduceat(padded, indices, axis=0) if len(indices) > 0 else np.zeros((0, padded.shape[1]))
+
+        pretest_counts, intest_counts = splits - starts, ends - splits
+        # reduceat returns the value at the index instead of 0 for empty segments
+        pretest_sums = np.where((pretest_counts > 0)[:, None], sums[0::3], 0.0)
+        intest_sums = np.where((intest_counts > 0)[:, None], sums[1::3], 0.0)
+        return pretest_counts, pretest_sums, intest_counts, intest_sums
+
+    def __repr__(self):
+        return f"UserTimeline(num_events={len(self)}, num_users={self.num_users}, packed={self.packed})"
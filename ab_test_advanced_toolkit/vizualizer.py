@@ -1,5 +1,6 @@
+import json
 import math
-from typing import List
+from typing import Iterable, Iterator, List, TextIO
 
 from ab_test_advanced_toolkit.metrics import MetricType, Metric
 
@@ -9,29 +10,83 @@ def describe_metric(metric: Metric) -> str:
     params = metric.metricparams
 
     if metric_type == MetricType.EVENT_COUNT_PER_USER:
-        return f"Count of '{params.event_name}' events per user."
+        description = f"Count of '{params.event_name}' events per user."
 
     elif metric_type == MetricType.EVENT_ATTRIBUTE_SUM_PER_USER:
-        return f"Sum of '{params.attribute_name}' for '{params.event_name}' events per user."
+        description = f"Sum of '{params.attribute_name}' for '{params.event_name}' events per user."
 
     elif metric_type == MetricType.CONVERSION_RATE:
-        return f"Conversion rate to '{params.event_name}' event per user."
+        description = f"Conversion rate to '{params.event_name}' event per user."
+
+    elif metric_type == MetricType.RATIO:
+        def describe_aggregate(event_name, attribute_name):
+            if attribute_name is None:
+                return f"count of '{event_name}' events"
+            return f"sum of '{attribute_name}' for '{event_name}' events"
+
+        numerator = describe_aggregate(params.event_name, params.attribute_name)
+        denominator = describe_aggregate(params.denominator_event_name or params.event_name,
+                                         params.denominator_attribute_name)
+        description = f"Ratio of {numerator} to {denominator}."
 
     else:
         return "Unknown metric type."
 
+    if params.segment is not None:
+        description += f" Segment: {params.segment[0]} = {params.segment[1]}."
+    return description
+
 
-def format_metrics_to_html(metrics: List[Metric], control_group: str, test_groups: List[str]):
+def _get_color(pval, diff):
     # Helper function to determine the color based on p-value and difference
-    def get_color(pval, diff):
-        if pval > 0.05:
-            return 'grey'
-        if 0.01 < pval <= 0.05:
-            return 'lightgreen' if diff > 0 else 'lightcoral'
-        return 'green' if diff > 0 else 'red'
+    if not pval <= 0.05:
+        # not significant or not defined
+        return 'grey'
+    if 0.01 < pval <= 0.05:
+        return 'lightgreen' if diff > 0 else 'lightcoral'
+    return 'green' if diff > 0 else 'red'
+
+
+def _format_number(value, precision: int) -> str:
+    # means of segment cells without users and ratios with a zero denominator are NaN
+    return 'n/a' if math.isnan(value) else f'{value:.{precision}f}'
+
+
+def _format_metric_row(metric: Metric, control_group: str, test_groups: List[str]) -> str:
+    metric_name = describe_metric(metric)
+    control_value = metric.result.data[control_group]
+    cells = [f'<tr><td>{metric_name}</td>', f'<td>{_format_number(control_value, 2)}</td>']
+
+    for test_group in test_groups:
+        test_value = metric.result.data[test_group]
+        pval = metric.result.stat_significance[test_group]
+        diff = ((test_value - control_value) / control_value) * 100 if control_value != 0 else float('inf')
+        diff_text = _format_number(diff, 0) if control_value != 0 else '0'
+        title_text = f'P-value: {_format_number(pval, 4)}'
+        if metric.result.adjusted_p_values is not None:
+            # significance is judged by the p-value adjusted for multiple testing
+            pval = metric.result.adjusted_p_values[test_group]
+            title_text += f', adjusted ({metric.result.correction}): {_format_number(pval, 4)}'
+        color = _get_color(pval, diff)
+        confidence_intervals = metric.result.confidence_intervals
+        if confidence_intervals and test_group in confidence_intervals:
+            low, high = confidence_intervals[test_group]
+            title_text += f', CI: [{low * 100:.2f}%, {high * 100:.2f}%]'
+        cells.append(f'<td class="{color}" title="{title_text}">{_format_number(test_value, 2)}<br/>({diff_text}%)</td>')
+
+    cells.append('</tr>')
+    return ''.join(cells)
 
+
+def iter_metrics_html(metrics: Iterable[Metric], control_group: str, test_groups: List[str]) -> Iterator[str]:
+    """
+    Yields the HTML report piece by piece: the header, one table row per metric and the footer.
+    :param metrics: Iterable of calculated metrics. It can be a generator, metrics are consumed one at a time.
+    :param control_group: The name of the control group.
+    :param test_groups: The names of the test groups.
+    """
     # Start of the HTML string with enhanced styles for centering and aesthetics
-    html_str = '''
+    yield '''
     <style>
         body {display: flex; justify-content: center; margin: 0; height: 100vh; align-items: center;}
         table {border-collapse: collapse; width: 80%; margin: auto;}
@@ -47,28 +102,43 @@ def format_metrics_to_html(metrics: List[Metric], control_group: str, test_group
         tr:hover {background-color: #f5f5f5;}
     </style>
     <table>
-        <tr><th>Metric</th><th>''' + control_group + '''</th>'''
+        <tr><th>Metric</th><th>''' + control_group + '''</th>''' + ''.join(
+        '<th>' + test_group + '</th>' for test_group in test_groups) + '</tr>'
+
+    for metric in metrics:
+        yield _format_metric_row(metric, control_group, test_groups)
+        # segment slices follow the row of the whole metric
+        for segment_metric in metric.result.segments:
+            yield _format_metric_row(segment_metric, control_group, test_groups)
+
+    yield '</table>'
+
+
+def format_metrics_to_html(metrics: List[Metric], control_group: str, test_groups: List[str]) -> str:
+    return ''.join(iter_metrics_html(metrics, control_group, test_groups))
+
+
+def write_metrics_html(metrics: Iterable[Metric], control_group: str, test_groups: List[str], file: TextIO):
+    """
+    Writes the HTML report to an open file row by row, so memory does not grow with the number of metrics.
+    :param metrics: Iterable of calculated metrics.
+    :param control_group: The name of the control group.
+    :param test_groups: The names of the test groups.
+    :param file: File handle opened for writing text.
+    """
+    for piece in iter_metrics_html(metrics, control_group, test_groups):
+        file.write(piece)
 
-    for test_group in test_groups:
-        html_str += '<th>' + test_group + '</th>'
-    html_str += '</tr>'
 
+def write_metrics_ndjson(metrics: Iterable[Metric], file: TextIO):
+    """
+    Writes metrics as newline-delimited JSON, one compact object per metric, for downstream dashboards.
+    :param metrics: Iterable of calculated metrics.
+    :param file: File handle opened for writing text.
+    """
     for metric in metrics:
-        metric_name = describe_metric(metric)
-        html_str += f'<tr><td>{metric_name}</td>'
-        control_value = metric.result.data[control_group]
-        html_str += f'<td>{control_value:.2f}</td>'
-
-        for test_group in test_groups:
-            test_value = metric.result.data[test_group]
-            pval = metric.result.stat_significance[test_group]
-            diff = ((test_value - control_value) / control_value) * 100 if control_value != 0 else float('inf')
-            diff_rounded = int(round(diff, 0)) if control_value != 0 else 0
-            color = get_color(pval, diff)
-            title_text = f'P-value: {pval:.4f}'
-            html_str += f'<td class="{color}" title="{title_text}">{test_value:.2f}<br/>({diff_rounded}%)</td>'
-
-        html_str += '</tr>'
-
-    html_str += '</table>'
-    return html_str
+        for record_metric in [metric] + metric.result.segments:
+            record = record_metric.to_dict()
+            record["description"] = describe_metric(record_metric)
+            file.write(json.dumps(record, separators=(',', ':'), allow_nan=False))
+            file.write('\n')
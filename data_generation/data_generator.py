@@ -4,8 +4,8 @@ import datetime
 import pandas as pd
 import numpy as np
 from ab_test_advanced_toolkit.analyzer import ABTestAnalyzer
+from ab_test_advanced_toolkit.metrics import MetricSpec, MetricType, MetricParams
 from typing import Tuple, Any
-import random
 import logging
 
 logger = logging.getLogger(__name__)
@@ -70,6 +70,11 @@ def generate_intermediate_in_test_value(age, engagement_score, country, platform
 
 
 
+def _residual_table(hash_function, values) -> np.ndarray:
+    # Hash residuals depend only on the value, so they are calculated once per distinct value
+    return np.array([hash_function(value) for value in values])
+
+
 def generate_synthetic_data(
     num_users: int = 1000,
     alpha: float = 0.5,
@@ -81,50 +86,45 @@ def generate_synthetic_data(
     base_increase_percentage: float = 0.2,
     seed: int = 40
 ) -> pd.DataFrame:
-    np.random.seed(seed)
-    random.seed(seed)
-    
-    data: dict[str, list[Any]] = {
-        'userid': [],
-        'country': [],
-        'platform': [],
-        'user_segment': [],
-        'abgroup': [],
-        'age': [],
-        'engagement_score': [],
-        'pre_test_value': [],
-        'value': []
-    }
-    
-    for i in range(num_users):
-        user_id = i + 1
-        country = random.choice(countries)
-        platform = random.choice(platforms)
-        user_segment = random.choice(user_segments)
-        ab_group = random.choice(ab_groups)
-        age = np.random.randint(18, 65)
-        engagement_score = np.random.randint(1, 11)
-        
-        pre_test_value = generate_pre_test_value(age, engagement_score, country, platform, user_segment, noise_level)
-        intermediate_value = generate_intermediate_in_test_value(age, engagement_score, country, platform, user_segment, noise_level)
-        
-        in_test_value_alpha = alpha * pre_test_value + (1 - alpha) * intermediate_value
-        in_test_value_increased = in_test_value_alpha
-        if ab_group.startswith('b'):
-            in_test_value_increased = in_test_value_increased * (1 + base_increase_percentage)
-
-        in_test_value_increased = in_test_value_increased + np.random.normal(0, noise_level)
-        data['userid'].append(user_id)
-        data['country'].append(country)
-        data['platform'].append(platform)
-        data['user_segment'].append(user_segment)
-        data['abgroup'].append(ab_group)
-        data['age'].append(age)
-        data['engagement_score'].append(engagement_score)
-        data['pre_test_value'].append(pre_test_value)
-        data['value'].append(in_test_value_increased)
-    
-    df = pd.DataFrame(data)
+    rng = np.random.default_rng(seed)
+
+    # Categorical values are drawn as codes into the lists of possible values
+    country_codes = rng.integers(0, len(countries), size=num_users)
+    platform_codes = rng.integers(0, len(platforms), size=num_users)
+    user_segment_codes = rng.integers(0, len(user_segments), size=num_users)
+    ab_group_codes = rng.integers(0, len(ab_groups), size=num_users)
+    ages = np.arange(18, 65)
+    age_codes = rng.integers(0, len(ages), size=num_users)
+    engagement_scores = np.arange(1, 11)
+    engagement_score_codes = rng.integers(0, len(engagement_scores), size=num_users)
+
+    features = [
+        (ages, age_codes),
+        (engagement_scores, engagement_score_codes),
+        (countries, country_codes),
+        (platforms, platform_codes),
+        (user_segments, user_segment_codes),
+    ]
+    # Same values as generate_pre_test_value and generate_intermediate_in_test_value
+    pre_test_value = 1 + sum(_residual_table(calculate_hash_1, values)[codes] for values, codes in features)
+    intermediate_value = 1 + sum(_residual_table(calculate_hash_2, values)[codes] for values, codes in features)
+
+    in_test_value = alpha * pre_test_value + (1 - alpha) * intermediate_value
+    is_increased = np.array([ab_group.startswith('b') for ab_group in ab_groups], dtype=bool)[ab_group_codes]
+    in_test_value = np.where(is_increased, in_test_value * (1 + base_increase_percentage), in_test_value)
+    in_test_value = in_test_value + rng.normal(0, noise_level, size=num_users)
+
+    df = pd.DataFrame({
+        'userid': np.arange(1, num_users + 1),
+        'country': np.asarray(countries, dtype=object)[country_codes],
+        'platform': np.asarray(platforms, dtype=object)[platform_codes],
+        'user_segment': np.asarray(user_segments, dtype=object)[user_segment_codes],
+        'abgroup': np.asarray(ab_groups, dtype=object)[ab_group_codes],
+        'age': ages[age_codes],
+        'engagement_score': engagement_scores[engagement_score_codes],
+        'pre_test_value': pre_test_value,
+        'value': in_test_value
+    })
     return df
 
 def create_dataframes(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
@@ -164,24 +164,13 @@ def create_dataframes(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, pd.
 
 def run_analysis(df: pd.DataFrame):
     event_data, user_allocations, user_properties = create_dataframes(df)
-    
-    # Analysis without enhancement
-    analyzer_no_enhancement = ABTestAnalyzer(event_data, user_allocations, "a1", user_properties, mode="no_enhancement")
-    results_no_enhancement = analyzer_no_enhancement.calculate_event_attribute_sum_per_user('purchase', 'purchase_value')
-
-    # Analysis with CUPED
-    analyzer_cuped = ABTestAnalyzer(event_data, user_allocations, "a1", user_properties, mode="cuped")
-    results_cuped = analyzer_cuped.calculate_event_attribute_sum_per_user('purchase', 'purchase_value')
-
-    # Analysis with gboost CUPED
-    analyzer_gboost_cuped = ABTestAnalyzer(event_data, user_allocations, "a1", user_properties, mode="gboost_cuped")
-    results_gboost_cuped = analyzer_gboost_cuped.calculate_event_attribute_sum_per_user('purchase', 'purchase_value')
-
-    return {
-        "no_enhancement": results_no_enhancement,
-        "cuped": results_cuped,
-        "gboost_cuped": results_gboost_cuped
-    }
+
+    # Aggregates are computed once and compared without enhancement, with CUPED and with gboost CUPED
+    analyzer = ABTestAnalyzer(event_data, user_allocations, "a1", user_properties)
+    spec = MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value'))
+    results = analyzer.calculate_metrics_for_modes([spec], ["no_enhancement", "cuped", "gboost_cuped"])
+
+    return {mode: metrics[0] for mode, metrics in results.items()}
 
 if __name__ == "__main__":
     # Set up logging
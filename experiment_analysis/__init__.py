@@ -1,3 +1,4 @@
-from .experiment_analysis import analyze_feature, plot_feature_results, analyze_and_plot_features
+from .experiment_analysis import analyze_feature, plot_feature_results, analyze_and_plot_features, \
+    SimulationResultsStore
 
-__all__ = ['analyze_feature', 'plot_feature_results', 'analyze_and_plot_features']
\ No newline at end of file
+__all__ = ['analyze_feature', 'plot_feature_results', 'analyze_and_plot_features', 'SimulationResultsStore']
\ No newline at end of file
@@ -9,7 +9,9 @@ import logging
 import hashlib
 import os
 from datetime import datetime, timezone
+import json
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Any, Sequence
 
 from itertools import product
@@ -35,41 +37,115 @@ def display_results(results):
             logger.info(f"  {size}: Mean {mean_value}")
 
 
+MODES = ['no_enhancement', 'cuped', 'gboost_cuped']
+
+
+class SimulationResultsStore:
+    """
+    On-disk store of simulation p-values keyed by (parameters, seed). Results are appended to a JSON lines file
+    as soon as a simulation finishes, so an interrupted sweep can be restarted without repeating completed cells.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._results: dict[tuple[str, int], dict[str, float]] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._results[(record['params'], record['seed'])] = record['p_values']
+
+    @staticmethod
+    def _params_key(params: dict[str, Any]) -> str:
+        # The same representation of parameters as in get_seed
+        return str(sorted(params.items()))
+
+    def get(self, params: dict[str, Any], seed: int) -> dict[str, float] | None:
+        return self._results.get((self._params_key(params), seed))
+
+    def put(self, params: dict[str, Any], seed: int, p_values: dict[str, float]) -> None:
+        key = (self._params_key(params), seed)
+        self._results[key] = p_values
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'params': key[0], 'seed': seed, 'p_values': p_values}) + '\n')
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+
+def run_simulation(params: dict[str, Any], seed: int) -> dict[str, float]:
+    # A single simulation cell: generate data with the given seed and compare p-values of all modes
+    generated_data = generate_synthetic_data(**params, seed=seed)
+    analysis_results = run_analysis(generated_data)
+    return {mode: float(analysis_results[mode].result.stat_significance['b']) for mode in MODES}
+
+
 # Analyzing p_values vs num_users with fixed other parameters one by one for all combinations
 
 def analyze_feature(
     values_ranges: dict[str, Sequence[Any]],
     fixed_params: dict[str, Any],
     feature: str,
-    num_iterations: int = 50
+    num_iterations: int = 50,
+    n_jobs: int = 1,
+    results_store: str | SimulationResultsStore | None = None
 ) -> dict[str, list[tuple[Any, float]]]:
-    feature_range = values_ranges[feature]
-    results: dict[str, list[tuple[Any, float]]] = {
-        'no_enhancement': [],
-        'cuped': [],
-        'gboost_cuped': []
-    }
+    """
+    Runs num_iterations simulations for every value of the feature and averages p-values of every mode.
+    Seeds are derived from the parameters with get_seed, so parallel and resumed runs give the same results
+    as a serial run.
 
-    for value in tqdm(feature_range):
-        no_enhancement_values = []
-        cuped_values = []
-        gboost_cuped_values = []
+    Args:
+        values_ranges (dict): Ranges of values for features. Only the range of `feature` is used.
+        fixed_params (dict): Parameters of generate_synthetic_data that remain constant.
+        feature (str): Feature to vary.
+        num_iterations (int): Number of simulations for every value of the feature.
+        n_jobs (int): Number of worker processes. 1 runs simulations in the current process, -1 uses all cores.
+        results_store (str | SimulationResultsStore | None): Path to a JSON lines file or a store with
+            completed simulations. Completed (params, seed) cells are skipped and new ones are appended.
 
+    Returns:
+        dict: Mean p-value for every value of the feature per mode.
+    """
+    feature_range = values_ranges[feature]
+    if isinstance(results_store, str):
+        results_store = SimulationResultsStore(results_store)
+
+    cells = []
+    for value in feature_range:
+        params = fixed_params.copy()
+        params[feature] = value
         for i in range(num_iterations):
-            params = fixed_params.copy()
-            params[feature] = value
             # Generate seed using the hash of parameters and iteration number
-            seed = get_seed(params, i)
-            generated_data = generate_synthetic_data(**params, seed=seed)
-            analysis_results = run_analysis(generated_data)
+            cells.append((params, get_seed(params, i)))
+
+    cell_p_values: list[dict[str, float] | None] = [
+        results_store.get(params, seed) if results_store is not None else None for params, seed in cells]
+    pending = [index for index, stored in enumerate(cell_p_values) if stored is None]
+    logger.info(f"Running {len(pending)} of {len(cells)} simulations for feature '{feature}'")
 
-            no_enhancement_values.append(analysis_results['no_enhancement'].result.stat_significance['b'])
-            cuped_values.append(analysis_results['cuped'].result.stat_significance['b'])
-            gboost_cuped_values.append(analysis_results['gboost_cuped'].result.stat_significance['b'])
+    def collect(index: int, p_values: dict[str, float]) -> None:
+        cell_p_values[index] = p_values
+        if results_store is not None:
+            results_store.put(*cells[index], p_values)
 
-        results['no_enhancement'].append((value, np.mean(no_enhancement_values)))
-        results['cuped'].append((value, np.mean(cuped_values)))
-        results['gboost_cuped'].append((value, np.mean(gboost_cuped_values)))
+    if n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(run_simulation, *cells[index]): index for index in pending}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                collect(futures[future], future.result())
+    else:
+        for index in tqdm(pending):
+            collect(index, run_simulation(*cells[index]))
+
+    results: dict[str, list[tuple[Any, float]]] = {mode: [] for mode in MODES}
+    for value_index, value in enumerate(feature_range):
+        value_p_values = cell_p_values[value_index * num_iterations:(value_index + 1) * num_iterations]
+        for mode in MODES:
+            results[mode].append((value, np.mean([p_values[mode] for p_values in value_p_values])))
 
     return results
 
@@ -126,7 +202,9 @@ def analyze_and_plot_features(
     varying_params: dict[str, Any],
     x_params: dict[str, Any],
     num_iterations: int = 50,
-    save_dir: str = 'plots'
+    save_dir: str = 'plots',
+    n_jobs: int = 1,
+    results_store: str | SimulationResultsStore | None = None
 ) -> list[str]:
     """
     Analyzes and plots features with given ranges, varying the values of specified features while keeping others fixed.
@@ -153,6 +231,9 @@ def analyze_and_plot_features(
             }
         num_iterations (int): Number of iterations for analysis.
         save_dir (str): Directory to save the plots.
+        n_jobs (int): Number of worker processes for simulations.
+        results_store (str | SimulationResultsStore | None): Path to a JSON lines file or a store with
+            completed simulations, used to resume interrupted sweeps.
         
     Returns:
         list: Paths to the saved plot files.
@@ -176,6 +257,9 @@ def analyze_and_plot_features(
         if len(values) == 0:
             raise ValueError(f"The feature '{feature}' in x_params must have at least one value.")
     
+    if isinstance(results_store, str):
+        results_store = SimulationResultsStore(results_store)
+
     # Ensure the save directory exists
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
@@ -200,7 +284,8 @@ def analyze_and_plot_features(
             # Ensure the correct value for the x_feature
             logger.info(f"Analyzing feature '{x_feature}' with fixed params: {params}")
             temp_values_ranges = {x_feature: x_values}
-            results = analyze_feature(temp_values_ranges, params, x_feature, num_iterations)
+            results = analyze_feature(temp_values_ranges, params, x_feature, num_iterations,
+                                      n_jobs=n_jobs, results_store=results_store)
             
             # Plotting and saving the plot
             fig = plot_feature_results(results, x_feature, params, num_iterations)
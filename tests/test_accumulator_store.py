@@ -0,0 +1,110 @@
+import pandas as pd
+import pytest
+
+from ab_test_advanced_toolkit import ABTestAnalyzer
+from ab_test_advanced_toolkit.accumulator_store import AccumulatorStore
+from ab_test_advanced_toolkit.metrics import MetricType, MetricSpec, MetricParams
+from tests.test_utils import generate_event_data, generate_user_allocations
+
+SPECS = [
+    MetricSpec(MetricType.EVENT_COUNT_PER_USER, MetricParams('purchase')),
+    MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value')),
+    MetricSpec(MetricType.CONVERSION_RATE, MetricParams('login')),
+]
+
+
+# metrics from a store filled over several runs match metrics calculated from the full event history
+@pytest.mark.parametrize("mode", ["no_enhancement", "cuped"])
+def test_metrics_from_store_match_full_history(mode, tmp_path):
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations()
+    expected = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode=mode).calculate_metrics(SPECS)
+
+    store_path = str(tmp_path / "store")
+    for start in range(0, len(event_data), 30):
+        analyzer = ABTestAnalyzer(None, ab_test_allocations, "A", mode=mode)
+        # a tiny initial capacity makes the arrays grow while users are added
+        analyzer.fold_events_into_store(event_data.iloc[start:start + 30], SPECS,
+                                        AccumulatorStore(store_path, initial_capacity=2))
+
+    store = AccumulatorStore(store_path)
+    assert store.checkpoint == event_data["timestamp"].max()
+    assert len(store) == event_data["userid"].nunique()
+
+    metrics = ABTestAnalyzer(None, ab_test_allocations, "A", mode=mode).calculate_metrics_from_store(SPECS, store_path)
+    for expected_metric, metric in zip(expected, metrics):
+        assert metric.result.data == pytest.approx(expected_metric.result.data)
+        assert metric.result.stat_significance['B'] == pytest.approx(expected_metric.result.stat_significance['B'])
+
+
+def test_untracked_metric_is_rejected(tmp_path):
+    analyzer = ABTestAnalyzer(None, generate_user_allocations(), "A", mode="no_enhancement")
+    store = analyzer.fold_events_into_store(generate_event_data(), SPECS[:1], str(tmp_path / "store"))
+    with pytest.raises(ValueError):
+        analyzer.calculate_metrics_from_store(SPECS, store)
+
+
+# events of users allocated after they were folded are split into periods once the users are allocated
+def test_allocations_grow_between_folds(tmp_path):
+    event_data = generate_event_data()
+    # events from before the allocation of their users, so that CUPED has pretest data
+    event_data['timestamp'] = event_data['timestamp'] - pd.Timedelta("20D")
+    ab_test_allocations = generate_user_allocations()
+    expected = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode="cuped").calculate_metrics(SPECS)
+
+    first_day, second_day = event_data.iloc[:76], event_data.iloc[76:]
+    allocated_by_then = ab_test_allocations[ab_test_allocations['timestamp'] <= first_day['timestamp'].max()]
+    store_path = str(tmp_path / "store")
+    ABTestAnalyzer(None, allocated_by_then, "A", mode="cuped").fold_events_into_store(first_day, SPECS, store_path)
+    assert AccumulatorStore(store_path).values("pending", "login", "__count", event_data['userid'].unique()).sum() > 0
+
+    analyzer = ABTestAnalyzer(None, ab_test_allocations, "A", mode="cuped")
+    analyzer.fold_events_into_store(second_day, SPECS, store_path)
+    # events at or before the checkpoint were folded already
+    analyzer.fold_events_into_store(event_data, SPECS, store_path)
+
+    for expected_metric, metric in zip(expected, analyzer.calculate_metrics_from_store(SPECS, store_path)):
+        assert metric.result.data == pytest.approx(expected_metric.result.data)
+        assert metric.result.stat_significance['B'] == pytest.approx(expected_metric.result.stat_significance['B'])
+
+
+def test_failed_fold_leaves_store_unchanged(tmp_path):
+    event_data = generate_event_data()
+    analyzer = ABTestAnalyzer(None, generate_user_allocations(), "A", mode="no_enhancement")
+    store_path = str(tmp_path / "store")
+    analyzer.fold_events_into_store(event_data.iloc[:50], SPECS, store_path)
+    userids = event_data['userid'].unique()
+    counts = AccumulatorStore(store_path).values("intest", "purchase", "__count", userids)
+
+    def failing_chunks():
+        yield event_data.iloc[50:70]
+        raise IOError("Lost connection")
+
+    with pytest.raises(IOError):
+        analyzer.fold_events_into_store(failing_chunks(), SPECS, store_path)
+
+    store = AccumulatorStore(store_path)
+    assert store.checkpoint == event_data['timestamp'].iloc[49]
+    assert (store.values("intest", "purchase", "__count", userids) == counts).all()
+    analyzer.fold_events_into_store(event_data.iloc[50:], SPECS, store)
+    assert AccumulatorStore(store_path).checkpoint == event_data['timestamp'].max()
+
+
+def test_store_is_used_with_its_pretest_lookback(tmp_path, caplog):
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations()
+    store_path = str(tmp_path / "store")
+    windowed = ABTestAnalyzer(None, ab_test_allocations, "A", mode="cuped", pretest_lookback="12h")
+    windowed.fold_events_into_store(event_data, SPECS, store_path)
+    assert AccumulatorStore(store_path).pretest_lookback == pd.Timedelta("12h").value
+
+    everything = ABTestAnalyzer(None, ab_test_allocations, "A", mode="cuped")
+    with pytest.raises(ValueError, match="pretest_lookback"):
+        everything.calculate_metrics_from_store(SPECS, store_path)
+    with pytest.raises(ValueError, match="pretest_lookback"):
+        everything.fold_events_into_store(event_data, SPECS, store_path)
+
+    # late events at or before the checkpoint are skipped and counted in the log
+    with caplog.at_level("INFO"):
+        windowed.fold_events_into_store(event_data.iloc[:10], SPECS, store_path)
+    assert "Skipped 10 events" in caplog.text
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ab_test_advanced_toolkit.allocation_table import AllocationTable
+from ab_test_advanced_toolkit.moments import calculate_group_moments
+
+
+def generate_allocations():
+    return pd.DataFrame({
+        'timestamp': pd.to_datetime(["2023-01-02", "2023-01-01", "2023-01-03", "2023-01-01"]),
+        'abgroup': ['B', 'A', 'B', 'A'],
+    }, index=pd.Index(["u1", "u2", "u3", "u4"], name="userid"))
+
+
+def test_encode_and_split_periods():
+    table = AllocationTable(generate_allocations())
+    assert table.group_names == ['A', 'B']
+    assert table.group_codes.dtype == np.int8
+    assert table.timestamps.dtype == np.int64
+
+    codes = table.encode(["u3", "unknown", "u1", "u1", "u2"])
+    assert codes.dtype == np.int32
+    assert list(codes) == [2, -1, 0, 0, 1]
+
+    event_timestamps = pd.Series(pd.to_datetime(["2023-01-01", "2023-01-05", "2023-01-02", None, "2023-01-05"]))
+    pretest, intest = table.split_periods(codes, event_timestamps)
+    assert list(pretest) == [True, False, False, False, False]
+    assert list(intest) == [False, False, True, False, True]
+
+
+def test_bincount_kernels_match_pandas():
+    allocations = generate_allocations()
+    table = AllocationTable(allocations)
+    codes = table.encode(["u1", "u1", "u3", "u4"])
+    values = table.aggregate(codes, weights=[1.0, 2.0, 5.0, 7.0])
+    assert list(values) == [3.0, 0.0, 5.0, 7.0]
+    assert list(table.scatter(["u4", "u1"], [7.0, 3.0])) == [3.0, 0.0, 0.0, 7.0]
+
+    merged = table.frame("value", values)
+    expected = calculate_group_moments(merged.astype({"abgroup": str}), "value")
+    moments = table.group_moments(values)
+    for group in ['A', 'B']:
+        assert moments[group].n == expected[group].n
+        assert moments[group].mean == pytest.approx(expected[group].mean)
+        assert moments[group].variance == pytest.approx(expected[group].variance)
+    assert table.group_means("value", values)["value"].to_dict() == pytest.approx(
+        merged.groupby("abgroup", observed=True)["value"].mean().to_dict())
@@ -3,7 +3,7 @@ import pandas as pd
 
 from ab_test_advanced_toolkit.metrics import Metric
 from ab_test_advanced_toolkit.stat_significance import StatSignificanceResult
-from data_generation.data_generator import generate_synthetic_data, run_analysis
+from data_generation.data_generator import generate_synthetic_data, run_analysis, generate_pre_test_value
 
 class TestDataGenerator(unittest.TestCase):
     
@@ -34,6 +34,20 @@ class TestDataGenerator(unittest.TestCase):
         self.assertTrue('value' in data.columns)
         self.assertTrue('pre_test_value' in data.columns)
 
+    def test_generate_synthetic_data_is_reproducible(self):
+        data = generate_synthetic_data(num_users=500, seed=7)
+        pd.testing.assert_frame_equal(data, generate_synthetic_data(num_users=500, seed=7))
+        self.assertFalse(data['value'].equals(generate_synthetic_data(num_users=500, seed=8)['value']))
+
+        # vectorized hash residuals are the same as in the per-user functions
+        for row in data.head(20).itertuples():
+            expected = generate_pre_test_value(row.age, row.engagement_score, row.country, row.platform,
+                                               row.user_segment, 1.0)
+            self.assertAlmostEqual(row.pre_test_value, expected)
+
+        self.assertTrue(data['age'].between(18, 64).all())
+        self.assertTrue(data['engagement_score'].between(1, 10).all())
+
     def test_run_analysis(self):
         num_users = 1000
         countries = ['US', 'UK', 'DE', 'FR', 'CA', 'AU', 'JP', 'IN']
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ab_test_advanced_toolkit import ABTestAnalyzer
+from ab_test_advanced_toolkit.data_validation import ValidationCache, validate_allocations, validate_data
+from tests.test_utils import generate_event_data, generate_user_allocations
+
+
+def test_validation_report():
+    ab_test_allocations = generate_user_allocations()
+    report = validate_allocations(ab_test_allocations, "A")
+
+    assert report.mode == "full"
+    assert report.group_names == ['A', 'B']
+    assert report.test_group_names == ['B']
+    assert list(report.userids) == list(ab_test_allocations['userid'])
+    expected_groups = ab_test_allocations['abgroup'].to_numpy()
+    assert np.array_equal(np.array(report.group_names)[report.group_codes], expected_groups)
+    assert report.matches(ab_test_allocations.copy(), "A")
+    assert not report.matches(ab_test_allocations.iloc[1:], "A")
+
+
+def test_validation_errors():
+    ab_test_allocations = generate_user_allocations()
+    duplicated = pd.concat([ab_test_allocations, ab_test_allocations.iloc[:1]], ignore_index=True)
+
+    with pytest.raises(ValueError, match="Duplicate userids"):
+        validate_allocations(duplicated, "A")
+    with pytest.raises(ValueError, match="Duplicate userids"):
+        validate_allocations(duplicated, "A", mode="sampled")
+    # duplicates are found on all rows in every mode, only missing values are sampled or trusted
+    with pytest.raises(ValueError, match="Duplicate userids"):
+        validate_allocations(duplicated, "A", mode="sampled", sample_size=10)
+    with pytest.raises(ValueError, match="Duplicate userids"):
+        validate_allocations(duplicated, "A", mode="trusted")
+    missing_group = ab_test_allocations.assign(abgroup=ab_test_allocations['abgroup'].where(
+        ab_test_allocations.index > 0))
+    trusted = validate_allocations(missing_group, "A", mode="trusted")
+    assert trusted.mode == "trusted"
+    assert trusted.matches(missing_group, "A") and not trusted.matches(ab_test_allocations, "A")
+
+    with pytest.raises(ValueError, match="Control group"):
+        validate_allocations(ab_test_allocations, "C", mode="trusted")
+    with pytest.raises(ValueError, match="Missing abgroup"):
+        validate_allocations(missing_group, "A")
+    with pytest.raises(ValueError, match="timestamp"):
+        validate_allocations(ab_test_allocations.assign(timestamp="2024-01-01"), "A")
+    with pytest.raises(ValueError):
+        validate_allocations(ab_test_allocations, "A", mode="unknown")
+
+
+def test_validation_cache():
+    ab_test_allocations = generate_user_allocations()
+    cache = ValidationCache()
+
+    report = validate_data(generate_event_data(), ab_test_allocations, "A", cache=cache)
+    assert validate_data(None, ab_test_allocations.copy(), "A", cache=cache) is report
+    # a full report also serves weaker modes, but a weaker report does not serve the full mode
+    assert validate_allocations(ab_test_allocations, "A", mode="sampled", cache=cache) is report
+    trusted = validate_allocations(ab_test_allocations, "B", mode="trusted", cache=cache)
+    assert validate_allocations(ab_test_allocations, "B", cache=cache) is not trusted
+    assert (cache.hits, cache.misses) == (2, 3)
+
+    changed = ab_test_allocations.assign(abgroup=ab_test_allocations['abgroup'].iloc[::-1].to_numpy())
+    assert validate_allocations(changed, "A", cache=cache) is not report
+
+
+def test_validation_cache_detects_any_changed_row():
+    userids = np.arange(20000)
+    ab_test_allocations = pd.DataFrame({'timestamp': pd.Timestamp('2024-01-01'), 'userid': userids,
+                                        'abgroup': np.where(userids % 2 == 0, 'A', 'B')})
+    cache = ValidationCache()
+    report = validate_allocations(ab_test_allocations, "A", cache=cache)
+
+    # a row between evenly spaced sample positions
+    changed = ab_test_allocations.copy()
+    changed.loc[1, 'abgroup'] = 'A'
+    changed_report = validate_allocations(changed, "A", cache=cache)
+    assert changed_report is not report
+    assert changed_report.group_codes[1] == 0
+    assert not report.matches(changed, "A")
+
+
+def test_analyzer_reuses_validation_report():
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations()
+    report = validate_data(event_data, ab_test_allocations, "A")
+
+    analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode="no_enhancement", validation=report)
+    assert analyzer.ab_test_allocations.index is report.userids
+    expected = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode="no_enhancement")
+    assert analyzer.test_group_names == expected.test_group_names
+    assert (analyzer.calculate_event_count_per_user('purchase').result.stat_significance ==
+            expected.calculate_event_count_per_user('purchase').result.stat_significance)
+
+    with pytest.raises(ValueError):
+        ABTestAnalyzer(event_data, ab_test_allocations.iloc[1:], "A", validation=report)
+    # a report of the same users in another order would relabel every user
+    with pytest.raises(ValueError):
+        ABTestAnalyzer(event_data, ab_test_allocations.iloc[::-1], "A", validation=report)
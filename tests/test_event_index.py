@@ -0,0 +1,42 @@
+import pandas as pd
+
+from ab_test_advanced_toolkit.event_index import EventIndex
+from tests.test_utils import generate_event_data, generate_user_allocations
+
+
+def test_event_index_matches_filtering():
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations().set_index("userid")
+    event_index = EventIndex(event_data, ab_test_allocations)
+
+    assert sorted(event_index.event_names) == ['login', 'purchase']
+    for event_name in event_index.event_names:
+        expected = event_data[event_data["event_name"] == event_name]
+        events = event_index.get(event_name)
+        assert events.index.tolist() == expected.index.tolist()
+        assert (events["timestamp_alloc"] == ab_test_allocations.loc[expected["userid"], "timestamp"].values).all()
+
+    assert event_index.get('unknown_event').empty
+    assert len(event_index.select(['login', 'purchase'])) == len(event_data)
+
+
+def test_event_index_keeps_users_without_allocation():
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations().set_index("userid").drop(index=[1, 2])
+    events = EventIndex(event_data, ab_test_allocations).select(['login', 'purchase'])
+
+    assert pd.isna(events.loc[events["userid"].isin([1, 2]), "timestamp_alloc"]).all()
+
+
+def test_event_index_takes_columns_without_copying_events():
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations().set_index("userid")
+    event_index = EventIndex(event_data, ab_test_allocations)
+
+    events = event_index.select(['purchase', 'login'], ["timestamp", "userid", "event_name"])
+    assert events.columns.tolist() == ["timestamp_event", "userid", "event_name", "timestamp_alloc"]
+    assert events["event_name"].tolist() == sorted(event_data["event_name"], reverse=True)
+    assert event_index.get('unknown_event', ["userid"]).columns.tolist() == ["userid", "timestamp_alloc"]
+    # the index keeps the caller's frame and a permutation instead of a sorted copy of the events
+    assert event_index._event_data is event_data
+    assert len(event_index._order) == len(event_data)
@@ -0,0 +1,25 @@
+import pytest
+
+from experiment_analysis.experiment_analysis import analyze_feature, SimulationResultsStore
+
+
+def test_analyze_feature_parallel_and_resumable(tmp_path):
+    values_ranges = {'num_users': [200, 300]}
+    fixed_params = {'ab_groups': ['a1', 'b'], 'noise_level': 1.0}
+
+    serial = analyze_feature(values_ranges, fixed_params, 'num_users', num_iterations=2)
+
+    store_path = str(tmp_path / "results.jsonl")
+    parallel = analyze_feature(values_ranges, fixed_params, 'num_users', num_iterations=2, n_jobs=2,
+                               results_store=store_path)
+    assert len(SimulationResultsStore(store_path)) == 4
+
+    for mode in serial:
+        assert [value for value, _ in parallel[mode]] == [200, 300]
+        assert [p_value for _, p_value in parallel[mode]] == pytest.approx([p_value for _, p_value in serial[mode]])
+
+    # a restarted run takes every completed cell from the store and runs no new simulations
+    store = SimulationResultsStore(store_path)
+    store.put = None
+    resumed = analyze_feature(values_ranges, fixed_params, 'num_users', num_iterations=2, results_store=store)
+    assert resumed == parallel
@@ -1,8 +1,14 @@
+import importlib.util
+import io
+import json
+
 import pytest
 import logging
 
 from ab_test_advanced_toolkit import ABTestAnalyzer
-from ab_test_advanced_toolkit.metrics import MetricType
+from ab_test_advanced_toolkit.metrics import MetricType, MetricSpec, MetricParams
+from ab_test_advanced_toolkit.stat_significance import BootstrapEngine, StatTests, adjust_p_values
+from ab_test_advanced_toolkit.vizualizer import format_metrics_to_html, write_metrics_html
 from tests.test_utils import generate_event_data, generate_user_properties, generate_user_allocations
 
 # Set up logging
@@ -81,3 +87,225 @@ def test_calculate_significance():
 
     assert abs(analyzer_user_properties.calculated_metrics[0].result.stat_significance['B'] -
                analyzer_no_user_properties.calculated_metrics[0].result.stat_significance['B']) > 1e-3
+
+
+# batched calculation returns the same metrics as calculating them one by one
+@pytest.mark.parametrize("mode", ["no_enhancement", "cuped", "gboost_cuped"])
+def test_calculate_metrics_batch(mode):
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations()
+    user_properties = generate_user_properties()
+
+    analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", user_properties, mode=mode)
+    expected = [
+        analyzer.calculate_event_count_per_user('purchase'),
+        analyzer.calculate_event_attribute_sum_per_user('purchase', 'purchase_value'),
+        analyzer.calculate_conversion('login'),
+    ]
+
+    batch_analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", user_properties, mode=mode)
+    metrics = batch_analyzer.calculate_metrics([
+        MetricSpec(MetricType.EVENT_COUNT_PER_USER, MetricParams('purchase')),
+        MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value')),
+        MetricSpec(MetricType.CONVERSION_RATE, MetricParams('login')),
+    ])
+
+    assert len(batch_analyzer.calculated_metrics) == 3
+    for expected_metric, metric in zip(expected, metrics):
+        assert metric.metrictype == expected_metric.metrictype
+        assert metric.result.data == pytest.approx(expected_metric.result.data)
+        assert metric.result.stat_significance['B'] == pytest.approx(expected_metric.result.stat_significance['B'])
+
+
+# metrics calculated in worker processes are the same and keep the order of the specs
+def test_calculate_metrics_parallel():
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations()
+    user_properties = generate_user_properties()
+    specs = [
+        MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value')),
+        MetricSpec(MetricType.CONVERSION_RATE, MetricParams('login')),
+        MetricSpec(MetricType.EVENT_COUNT_PER_USER, MetricParams('purchase')),
+    ]
+
+    serial = ABTestAnalyzer(event_data, ab_test_allocations, "A", user_properties).calculate_metrics(specs)
+    analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", user_properties)
+    parallel = analyzer.calculate_metrics(specs, n_jobs=2)
+
+    assert [metric.metrictype for metric in analyzer.calculated_metrics] == [spec.metrictype for spec in specs]
+    for serial_metric, parallel_metric in zip(serial, parallel):
+        assert parallel_metric.result.data == pytest.approx(serial_metric.result.data)
+        assert parallel_metric.result.stat_significance['B'] == pytest.approx(
+            serial_metric.result.stat_significance['B'])
+
+
+# streaming event data in chunks gives the same metrics as the in-memory event data
+@pytest.mark.parametrize("mode", ["no_enhancement", "cuped"])
+def test_calculate_metrics_from_chunks(mode, tmp_path):
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations()
+    specs = [
+        MetricSpec(MetricType.EVENT_COUNT_PER_USER, MetricParams('purchase')),
+        MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value')),
+        MetricSpec(MetricType.CONVERSION_RATE, MetricParams('login')),
+    ]
+    expected = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode=mode).calculate_metrics(specs)
+
+    csv_path = tmp_path / "event_data.csv"
+    event_data.to_csv(csv_path, index=False)
+    chunk_sources = [[event_data.iloc[i:i + 7] for i in range(0, len(event_data), 7)], str(csv_path)]
+    if importlib.util.find_spec("pyarrow") is not None:
+        parquet_path = tmp_path / "event_data.parquet"
+        event_data.to_parquet(parquet_path, index=False)
+        chunk_sources.append(str(parquet_path))
+
+    for source in chunk_sources:
+        analyzer = ABTestAnalyzer(None, ab_test_allocations, "A", mode=mode)
+        metrics = analyzer.calculate_metrics_from_chunks(source, specs, chunksize=9)
+        for expected_metric, metric in zip(expected, metrics):
+            assert metric.result.data == pytest.approx(expected_metric.result.data)
+            assert metric.result.stat_significance['B'] == pytest.approx(expected_metric.result.stat_significance['B'])
+        analyzer.save_report(str(tmp_path / "report.html"))
+
+
+# one analyzer compares several modes with the same results as one analyzer per mode
+def test_calculate_metrics_for_modes():
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations()
+    user_properties = generate_user_properties()
+    specs = [MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value'))]
+    modes = ["no_enhancement", "cuped", "gboost_cuped"]
+
+    analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", user_properties)
+    results = analyzer.calculate_metrics_for_modes(specs, modes)
+
+    assert list(results) == modes
+    assert len(analyzer.calculated_metrics) == 0
+    for mode in modes:
+        expected = ABTestAnalyzer(event_data, ab_test_allocations, "A", user_properties,
+                                  mode=mode).calculate_metrics(specs)[0]
+        assert results[mode][0].result.stat_significance_method == expected.result.stat_significance_method
+        assert results[mode][0].result.stat_significance['B'] == pytest.approx(expected.result.stat_significance['B'])
+
+
+# bootstrap confidence intervals are attached to metrics and shown in the report
+def test_calculate_metrics_with_bootstrap(tmp_path):
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations()
+    analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode="cuped",
+                              bootstrap=BootstrapEngine(n_replicates=200, seed=0))
+    metrics = analyzer.calculate_metrics([
+        MetricSpec(MetricType.EVENT_COUNT_PER_USER, MetricParams('purchase')),
+        MetricSpec(MetricType.CONVERSION_RATE, MetricParams('login')),
+    ])
+    metrics.append(analyzer.calculate_event_attribute_sum_per_user('purchase', 'purchase_value'))
+
+    for metric in metrics:
+        low, high = metric.result.confidence_intervals['B']
+        assert low <= high
+    report_path = tmp_path / "report.html"
+    analyzer.save_report(str(report_path))
+    assert "CI: [" in report_path.read_text()
+
+
+# reports are streamed row by row and metrics can be exported as NDJSON
+def test_save_report_and_ndjson(tmp_path):
+    analyzer = ABTestAnalyzer(generate_event_data(), generate_user_allocations(), "A", mode="no_enhancement")
+    analyzer.calculate_metrics([
+        MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value')),
+        MetricSpec(MetricType.CONVERSION_RATE, MetricParams('login')),
+    ])
+
+    report_path = tmp_path / "report.html"
+    analyzer.save_report(str(report_path))
+    assert report_path.read_text() == format_metrics_to_html(analyzer.calculated_metrics, "A", ["B"])
+
+    ndjson_path = tmp_path / "metrics.ndjson"
+    analyzer.save_metrics_ndjson(str(ndjson_path))
+    records = [json.loads(line) for line in ndjson_path.read_text().splitlines()]
+    assert [record["metric_type"] for record in records] == ["EVENT_ATTRIBUTE_SUM_PER_USER", "CONVERSION_RATE"]
+    assert records[0]["attribute_name"] == "purchase_value"
+    assert records[0]["values"]["B"] == pytest.approx(analyzer.calculated_metrics[0].result.data["B"])
+    assert records[1]["p_values"]["B"] == pytest.approx(analyzer.calculated_metrics[1].result.stat_significance["B"])
+
+    # the writer consumes a generator of metrics without materializing the report
+    stream = io.StringIO()
+    write_metrics_html((analyzer.calculated_metrics[i % 2] for i in range(1000)), "A", ["B"], stream)
+    assert stream.getvalue().count("<tr>") == 1001
+
+
+# segment slices match a separate t-test on the users of every segment
+def test_calculate_metrics_with_segments(tmp_path):
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations()
+    user_properties = generate_user_properties()
+    specs = [MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value'))]
+    analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", user_properties, mode="cuped")
+    metric = analyzer.calculate_metrics(specs, segments=["device_type", "gender"])[0]
+
+    merged_intest = analyzer._merge_and_aggregate_batch(event_data, analyzer.ab_test_allocations, specs)[specs[0].key][1]
+    properties = user_properties.set_index("userid")
+    assert len(metric.result.segments) == properties["device_type"].nunique() + properties["gender"].nunique()
+    for segment_metric in metric.result.segments:
+        segment, value = segment_metric.metricparams.segment
+        users = properties.index[properties[segment] == value]
+        expected = StatTests.calculate_t_test_for_dataset(merged_intest.loc[users], "A", ["B"])
+        expected_means = merged_intest.loc[users].groupby("abgroup", observed=True)["purchase_value"].mean()
+        assert segment_metric.result.stat_significance["B"] == pytest.approx(expected.p_values[0], nan_ok=True)
+        assert segment_metric.result.data == pytest.approx(expected_means.to_dict())
+
+    report_path = tmp_path / "report.html"
+    analyzer.save_report(str(report_path))
+    assert "Segment: device_type = Mobile." in report_path.read_text()
+
+
+# segment cells without control users have NaN means, which the report shows as n/a
+def test_report_with_empty_segment_cell(tmp_path):
+    ab_test_allocations = generate_user_allocations()
+    user_properties = generate_user_properties()
+    test_user = ab_test_allocations.loc[ab_test_allocations["abgroup"] == "B", "userid"].iloc[0]
+    user_properties["cohort"] = (user_properties["userid"] == test_user).map({True: "new", False: "old"})
+    specs = [MetricSpec(MetricType.EVENT_COUNT_PER_USER, MetricParams('purchase'))]
+    analyzer = ABTestAnalyzer(generate_event_data(), ab_test_allocations, "A", user_properties,
+                              mode="no_enhancement")
+    metric = analyzer.calculate_metrics(specs, segments=["cohort"])[0]
+
+    new_cohort = next(segment_metric for segment_metric in metric.result.segments
+                      if segment_metric.metricparams.segment == ("cohort", "new"))
+    assert new_cohort.result.data["A"] != new_cohort.result.data["A"]
+
+    report_path = tmp_path / "report.html"
+    analyzer.save_report(str(report_path))
+    assert "<td>n/a</td>" in report_path.read_text()
+
+
+# adjusted p-values of metrics calculated together are corrected as one family
+@pytest.mark.parametrize("mode", ["no_enhancement", "cuped"])
+def test_calculate_metrics_with_correction(mode):
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations()
+    specs = [
+        MetricSpec(MetricType.EVENT_COUNT_PER_USER, MetricParams('purchase')),
+        MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value')),
+        MetricSpec(MetricType.CONVERSION_RATE, MetricParams('login')),
+    ]
+
+    expected = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode=mode).calculate_metrics(specs)
+    analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode=mode, correction="bh")
+    metrics = analyzer.calculate_metrics(specs)
+
+    p_values = [metric.result.stat_significance['B'] for metric in metrics]
+    assert p_values == [metric.result.stat_significance['B'] for metric in expected]
+    assert expected[0].result.adjusted_p_values is None
+    adjusted = adjust_p_values(p_values, "bh")
+    for metric, adjusted_p_value in zip(metrics, adjusted):
+        assert metric.result.adjusted_p_values['B'] == pytest.approx(adjusted_p_value)
+        assert metric.to_dict()["adjusted_p_values"]["B"] == pytest.approx(adjusted_p_value)
+        assert metric.to_dict()["correction"] == "bh"
+
+    # a metric calculated on its own is corrected across its test groups only
+    metric = analyzer.calculate_event_count_per_user('purchase')
+    assert metric.result.adjusted_p_values['B'] == pytest.approx(metric.result.stat_significance['B'])
+
+    with pytest.raises(ValueError):
+        ABTestAnalyzer(event_data, ab_test_allocations, "A", correction="bonferroni")
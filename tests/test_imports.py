@@ -0,0 +1,43 @@
+import json
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ["catboost", "xgboost", "sklearn", "category_encoders", "scipy.stats", "matplotlib", "seaborn"]
+
+
+def run_in_fresh_interpreter(code: str) -> dict:
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True,
+                            cwd=repo_root).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+# importing the package and running a no_enhancement analysis does not load ML backends
+def test_heavy_dependencies_are_imported_lazily():
+    result = run_in_fresh_interpreter(f"""
+import json, sys
+import ab_test_advanced_toolkit
+loaded_on_import = [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+
+from ab_test_advanced_toolkit import ABTestAnalyzer
+from tests.test_utils import generate_event_data, generate_user_allocations
+ABTestAnalyzer(generate_event_data(), generate_user_allocations(), "A", mode="no_enhancement").calculate_conversion("login")
+loaded_on_analysis = [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+print(json.dumps({{"import": loaded_on_import, "analysis": loaded_on_analysis}}))
+""")
+    assert result == {"import": [], "analysis": []}
+
+
+# importing the package on top of numpy and pandas loads no heavy module; the import time is only reported
+def test_import_loads_no_heavy_modules():
+    result = run_in_fresh_interpreter(f"""
+import json, sys, time
+import numpy, pandas
+start = time.perf_counter()
+import ab_test_advanced_toolkit
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+""")
+    print(f"Package import took {result['seconds']:.3f}s on top of numpy and pandas")
+    assert result["loaded"] == []
@@ -0,0 +1,47 @@
+import pytest
+
+from ab_test_advanced_toolkit import ABTestAnalyzer
+from ab_test_advanced_toolkit.ingestion import load_event_data, iter_event_chunks
+from ab_test_advanced_toolkit.metrics import MetricSpec, MetricType, MetricParams
+from tests.test_utils import generate_event_data, generate_user_allocations
+
+pytest.importorskip("pyarrow")
+
+
+def write_event_data(tmp_path):
+    event_data = generate_event_data()
+    event_data["unused_attribute"] = "unused"
+    path = tmp_path / "event_data.parquet"
+    event_data.to_parquet(path, index=False)
+    return event_data, str(path)
+
+
+def test_load_event_data_pushes_down_filter_and_projection(tmp_path):
+    event_data, path = write_event_data(tmp_path)
+
+    loaded = load_event_data(path, event_names=['purchase'], attributes=['purchase_value'])
+    assert list(loaded.columns) == ['timestamp', 'userid', 'event_name', 'purchase_value']
+    assert (loaded['event_name'] == 'purchase').all()
+    assert len(loaded) == (event_data['event_name'] == 'purchase').sum()
+
+    chunks = list(iter_event_chunks(path, chunksize=10, event_names=['login'], attributes=[]))
+    assert sum(len(chunk) for chunk in chunks) == (event_data['event_name'] == 'login').sum()
+    assert all(list(chunk.columns) == ['timestamp', 'userid', 'event_name'] for chunk in chunks)
+
+
+def test_analyzer_from_parquet(tmp_path):
+    event_data, path = write_event_data(tmp_path)
+    ab_test_allocations = generate_user_allocations()
+    specs = [
+        MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value')),
+        MetricSpec(MetricType.CONVERSION_RATE, MetricParams('purchase')),
+    ]
+
+    analyzer = ABTestAnalyzer.from_parquet(path, ab_test_allocations, "A", specs, mode="cuped")
+    assert 'unused_attribute' not in analyzer.event_data.columns
+    metrics = analyzer.calculate_metrics(specs)
+
+    expected = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode="cuped").calculate_metrics(specs)
+    for expected_metric, metric in zip(expected, metrics):
+        assert metric.result.data == pytest.approx(expected_metric.result.data)
+        assert metric.result.stat_significance['B'] == pytest.approx(expected_metric.result.stat_significance['B'])
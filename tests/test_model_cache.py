@@ -0,0 +1,49 @@
+import pandas as pd
+import pytest
+
+from ab_test_advanced_toolkit import ABTestAnalyzer
+from ab_test_advanced_toolkit.model_cache import ModelCache
+from tests.test_utils import generate_event_data, generate_user_properties, generate_user_allocations
+
+
+def test_model_cache_lru_eviction():
+    cache = ModelCache(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_model_cache_fingerprint():
+    x_train = pd.DataFrame({'pretest': [1.0, 2.0, 3.0], 'country': ['US', 'UK', 'US']})
+    y_train = pd.Series([1.0, 2.0, 4.0], name='value')
+    params = {'depth': 4}
+
+    key = ModelCache.fingerprint(x_train, y_train, params)
+    assert key == ModelCache.fingerprint(x_train.copy(), y_train.copy(), params)
+    assert key != ModelCache.fingerprint(x_train, y_train * 2, params)
+    assert key != ModelCache.fingerprint(x_train.drop(columns=['country']), y_train, params)
+    assert key != ModelCache.fingerprint(x_train, y_train, {'depth': 6})
+
+
+def test_analyzer_reuses_models_from_disk(tmp_path):
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations()
+    user_properties = generate_user_properties()
+
+    cache = ModelCache(cache_dir=str(tmp_path))
+    analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", user_properties, model_cache=cache)
+    metric = analyzer.calculate_event_attribute_sum_per_user('purchase', 'purchase_value')
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    # a fresh cache with the same directory reuses the fitted model
+    disk_cache = ModelCache(cache_dir=str(tmp_path))
+    analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", user_properties, model_cache=disk_cache)
+    cached_metric = analyzer.calculate_event_attribute_sum_per_user('purchase', 'purchase_value')
+    assert (disk_cache.hits, disk_cache.misses) == (1, 0)
+    assert cached_metric.result.stat_significance['B'] == pytest.approx(metric.result.stat_significance['B'])
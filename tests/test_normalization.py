@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ab_test_advanced_toolkit import ABTestAnalyzer
+from ab_test_advanced_toolkit.ingestion import normalize_allocations, normalize_event_data
+from ab_test_advanced_toolkit.metrics import MetricSpec, MetricType, MetricParams
+from tests.test_utils import generate_event_data, generate_user_allocations
+
+SPECS = [
+    MetricSpec(MetricType.EVENT_COUNT_PER_USER, MetricParams('purchase')),
+    MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value')),
+    MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'discount')),
+    MetricSpec(MetricType.CONVERSION_RATE, MetricParams('login')),
+]
+
+
+def generate_wide_event_data():
+    event_data = generate_event_data()
+    # quarters survive a round trip through float32, tenths do not
+    event_data['discount'] = event_data['purchase_value'] / 4
+    event_data['rate'] = event_data['purchase_value'] / 10
+    return event_data
+
+
+def test_normalize_event_data():
+    event_data = generate_wide_event_data()
+    normalized, report = normalize_event_data(event_data)
+
+    assert isinstance(normalized['event_name'].dtype, pd.CategoricalDtype)
+    assert normalized['timestamp'].dtype == np.dtype('datetime64[ns]')
+    assert normalized['userid'].dtype == event_data['userid'].dtype
+    assert normalized['purchase_value'].dtype == np.int16
+    assert normalized['discount'].dtype == np.float32
+    assert normalized['rate'].dtype == np.float64
+    assert set(report.conversions) == {'event_data.event_name', 'event_data.purchase_value', 'event_data.discount'}
+    assert report.bytes_saved > 0
+    pd.testing.assert_frame_equal(normalized.astype(event_data.dtypes.to_dict()), event_data)
+
+    # chunks share the categories of the requested event names
+    chunk, _ = normalize_event_data(event_data.iloc[:10], event_names=['purchase', 'signup'])
+    assert list(chunk['event_name'].cat.categories) == ['purchase', 'signup']
+    assert (chunk['event_name'] == 'purchase').all()
+
+
+def test_normalize_timezone_aware_timestamps():
+    ab_test_allocations = generate_user_allocations()
+    ab_test_allocations['timestamp'] = ab_test_allocations['timestamp'].dt.tz_localize('Europe/Berlin')
+    normalized, report = normalize_allocations(ab_test_allocations)
+
+    assert isinstance(normalized['abgroup'].dtype, pd.CategoricalDtype)
+    assert normalized['timestamp'].dtype == np.dtype('datetime64[ns]')
+    assert normalized['timestamp'].iloc[0] == pd.Timestamp('2022-12-14 23:00:00')
+    assert 'ab_test_allocations.abgroup' in report.conversions
+
+
+@pytest.mark.parametrize("mode", ["no_enhancement", "cuped"])
+def test_normalized_analyzer_matches_original_dtypes(mode):
+    event_data = generate_wide_event_data()
+    ab_test_allocations = generate_user_allocations()
+
+    expected = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode=mode)
+    analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode=mode, normalize_dtypes=True)
+    assert analyzer.normalization_report.bytes_saved > 0
+    assert not (analyzer.event_data.dtypes == object).any()
+    assert isinstance(analyzer.ab_test_allocations['abgroup'].dtype, pd.CategoricalDtype)
+
+    def results(metrics):
+        return [(metric.result.data, metric.result.stat_significance) for metric in metrics]
+
+    expected_results = results(expected.calculate_metrics(SPECS))
+    assert results(analyzer.calculate_metrics(SPECS)) == expected_results
+    chunks = [event_data.iloc[:50], event_data.iloc[50:]]
+    assert results(analyzer.calculate_metrics_from_chunks(chunks, SPECS)) == expected_results
+
+    metric = analyzer.calculate_event_attribute_sum_per_user('purchase', 'discount')
+    expected_metric = expected.calculate_event_attribute_sum_per_user('purchase', 'discount')
+    assert metric.result.data == expected_metric.result.data
+    assert metric.result.stat_significance == expected_metric.result.stat_significance
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+from ab_test_advanced_toolkit import ABTestAnalyzer
+from ab_test_advanced_toolkit.metrics import MetricSpec, MetricType, MetricParams
+from ab_test_advanced_toolkit.moments import RatioMomentsMatrix
+from ab_test_advanced_toolkit.stat_significance import StatTests, StatSignificanceMethod
+from tests.test_utils import generate_event_data, generate_user_allocations, generate_user_properties
+
+SPECS = [
+    MetricSpec(MetricType.RATIO, MetricParams('purchase', 'purchase_value')),
+    MetricSpec(MetricType.RATIO, MetricParams('purchase', denominator_event_name='login')),
+    MetricSpec(MetricType.EVENT_COUNT_PER_USER, MetricParams('purchase')),
+]
+
+
+def generate_merged_ratio_intest():
+    rng = np.random.default_rng(11)
+    abgroup = rng.choice(['A', 'B', 'C'], size=600)
+    denominators = rng.poisson(3.0, size=600).astype(float)
+    numerators = rng.gamma(2.0, 5.0, size=600) * denominators + (abgroup == 'B') * denominators
+    return pd.DataFrame({'abgroup': abgroup, 'numerator': numerators, 'denominator': denominators},
+                        index=pd.Index(np.arange(600), name='userid'))
+
+
+def test_delta_method_matches_linearized_t_test():
+    merged_intest = generate_merged_ratio_intest()
+    moments = StatTests.ratio_moments_row(merged_intest['numerator'], merged_intest['denominator'],
+                                          merged_intest['abgroup'], ['A', 'B', 'C'])
+
+    for column, group in enumerate(['A', 'B', 'C']):
+        group_data = merged_intest[merged_intest['abgroup'] == group]
+        x, y = group_data['numerator'].to_numpy(), group_data['denominator'].to_numpy()
+        ratio = x.sum() / y.sum()
+        covariance = np.cov(x, y)
+        delta_variance = (covariance[0, 0] - 2 * ratio * covariance[0, 1] + ratio ** 2 * covariance[1, 1]) / (
+                len(x) * y.mean() ** 2)
+        assert moments.mean[0, column] == pytest.approx(ratio)
+        assert moments.variance[0, column] / moments.n[0, column] == pytest.approx(delta_variance)
+
+    # the delta-method test is Welch's T-test on linearized values
+    linearized = StatTests.linearize_ratio(merged_intest, 'A', ['B', 'C'])
+    assert linearized.groupby('abgroup')['ratio'].mean().to_numpy() == pytest.approx(moments.mean[0])
+    result = StatTests.calculate_delta_method_t_test(merged_intest, 'A', ['B', 'C'])
+    assert result.method_used == StatSignificanceMethod.DELTA_METHOD_T_TEST
+    control = linearized.loc[linearized['abgroup'] == 'A', 'ratio']
+    for test_group, p_value in zip(['B', 'C'], result.p_values):
+        _, expected = stats.ttest_ind(control, linearized.loc[linearized['abgroup'] == test_group, 'ratio'],
+                                      equal_var=False)
+        assert p_value == pytest.approx(expected, rel=1e-9)
+
+    stacked = RatioMomentsMatrix.stack([moments, moments])
+    assert stacked.n.shape == (2, 3)
+    assert StatTests.calculate_t_test_for_moments_matrix(stacked, 0, [1, 2])[1] == pytest.approx(result.p_values)
+
+
+def generate_event_data_with_pretest():
+    event_data = generate_event_data()
+    # events from before the allocation of their users, so that CUPED has pretest data
+    event_data['timestamp'] = event_data['timestamp'] - pd.Timedelta("20D")
+    return event_data
+
+
+def results(metrics):
+    return [(metric.result.data, metric.result.stat_significance, metric.result.stat_significance_method)
+            for metric in metrics]
+
+
+@pytest.mark.parametrize("mode,method", [("no_enhancement", StatSignificanceMethod.DELTA_METHOD_T_TEST),
+                                         ("cuped", StatSignificanceMethod.PURE_CUPED_T_TEST)])
+@pytest.mark.parametrize("period_split", ["merge", "sorted"])
+def test_ratio_metrics_in_batch_and_one_by_one(mode, method, period_split):
+    event_data = generate_event_data_with_pretest()
+    ab_test_allocations = generate_user_allocations()
+
+    analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode=mode, period_split=period_split)
+    metrics = analyzer.calculate_metrics(SPECS)
+    assert metrics[0].result.stat_significance_method == method
+
+    intest = event_data.merge(ab_test_allocations, on='userid', suffixes=('', '_alloc'))
+    intest = intest[intest['timestamp'] >= intest['timestamp_alloc']]
+    purchases = intest[intest['event_name'] == 'purchase']
+    for group in ['A', 'B']:
+        group_purchases = purchases[purchases['abgroup'] == group]
+        expected = group_purchases['purchase_value'].sum() / len(group_purchases)
+        assert metrics[0].result.data[group] == pytest.approx(expected)
+
+    expected_results = results(metrics)
+    one_by_one = [analyzer.calculate_ratio('purchase', 'purchase_value'),
+                  analyzer.calculate_ratio('purchase', denominator_event_name='login'),
+                  analyzer.calculate_event_count_per_user('purchase')]
+    for (data, p_values, metric_method), (expected_data, expected_p_values, expected_method) in zip(
+            results(one_by_one), expected_results):
+        assert data == pytest.approx(expected_data)
+        assert p_values == pytest.approx(expected_p_values)
+        assert metric_method == expected_method
+
+    chunks = [event_data.iloc[:40], event_data.iloc[40:]]
+    for (data, p_values, _), (expected_data, expected_p_values, _) in zip(
+            results(analyzer.calculate_metrics_from_chunks(chunks, SPECS)), expected_results):
+        assert data == pytest.approx(expected_data)
+        assert p_values == pytest.approx(expected_p_values)
+
+
+def test_ratio_metrics_from_store_and_segments(tmp_path):
+    event_data = generate_event_data_with_pretest()
+    ab_test_allocations = generate_user_allocations()
+    analyzer = ABTestAnalyzer(event_data, ab_test_allocations, "A", generate_user_properties(), mode="cuped")
+    expected = analyzer.calculate_metrics(SPECS[:2], segments=["membership_status"])
+
+    store = analyzer.fold_events_into_store(event_data, SPECS[:2], str(tmp_path / "store"))
+    for metric, expected_metric in zip(analyzer.calculate_metrics_from_store(SPECS[:2], store), expected):
+        assert metric.result.data == pytest.approx(expected_metric.result.data)
+        assert metric.result.stat_significance == pytest.approx(expected_metric.result.stat_significance)
+
+    segment_metrics = expected[1].result.segments
+    assert [metric.metricparams.segment for metric in segment_metrics] == [("membership_status", "Free"),
+                                                                          ("membership_status", "Premium")]
+    assert segment_metrics[0].metricparams.denominator_event_name == 'login'
+    assert segment_metrics[0].result.stat_significance_method == StatSignificanceMethod.DELTA_METHOD_T_TEST
+    assert segment_metrics[0].to_dict()["denominator_event_name"] == 'login'
+
+
+def test_ratio_metric_validation(tmp_path):
+    with pytest.raises(ValueError):
+        MetricSpec(MetricType.RATIO, MetricParams('purchase'))
+    assert SPECS[0].key != MetricSpec(MetricType.RATIO, MetricParams('purchase', 'purchase_value',
+                                                                     denominator_event_name='login')).key
+
+    analyzer = ABTestAnalyzer(generate_event_data(), generate_user_allocations(), "A", mode="no_enhancement")
+    with pytest.raises(ValueError):
+        analyzer.calculate_ratio('purchase', 'unknown_attribute')
+    with pytest.raises(ValueError):
+        analyzer.update_sequential(generate_event_data(), SPECS[:1], str(tmp_path / "state.pkl"))
@@ -0,0 +1,102 @@
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ab_test_advanced_toolkit import ABTestAnalyzer
+from ab_test_advanced_toolkit.model_cache import ModelCache
+from ab_test_advanced_toolkit.regressors import REGRESSOR_BACKENDS, CrossFitting, RegressorBackend, \
+    get_regressor_backend
+from tests.test_utils import generate_event_data, generate_user_allocations, generate_user_properties
+
+
+def generate_training_data():
+    rng = np.random.default_rng(0)
+    x = pd.DataFrame({
+        'pretest_value': rng.exponential(1.0, size=2000),
+        'country': rng.choice(['USA', 'UK', 'India', None], size=2000),
+    })
+    y = pd.Series(2 * x['pretest_value'] + (x['country'] == 'USA') + rng.normal(0, 0.1, size=2000))
+    return x, y
+
+
+@pytest.mark.parametrize("name", sorted(REGRESSOR_BACKENDS))
+def test_regressor_backends(name):
+    x, y = generate_training_data()
+    backend = get_regressor_backend(name, n_threads=1, early_stopping_rounds=10, time_budget=30)
+    model = backend.fit(x, y, ['country'])
+
+    residuals = y - model.predict(x)
+    assert residuals.var() < 0.1 * y.var()
+    # fitted models are stored in the on-disk model cache
+    assert np.allclose(pickle.loads(pickle.dumps(model)).predict(x.iloc[:10]), model.predict(x.iloc[:10]))
+
+
+def test_incomplete_backend_is_rejected():
+    class IncompleteBackend(RegressorBackend):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        IncompleteBackend()
+
+
+def test_time_budget_stops_boosting():
+    x, y = generate_training_data()
+    start = time.monotonic()
+    model = get_regressor_backend("sklearn_hist", n_threads=1, time_budget=0, max_iter=10_000).fit(x, y, ['country'])
+    assert time.monotonic() - start < 5
+    assert model.model.n_iter_ < 10_000
+
+
+def test_analyzer_with_regressor_backend():
+    analyzer = ABTestAnalyzer(generate_event_data(), generate_user_allocations(), "A", generate_user_properties(),
+                              mode="gboost_cuped", regressor="ridge_target_encoding")
+    metric = analyzer.calculate_event_attribute_sum_per_user('purchase', 'purchase_value')
+    assert 0 <= metric.result.stat_significance['B'] <= 1
+
+    with pytest.raises(ValueError):
+        get_regressor_backend("unknown")
+
+
+def test_cross_fitting_folds_are_stratified():
+    strata = np.repeat(['A', 'B', 'C'], [100, 50, 7])
+    fold_ids = CrossFitting(n_folds=5, random_state=1).fold_ids(strata)
+    for stratum in ['A', 'B']:
+        assert np.all(np.bincount(fold_ids[strata == stratum], minlength=5) == (strata == stratum).sum() // 5)
+    assert set(fold_ids[strata == 'C']) <= set(range(5))
+
+
+# a user's out-of-fold prediction does not depend on the user's own target
+def test_cross_fitting_predicts_out_of_fold():
+    x, y = generate_training_data()
+    strata = np.where(np.arange(len(x)) % 2 == 0, 'A', 'B')
+    backend = get_regressor_backend("ridge_target_encoding", n_threads=1)
+    cross_fitting = CrossFitting(n_folds=4)
+    predictions = cross_fitting.predict_out_of_fold(backend, x, y, ['country'], strata)
+    assert np.var(y - predictions) < 0.1 * y.var()
+
+    holdout = cross_fitting.fold_ids(strata) == 0
+    changed_y = y.where(~holdout, y + 100)
+    changed_predictions = cross_fitting.predict_out_of_fold(backend, x, changed_y, ['country'], strata)
+    assert np.allclose(changed_predictions[holdout], predictions[holdout])
+    assert not np.allclose(changed_predictions[~holdout], predictions[~holdout])
+
+    # parallel folds and cached fold models give the same predictions
+    model_cache = ModelCache()
+    parallel = CrossFitting(n_folds=4, n_jobs=4)
+    assert np.allclose(parallel.predict_out_of_fold(backend, x, y, ['country'], strata, model_cache), predictions)
+    assert np.allclose(parallel.predict_out_of_fold(backend, x, y, ['country'], strata, model_cache), predictions)
+    assert model_cache.misses == 4 and model_cache.hits == 4
+
+
+def test_analyzer_with_cross_fitting():
+    analyzer = ABTestAnalyzer(generate_event_data(), generate_user_allocations(), "A", generate_user_properties(),
+                              mode="gboost_cuped", regressor="ridge_target_encoding",
+                              cross_fitting=CrossFitting(n_folds=3, n_jobs=2))
+    metric = analyzer.calculate_event_attribute_sum_per_user('purchase', 'purchase_value')
+    assert 0 <= metric.result.stat_significance['B'] <= 1
+
+    with pytest.raises(ValueError):
+        CrossFitting(n_folds=1)
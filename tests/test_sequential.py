@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from ab_test_advanced_toolkit import ABTestAnalyzer
+from ab_test_advanced_toolkit.metrics import MetricType, MetricSpec, MetricParams
+from ab_test_advanced_toolkit.moments import GroupMoments, calculate_group_moments
+from ab_test_advanced_toolkit.sequential import SequentialState, msprt_p_value
+from ab_test_advanced_toolkit.stat_significance import StatSignificanceMethod
+from tests.test_utils import generate_event_data, generate_user_allocations
+
+SPECS = [
+    MetricSpec(MetricType.EVENT_COUNT_PER_USER, MetricParams('purchase')),
+    MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value')),
+    MetricSpec(MetricType.CONVERSION_RATE, MetricParams('login')),
+]
+
+
+# incremental updates from new events only give the same moments as a recomputation over the full history
+def test_sequential_updates_match_full_recalculation(tmp_path):
+    event_data = generate_event_data()
+    ab_test_allocations = generate_user_allocations()
+    state_path = str(tmp_path / "state.pkl")
+
+    # users allocated later in the experiment join the state on a later update; allocations of some users reach
+    # the analyzer only after their first events, which are kept pending until then
+    late_users = [5, 6, 7]
+    early_allocations = ab_test_allocations.iloc[:60][~ab_test_allocations['userid'].iloc[:60].isin(late_users)]
+    assert event_data.iloc[:40]['userid'].isin(late_users).any()
+    p_values = []
+    # the second batch overlaps the first one, re-delivered events are skipped
+    for new_events, allocations in [(event_data.iloc[:40], early_allocations),
+                                    (event_data.iloc[30:70], ab_test_allocations),
+                                    (event_data.iloc[70:], ab_test_allocations)]:
+        analyzer = ABTestAnalyzer(None, allocations, "A")
+        metrics = analyzer.update_sequential(new_events, SPECS, state_path)
+        p_values.append([metric.result.stat_significance['B'] for metric in metrics])
+
+    state = SequentialState.load(state_path)
+    assert state.num_updates == 3
+    assert state.checkpoint == event_data["timestamp"].max()
+    assert len(state.userids) == len(ab_test_allocations)
+
+    expected = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode="no_enhancement")
+    aggregates = expected._merge_and_aggregate_batch(event_data, expected.ab_test_allocations, SPECS)
+    for spec, metric in zip(SPECS, metrics):
+        merged_intest = aggregates[spec.key][1]
+        moments = calculate_group_moments(merged_intest, spec.value_column)
+        for group in ['A', 'B']:
+            assert state.group_moments(spec.key, group).n == moments[group].n
+            assert state.group_moments(spec.key, group).mean == pytest.approx(moments[group].mean)
+            assert state.group_moments(spec.key, group).variance == pytest.approx(moments[group].variance)
+        assert metric.result.data == pytest.approx(aggregates[spec.key][2][spec.value_column].to_dict())
+        assert metric.result.stat_significance_method == StatSignificanceMethod.MSPRT
+
+    # always-valid p-values never increase between looks
+    for previous, current in zip(p_values, p_values[1:]):
+        assert all(c <= p for p, c in zip(previous, current))
+
+
+def test_msprt_p_value():
+    rng = np.random.default_rng(0)
+    control = GroupMoments.from_values(rng.normal(0, 1, size=5000))
+    assert msprt_p_value(control, GroupMoments.from_values(rng.normal(0.2, 1, size=5000))) < 1e-6
+    assert msprt_p_value(control, GroupMoments.from_values(rng.normal(0, 1, size=5000))) > 0.05
+    assert msprt_p_value(control, GroupMoments(1, 1.0, 1.0)) == 1.0
@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+from sklearn.linear_model import LinearRegression
+
+from ab_test_advanced_toolkit.moments import GroupMoments, CovariateMoments, MomentsMatrix, calculate_group_moments
+from ab_test_advanced_toolkit.stat_significance import StatTests, StatSignificanceMethod, BootstrapEngine, \
+    adjust_p_values, _poisson_weights
+
+
+def generate_merged_intest():
+    rng = np.random.default_rng(42)
+    return pd.DataFrame({
+        'abgroup': rng.choice(['A', 'B', 'C'], size=300),
+        'value': rng.exponential(2.0, size=300),
+    }, index=pd.Index(np.arange(1, 301), name='userid'))
+
+
+def test_t_test_from_moments_matches_scipy():
+    merged_intest = generate_merged_intest()
+    result = StatTests.calculate_t_test_for_dataset(merged_intest, 'A', ['B', 'C'])
+
+    control_values = merged_intest[merged_intest['abgroup'] == 'A']['value']
+    for test_group, p_value in zip(['B', 'C'], result.p_values):
+        test_values = merged_intest[merged_intest['abgroup'] == test_group]['value']
+        _, expected = stats.ttest_ind(control_values, test_values, equal_var=False)
+        assert p_value == pytest.approx(expected, rel=1e-9)
+
+
+def test_compare_moments_matrix_matches_scipy():
+    rng = np.random.default_rng(3)
+    groups = ['A', 'B', 'C', 'D']
+    abgroup = rng.choice(groups, size=400)
+    metric_values = [rng.exponential(scale, size=400) for scale in (1.0, 2.0, 5.0)]
+
+    moments = MomentsMatrix.stack([StatTests.group_moments_row(values, abgroup, groups) for values in metric_values])
+    results = StatTests.compare_moments_matrix(moments, StatSignificanceMethod.T_TEST, correction="holm")
+
+    p_values = []
+    for values, result in zip(metric_values, results):
+        for test_group, p_value in zip(groups[1:], result.p_values):
+            _, expected = stats.ttest_ind(values[abgroup == 'A'], values[abgroup == test_group], equal_var=False)
+            assert p_value == pytest.approx(expected, rel=1e-9)
+            p_values.append(p_value)
+    # the correction is applied across all metrics and test groups
+    adjusted = [p_value for result in results for p_value in result.adjusted_p_values]
+    assert adjusted == pytest.approx(list(adjust_p_values(p_values, "holm")))
+    assert results[0].correction == "holm"
+
+
+def test_adjust_p_values():
+    p_values = np.array([0.01, 0.04, 0.03, np.nan, 0.005])
+    assert adjust_p_values(p_values, "holm") == pytest.approx([0.03, 0.06, 0.06, np.nan, 0.02], nan_ok=True)
+    assert adjust_p_values(p_values, "bh") == pytest.approx([0.02, 0.04, 0.04, np.nan, 0.02], nan_ok=True)
+    assert adjust_p_values(p_values.reshape(1, 5), "bh").shape == (1, 5)
+    assert adjust_p_values([0.9, 0.8], "holm") == pytest.approx([1.0, 1.0])
+    with pytest.raises(ValueError):
+        adjust_p_values(p_values, "bonferroni")
+
+
+def test_group_moments_can_be_merged():
+    merged_intest = generate_merged_intest()
+    first_half = calculate_group_moments(merged_intest.iloc[:150], 'value')
+    second_half = calculate_group_moments(merged_intest.iloc[150:], 'value')
+    moments = calculate_group_moments(merged_intest, 'value')
+
+    for group in ['A', 'B', 'C']:
+        merged = first_half[group] + second_half[group]
+        assert merged.n == moments[group].n
+        assert merged.mean == pytest.approx(moments[group].mean)
+        assert merged.variance == pytest.approx(moments[group].variance)
+
+    values = merged_intest[merged_intest['abgroup'] == 'A']['value']
+    assert moments['A'].variance == pytest.approx(values.var())
+    assert GroupMoments.from_values(values).mean == pytest.approx(values.mean())
+
+
+def generate_merged_pretest_and_intest():
+    rng = np.random.default_rng(7)
+    index = pd.Index(np.arange(1, 501), name='userid')
+    abgroup = rng.choice(['A', 'B'], size=500)
+    covariates = rng.normal(size=(500, 2))
+    value = 1.5 * covariates[:, 0] - 0.5 * covariates[:, 1] + rng.normal(size=500) + (abgroup == 'B') * 0.2
+    merged_pretest = pd.DataFrame({'abgroup': abgroup, 'x1': covariates[:, 0], 'x2': covariates[:, 1]}, index=index)
+    merged_intest = pd.DataFrame({'abgroup': abgroup, 'value': value}, index=index)
+    return merged_pretest, merged_intest
+
+
+def test_cuped_matches_linear_regression():
+    merged_pretest, merged_intest = generate_merged_pretest_and_intest()
+    control = merged_intest['abgroup'] == 'A'
+
+    model = LinearRegression().fit(merged_pretest.loc[control, ['x1', 'x2']], merged_intest.loc[control, 'value'])
+    moments = CovariateMoments.from_values(merged_pretest.loc[control, ['x1', 'x2']], merged_intest.loc[control, 'value'])
+    assert moments.theta == pytest.approx(model.coef_)
+    assert moments.intercept == pytest.approx(model.intercept_)
+
+    adjusted = merged_intest['value'] - model.predict(merged_pretest[['x1', 'x2']])
+    _, expected = stats.ttest_ind(adjusted[control], adjusted[~control], equal_var=False)
+    result = StatTests.calculate_cuped_and_compare(merged_pretest, merged_intest, 'A', ['B'])
+    assert result.p_values[0] == pytest.approx(expected, rel=1e-6)
+
+
+def test_cuped_accepts_streamed_moments():
+    merged_pretest, merged_intest = generate_merged_pretest_and_intest()
+    control = (merged_intest['abgroup'] == 'A').to_numpy()
+    x = merged_pretest[['x1', 'x2']].to_numpy()[control]
+    y = merged_intest['value'].to_numpy()[control]
+
+    streamed = CovariateMoments(2)
+    for chunk in np.array_split(np.arange(len(y)), 5):
+        streamed.update(x[chunk], y[chunk])
+    assert streamed.theta == pytest.approx(CovariateMoments.from_values(x, y).theta)
+
+    result = StatTests.calculate_cuped_and_compare(merged_pretest, merged_intest, 'A', ['B'])
+    streamed_result = StatTests.calculate_cuped_and_compare(merged_pretest, merged_intest, 'A', ['B'],
+                                                            covariate_moments=streamed)
+    assert streamed_result.p_values[0] == pytest.approx(result.p_values[0])
+
+
+# table lookup weights follow Poisson(1), including the tail beyond the resolution of the table
+def test_poisson_weights_have_poisson_tail():
+    weights = _poisson_weights(np.random.default_rng(0), (1 << 12, 1 << 12))
+    counts = np.bincount(weights.astype(int).ravel(), minlength=12)[:12]
+    expected = stats.poisson.pmf(np.arange(12), 1.0) * weights.size
+    assert counts[8:].sum() > 0
+    assert (np.abs(counts - expected) < 5 * np.sqrt(expected) + 1).all()
+
+
+@pytest.mark.parametrize("weights", ["poisson", "multinomial"])
+def test_bootstrap_interval_matches_normal_approximation(weights):
+    rng = np.random.default_rng(3)
+    control_values = rng.exponential(1.0, size=20000)
+    test_values = rng.exponential(1.1, size=20000)
+    engine = BootstrapEngine(n_replicates=400, weights=weights, max_block_elements=1_000_000, seed=1)
+    low, high = engine.relative_lift_interval(control_values, test_values)
+
+    lift = test_values.mean() / control_values.mean() - 1
+    # delta method standard error of the ratio of means
+    ratio = test_values.mean() / control_values.mean()
+    se = ratio * np.sqrt(test_values.var() / len(test_values) / test_values.mean() ** 2 +
+                         control_values.var() / len(control_values) / control_values.mean() ** 2)
+    assert low < lift < high
+    assert low == pytest.approx(lift - 1.96 * se, abs=0.5 * se)
+    assert high == pytest.approx(lift + 1.96 * se, abs=0.5 * se)
+    # the same seed gives the same interval, in one thread or several
+    assert BootstrapEngine(n_replicates=400, weights=weights, max_block_elements=1_000_000, seed=1,
+                           n_jobs=2).relative_lift_interval(control_values, test_values) == (low, high)
+
+
+def test_bootstrap_confidence_intervals_for_groups():
+    merged_intest = generate_merged_intest()
+    intervals = BootstrapEngine(n_replicates=200, seed=0).calculate_confidence_intervals(merged_intest, 'A',
+                                                                                          ['B', 'C', 'D'])
+    assert set(intervals) == {'B', 'C', 'D'}
+    for group in ['B', 'C']:
+        values = merged_intest.groupby('abgroup')['value'].mean()
+        low, high = intervals[group]
+        assert low < values[group] / values['A'] - 1 < high
+    assert np.isnan(intervals['D'][0])
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ab_test_advanced_toolkit import ABTestAnalyzer, user_timeline
+from ab_test_advanced_toolkit.allocation_table import NAT
+from ab_test_advanced_toolkit.metrics import MetricSpec, MetricType, MetricParams
+from ab_test_advanced_toolkit.user_timeline import UserTimeline
+from tests.test_utils import generate_event_data, generate_user_allocations
+
+SPECS = [
+    MetricSpec(MetricType.EVENT_COUNT_PER_USER, MetricParams('purchase')),
+    MetricSpec(MetricType.EVENT_ATTRIBUTE_SUM_PER_USER, MetricParams('purchase', 'purchase_value')),
+    MetricSpec(MetricType.CONVERSION_RATE, MetricParams('login')),
+]
+
+
+@pytest.mark.parametrize("packed", [True, False])
+@pytest.mark.parametrize("lookback", [None, 5])
+def test_user_timeline_matches_masks(lookback, packed, monkeypatch):
+    if not packed:
+        # keys that do not fit into int64 are sorted with np.lexsort instead
+        monkeypatch.setattr(user_timeline, "MAX_PACKED_KEY", 0)
+    rng = np.random.default_rng(0)
+    num_users, num_events = 50, 2000
+    codes = rng.integers(-1, num_users, size=num_events)
+    event_times = rng.integers(0, 30, size=num_events)
+    event_times[rng.random(num_events) < 0.05] = NAT
+    allocation_times = rng.integers(0, 30, size=num_users)
+    allocation_times[:3] = NAT
+    values = rng.normal(size=(num_events, 2))
+
+    timeline = UserTimeline(codes, event_times, num_users, values)
+    assert timeline.packed == packed
+    pretest_counts, pretest_sums, intest_counts, intest_sums = timeline.period_aggregates(allocation_times, lookback)
+
+    for user in range(num_users):
+        allocated = allocation_times[user] != NAT
+        own = (codes == user) & (event_times != NAT) & allocated
+        pretest = own & (event_times < allocation_times[user])
+        if lookback is not None and allocated:
+            pretest &= event_times >= allocation_times[user] - lookback
+        intest = own & (event_times >= allocation_times[user])
+        assert pretest_counts[user] == pretest.sum()
+        assert intest_counts[user] == intest.sum()
+        assert pretest_sums[user] == pytest.approx(values[pretest].sum(axis=0))
+        assert intest_sums[user] == pytest.approx(values[intest].sum(axis=0))
+
+
+def results(metrics):
+    return [(metric.result.data, metric.result.stat_significance) for metric in metrics]
+
+
+def assert_same_results(actual, expected):
+    for (actual_data, actual_p_values), (expected_data, expected_p_values) in zip(results(actual), results(expected)):
+        assert actual_data == pytest.approx(expected_data)
+        assert actual_p_values == pytest.approx(expected_p_values, nan_ok=True)
+
+
+@pytest.mark.parametrize("pretest_lookback", [None, "12h"])
+def test_sorted_split_matches_merge_split(pretest_lookback):
+    event_data = generate_event_data()
+    # events from before the allocation of their users, so that the lookback window matters
+    event_data['timestamp'] = event_data['timestamp'] - pd.Timedelta("20D")
+    ab_test_allocations = generate_user_allocations()
+
+    merge = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode="cuped", pretest_lookback=pretest_lookback)
+    sorted_split = ABTestAnalyzer(event_data, ab_test_allocations, "A", mode="cuped", period_split="sorted",
+                                  pretest_lookback=pretest_lookback)
+
+    expected = merge.calculate_metrics(SPECS)
+    assert_same_results(sorted_split.calculate_metrics(SPECS), expected)
+    assert_same_results(sorted_split.calculate_metrics_from_chunks([event_data.iloc[:30], event_data.iloc[30:]],
+                                                                   SPECS), expected)
+    assert_same_results([sorted_split.calculate_event_count_per_user('purchase'),
+                         sorted_split.calculate_event_attribute_sum_per_user('purchase', 'purchase_value'),
+                         sorted_split.calculate_conversion('login')],
+                        [merge.calculate_event_count_per_user('purchase'),
+                         merge.calculate_event_attribute_sum_per_user('purchase', 'purchase_value'),
+                         merge.calculate_conversion('login')])
+
+
+def test_pretest_lookback_limits_pretest_events():
+    event_data = generate_event_data()
+    event_data['timestamp'] = event_data['timestamp'] - pd.Timedelta("20D")
+    ab_test_allocations = generate_user_allocations()
+    spec = SPECS[0]
+
+    for period_split in ["merge", "sorted"]:
+        everything = ABTestAnalyzer(event_data, ab_test_allocations, "A", period_split=period_split)
+        window = ABTestAnalyzer(event_data, ab_test_allocations, "A", period_split=period_split,
+                                pretest_lookback="12h")
+        all_pretest = everything._merge_and_aggregate_batch(
+            event_data, everything.ab_test_allocations, [spec], allocation_table=everything.allocation_table,
+            **everything._period_settings())[spec.key][0]
+        window_pretest = window._merge_and_aggregate_batch(
+            event_data, window.ab_test_allocations, [spec], allocation_table=window.allocation_table,
+            **window._period_settings())[spec.key][0]
+        assert 0 < window_pretest[spec.value_column].sum() < all_pretest[spec.value_column].sum()
+
+    with pytest.raises(ValueError):
+        ABTestAnalyzer(event_data, ab_test_allocations, "A", period_split="unknown")